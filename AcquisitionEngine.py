@@ -0,0 +1,190 @@
+"""
+AcquisitionEngine.py
+
+Runs an acquisition on a worker thread, so GUI repaints don't stall the scope
+    and slow frames don't freeze the GUI.
+
+The acquisition function is called as `target(engine, *args)`.  It should
+    report progress with `engine.progress(...)` and call `engine.checkpoint()`
+    between frames, which blocks while the acquisition is paused and returns
+    False once it has been aborted.
+
+    >>> engine = AcquisitionEngine(acquire, args=(outdir,))
+    >>> engine.add_listener(on_event)
+    >>> engine.start()
+    >>> engine.pause()
+    >>> engine.resume()
+    >>> engine.abort()
+
+Commands can be sent from any thread.  Listeners are called with an
+    AcquisitionEvent on the worker thread, so GUI listeners have to hand events
+    over to the GUI thread themselves (eg. with wx.CallAfter).
+
+"""
+import time
+import Queue
+import logging
+import threading
+import traceback
+import collections
+
+# states
+IDLE = "idle"
+RUNNING = "running"
+PAUSED = "paused"
+ABORTING = "aborting"
+FINISHED = "finished"
+FAILED = "failed"
+
+# commands
+PAUSE = "pause"
+RESUME = "resume"
+ABORT = "abort"
+
+# events
+STARTED = "started"
+PROGRESS = "progress"
+PAUSED_EVENT = "paused"
+RESUMED = "resumed"
+ABORTED = "aborted"
+DONE = "done"
+
+AcquisitionEvent = collections.namedtuple('AcquisitionEvent', 'kind status')
+
+
+class AcquisitionEngine(object):
+    """ Runs `target(engine, *args)` on a worker thread with a pause/resume/abort
+            command channel.
+
+        Args:
+            target (callable): the acquisition
+            args (tuple): extra arguments for target
+            max_val (int): progress value at completion
+    """
+    def __init__(self, target, args=(), max_val=100):
+        self.target = target
+        self.args = args
+        self._commands = Queue.Queue()
+        self._listeners = []
+        self._lock = threading.Lock()
+        self._thread = None
+        self._state = IDLE
+        self._value = 0
+        self._max_val = max_val
+        self._message = ""
+        self._error = None
+        self._start_time = None
+
+    def add_listener(self, callback):
+        """ Calls `callback(event)` for every AcquisitionEvent.
+        """
+        self._listeners.append(callback)
+
+    def _emit(self, kind):
+        event = AcquisitionEvent(kind, self.status)
+        for callback in self._listeners:
+            try:
+                callback(event)
+            except Exception:
+                logging.exception("Acquisition event listener failed.")
+
+    def _set_state(self, state):
+        with self._lock:
+            self._state = state
+
+    @property
+    def state(self):
+        return self._state
+
+    @property
+    def status(self):
+        """ Snapshot of the acquisition state and progress.
+        """
+        with self._lock:
+            return {
+                'state': self._state,
+                'value': self._value,
+                'max_val': self._max_val,
+                'message': self._message,
+                'elapsed': time.time()-self._start_time if self._start_time else 0.0,
+                'error': self._error,
+            }
+
+    def is_alive(self):
+        return self._thread is not None and self._thread.is_alive()
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run, name="acquisition")
+        self._thread.daemon = True
+        self._thread.start()
+
+    def join(self, timeout=None):
+        if self._thread is not None:
+            self._thread.join(timeout)
+
+    def _run(self):
+        self._start_time = time.time()
+        self._set_state(RUNNING)
+        self._emit(STARTED)
+        try:
+            self.target(self, *self.args)
+        except Exception:
+            logging.exception("Acquisition failed.")
+            with self._lock:
+                self._error = traceback.format_exc()
+            self._set_state(FAILED)
+        else:
+            self._set_state(FINISHED)
+        self._emit(DONE)
+
+    # commands, safe to call from any thread
+
+    def pause(self):
+        self._commands.put(PAUSE)
+
+    def resume(self):
+        self._commands.put(RESUME)
+
+    def abort(self):
+        self._commands.put(ABORT)
+
+    # called by the acquisition
+
+    def progress(self, value, message="", max_val=None):
+        with self._lock:
+            self._value = value
+            if message:
+                self._message = message
+            if max_val is not None:
+                self._max_val = max_val
+        self._emit(PROGRESS)
+
+    def _handle(self, command):
+        if command == ABORT:
+            self._set_state(ABORTING)
+            self._emit(ABORTED)
+        elif command == PAUSE and self._state == RUNNING:
+            self._set_state(PAUSED)
+            self._emit(PAUSED_EVENT)
+        elif command == RESUME and self._state == PAUSED:
+            self._set_state(RUNNING)
+            self._emit(RESUMED)
+
+    def checkpoint(self):
+        """ Handles pending commands, blocks while paused.
+
+            Returns:
+                bool: False if the acquisition should stop
+        """
+        while True:
+            try:
+                self._handle(self._commands.get_nowait())
+            except Queue.Empty:
+                break
+        while self._state == PAUSED:
+            self._handle(self._commands.get())
+        return self._state != ABORTING
+
+    @property
+    def aborted(self):
+        return self._state == ABORTING
@@ -0,0 +1,152 @@
+"""
+AcquisitionPipeline.py
+
+A small state machine for pipelined acquisition.  Instead of
+    move -> settle -> snap -> queue -> move, the stage move to frame N+1 is
+    sent as soon as the last exposure of frame N is done, and the data for
+    frame N is handed to the save queue while the stage is travelling.
+
+    >>> pipeline = FramePipeline(imgSrc)
+    >>> pipeline.arrive(x0, y0)          # blocking move, nothing in flight
+    >>> ... snap channels, pipeline.defer(token) ...
+    >>> pipeline.start_move(x1, y1)      # non-blocking
+    >>> pipeline.flush(dataQueue)        # overlaps with the move
+    >>> pipeline.arrive(x1, y1)          # waits for whatever is left of the move
+
+"""
+import time
+import logging
+
+import numpy as np
+
+
+IDLE = "IDLE"
+MOVING = "MOVING"
+ACQUIRING = "ACQUIRING"
+
+# allowed state transitions
+TRANSITIONS = {
+    IDLE: (MOVING, ACQUIRING),
+    MOVING: (ACQUIRING,),
+    ACQUIRING: (MOVING, IDLE),
+}
+
+
+class PipelineStateError(Exception):
+    pass
+
+
+class FramePipeline(object):
+    """ Overlaps the stage move to the next frame with queueing the data from
+            the previous one.
+
+        Each call to `arrive` closes out the previous move and records how much
+            work was done while the stage was moving.
+
+        Args:
+            imgSrc (ImageSource): image source, must implement `move_stage`,
+                `start_move_stage`, `wait_for_stage` and `is_stage_busy`
+    """
+    def __init__(self, imgSrc):
+        self.imgSrc = imgSrc
+        self.state = IDLE
+        self.frame_savings = []  # seconds saved per pipelined frame
+
+        self._deferred = []
+        self._pending_xy = None
+        self._move_t0 = None
+        self._move_time = None  # running estimate of a full stage move (s)
+
+    def _transition(self, state):
+        if state not in TRANSITIONS[self.state]:
+            raise PipelineStateError("Can't go from {} to {}".format(self.state, state))
+        self.state = state
+
+    def start_move(self, x, y):
+        """ Starts moving the stage to (x, y) without waiting for it to get there.
+        """
+        self._transition(MOVING)
+        self._pending_xy = (x, y)
+        self._move_t0 = time.time()
+        self.imgSrc.start_move_stage(x, y)
+
+    def arrive(self, x, y):
+        """ Makes sure the stage is at (x, y).  If a move there is already in
+                flight we just wait for it, otherwise this is a normal blocking
+                move.
+
+            Returns:
+                float: seconds of work that overlapped with the stage move
+        """
+        if self.state == MOVING and self._pending_xy == (x, y):
+            t_wait = time.time()
+            still_moving = self.imgSrc.is_stage_busy()
+            self.imgSrc.wait_for_stage()
+            t_done = time.time()
+            overlapped = t_wait - self._move_t0
+            if still_moving:
+                # the move took the whole time we were busy, and then some
+                self._update_move_time(t_done - self._move_t0)
+                saved = overlapped
+            elif self._move_time is not None:
+                # the stage beat us there, so at most one move was hidden
+                saved = min(overlapped, self._move_time)
+            else:
+                saved = 0.0
+            self.frame_savings.append(saved)
+            logging.debug("Pipelined move overlapped {:.1f} ms of work".format(saved*1000))
+        else:
+            if self.state == MOVING:
+                # someone changed their mind about where we're going
+                self.imgSrc.wait_for_stage()
+                self.state = IDLE
+            t0 = time.time()
+            self.imgSrc.move_stage(x, y)
+            self._update_move_time(time.time()-t0)
+            saved = 0.0
+        self._pending_xy = None
+        self._transition(ACQUIRING)
+        return saved
+
+    def _update_move_time(self, duration):
+        if self._move_time is None:
+            self._move_time = duration
+        else:
+            self._move_time = 0.8*self._move_time + 0.2*duration
+
+    def defer(self, token):
+        """ Holds on to a save-queue token until the next `flush`.
+        """
+        self._deferred.append(token)
+
+    def flush(self, queue):
+        """ Puts all deferred tokens on the save queue.  Call after `start_move`
+                so that the copying happens while the stage is moving.
+        """
+        for token in self._deferred:
+            queue.put(token)
+        self._deferred = []
+        if self.state == ACQUIRING:
+            self._transition(IDLE)
+
+    def finish(self, queue):
+        """ Flushes anything left and waits for any move still in flight.
+        """
+        if self.state == MOVING:
+            self.imgSrc.wait_for_stage()
+            self.state = IDLE
+        self.flush(queue)
+        self.state = IDLE
+
+    @property
+    def summary(self):
+        """ Summary of the time saved by pipelining so far.
+        """
+        savings = np.array(self.frame_savings)
+        if not len(savings):
+            return {'frames': 0, 'total_saved': 0.0, 'mean_saved': 0.0}
+        return {
+            'frames': len(savings),
+            'total_saved': float(savings.sum()),
+            'mean_saved': float(savings.mean()),
+        }
@@ -0,0 +1,159 @@
+"""
+AcquisitionTrace.py
+
+Per-frame timing trace for acquisitions.  Every phase of every frame (stage
+    move, autofocus wait, snap, etc) is recorded as a span and appended to a
+    small csv file:
+
+    phase,section,frame,start,duration
+
+    `start` is seconds since the epoch and `duration` is in seconds, so traces
+    written by different processes (acquisition and save) can be merged.
+
+    >>> trace = AcquisitionTrace("C:/data/acquisition_trace.csv")
+    >>> trace.set_frame(section=3, frame=0)
+    >>> with trace.span(SNAP):
+    ...     data = imgSrc.snap_image()
+    >>> trace.close()
+
+Use trace_report.py to summarize one or more trace files.
+
+"""
+import time
+
+# phases
+STAGE_MOVE = "stage_move"
+AUTOFOCUS_WAIT = "autofocus_wait"
+AUTOFOCUS_WAIT_2 = "autofocus_wait_2"
+PIEZO_RESET = "piezo_reset"
+SET_Z = "set_z"
+SET_CHANNEL = "set_channel"
+SET_EXPOSURE = "set_exposure"
+SNAP = "snap"
+QUEUE_PUT = "queue_put"
+DISK_WRITE = "disk_write"
+
+HEADER = "phase,section,frame,start,duration\n"
+
+
+class _Span(object):
+    """ Context manager that records a single span on exit.
+    """
+    __slots__ = ('trace', 'phase', 'section', 'frame', 't0')
+
+    def __init__(self, trace, phase, section, frame):
+        self.trace = trace
+        self.phase = phase
+        self.section = section
+        self.frame = frame
+
+    def __enter__(self):
+        self.t0 = time.time()
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        self.trace.record(self.phase, self.t0, time.time()-self.t0,
+                          self.section, self.frame)
+        return False
+
+
+class AcquisitionTrace(object):
+    """ Records timestamped spans to a csv file.
+
+        Args:
+            filename (str): trace file to write, appended to if it exists
+            buffer_size (int): number of spans to hold before writing
+    """
+    def __init__(self, filename, buffer_size=200):
+        self.filename = filename
+        self.buffer_size = buffer_size
+        self.section = -1
+        self.frame = -1
+        self._lines = []
+        self._file = open(filename, 'a')
+        if self._file.tell() == 0:
+            self._file.write(HEADER)
+
+    def set_frame(self, section, frame):
+        """ Sets the section and frame that following spans belong to.
+        """
+        self.section = section
+        self.frame = frame
+
+    def span(self, phase, section=None, frame=None):
+        """ Context manager that times the enclosed block as `phase`.
+                Defaults to the current section and frame.
+        """
+        if section is None:
+            section = self.section
+        if frame is None:
+            frame = self.frame
+        return _Span(self, phase, section, frame)
+
+    def record(self, phase, start, duration, section=None, frame=None):
+        """ Records a span that was timed elsewhere.
+        """
+        if section is None:
+            section = self.section
+        if frame is None:
+            frame = self.frame
+        self._lines.append("%s,%d,%d,%.6f,%.6f\n" % (phase, section, frame, start, duration))
+        if len(self._lines) >= self.buffer_size:
+            self.flush()
+
+    def flush(self):
+        if self._lines:
+            self._file.write("".join(self._lines))
+            self._file.flush()
+            self._lines = []
+
+    def close(self):
+        self.flush()
+        self._file.close()
+
+
+class _NullSpan(object):
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        return False
+
+_NULL_SPAN = _NullSpan()
+
+
+class NullTrace(object):
+    """ Stand-in for AcquisitionTrace when tracing is off.
+    """
+    def set_frame(self, section, frame):
+        pass
+
+    def span(self, phase, section=None, frame=None):
+        return _NULL_SPAN
+
+    def record(self, phase, start, duration, section=None, frame=None):
+        pass
+
+    def flush(self):
+        pass
+
+    def close(self):
+        pass
+
+
+def load_trace(filename):
+    """ Loads a trace file.
+
+        Returns:
+            list: (phase, section, frame, start, duration) tuples
+    """
+    spans = []
+    with open(filename, 'r') as f:
+        for line in f:
+            if line.startswith("phase"):
+                continue
+            phase, section, frame, start, duration = line.strip().split(",")
+            spans.append((phase, int(section), int(frame), float(start), float(duration)))
+    return spans
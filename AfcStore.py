@@ -0,0 +1,194 @@
+"""
+AfcStore.py
+
+Leica AFC profiles for a whole session in two memory mappable files instead of
+    an _afc.json per frame.
+
+    <outdir>/afc_profiles.npy: every profile, one after the other (float64)
+    <outdir>/afc_index.npy: a row per profile (AFC_INDEX_DTYPE) with the
+        section, frame, stage position and where its profile starts
+
+Both files are preallocated and doubled if a session outgrows them, like the
+    FocusStore.  Rows that haven't been written yet have a time of 0.
+
+    >>> index, profiles = load_afc_profiles(outdir)
+    >>> profiles[index['section'] == 3].mean(axis=0)
+
+Use export_container.py --afc-only to write the legacy _afc.json files.
+
+"""
+import os
+import time
+
+import numpy as np
+
+from FocusStore import grow_npy, replace_npy, recover_npy, latest_rows
+
+AFC_PROFILES_FILE = "afc_profiles.npy"
+AFC_INDEX_FILE = "afc_index.npy"
+
+AFC_INDEX_DTYPE = np.dtype([
+    ('section', np.int32),
+    ('frame', np.int32),
+    ('z_index', np.int32),
+    ('prot_name', 'S64'),
+    ('x', np.float64),
+    ('y', np.float64),
+    ('offset', np.int64),
+    ('length', np.int32),
+    ('time', np.float64),
+])
+
+
+class AfcStore(object):
+    """ The session's AFC profiles, appended to by the save pool.
+
+        Args:
+            outdir (str): session directory
+            capacity (int): profiles to preallocate, eg. the number of frames
+            profile_length (int): expected values per profile, LeicaDMI's
+                get_AFC_image gives 400
+            batch_size (int): profiles to buffer before writing
+            flush_interval (float): longest a profile waits to be written (s)
+    """
+    def __init__(self, outdir, capacity=1024, profile_length=400, batch_size=50, flush_interval=2.0):
+        self.index_path = os.path.join(outdir, AFC_INDEX_FILE)
+        self.profiles_path = os.path.join(outdir, AFC_PROFILES_FILE)
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        capacity = max(capacity, 1)
+        recover_npy(self.index_path)
+        recover_npy(self.profiles_path)
+        if os.path.isfile(self.index_path):
+            # carry on with an earlier session, eg. for retakes.  The old
+            # rows go in new files first so a failure can't lose them, the
+            # profiles first so the index never points past them.
+            index, profiles = _load(outdir)
+            profiles = np.array(profiles[:_end(index)])
+            capacity = max(capacity, 2*len(index))
+            self.count = len(index)
+            self.values = len(profiles)
+            self._profiles = replace_npy(self.profiles_path, profiles,
+                                         max(capacity*profile_length, 2*self.values))
+            self._index = replace_npy(self.index_path, index, capacity)
+        else:
+            self.count = 0
+            self.values = 0
+            self._index = np.lib.format.open_memmap(self.index_path, mode='w+', dtype=AFC_INDEX_DTYPE,
+                                                    shape=(capacity,))
+            self._profiles = np.lib.format.open_memmap(self.profiles_path, mode='w+', dtype=np.float64,
+                                                       shape=(capacity*profile_length,))
+        self._rows = []
+        self._last_flush = time.time()
+        self.flushes = 0
+
+    def append(self, row):
+        """ Buffers a profile, `row` is a save pool row with afc_image.
+        """
+        self._rows.append(row)
+        if len(self._rows) >= self.batch_size or time.time() - self._last_flush > self.flush_interval:
+            self.flush()
+
+    def flush(self):
+        """ Writes buffered profiles.
+        """
+        self._last_flush = time.time()
+        if not self._rows:
+            return
+        index = np.zeros(len(self._rows), AFC_INDEX_DTYPE)
+        profiles = [np.asarray(row['afc_image'], np.float64).ravel() for row in self._rows]
+        for name in ('section', 'frame', 'z_index', 'prot_name', 'x', 'y'):
+            index[name] = [row[name] for row in self._rows]
+        index['length'] = [len(profile) for profile in profiles]
+        index['offset'] = self.values + np.concatenate(([0], np.cumsum(index['length'])[:-1]))
+        index['time'] = [row.get('time') or time.time() for row in self._rows]
+        profiles = np.concatenate(profiles)
+
+        # the old mappings have to be closed before their files are replaced
+        if self.count + len(index) > len(self._index):
+            rows, size = np.array(self._index[:self.count]), len(self._index)
+            self._index = None
+            self._index = grow_npy(self.index_path, rows, size, self.count + len(index))
+        if self.values + len(profiles) > len(self._profiles):
+            rows, size = np.array(self._profiles[:self.values]), len(self._profiles)
+            self._profiles = None
+            self._profiles = grow_npy(self.profiles_path, rows, size, self.values + len(profiles))
+
+        # profiles first, so an index row never points at a profile that isn't there
+        self._profiles[self.values:self.values+len(profiles)] = profiles
+        self._profiles.flush()
+        self._index[self.count:self.count+len(index)] = index
+        self._index.flush()
+        self.count += len(index)
+        self.values += len(profiles)
+        self._rows = []
+        self.flushes += 1
+
+    def close(self):
+        self.flush()
+        self._index = None
+        self._profiles = None
+
+
+def _end(index):
+    if not len(index):
+        return 0
+    return int((index['offset'] + index['length']).max())
+
+
+def _load(outdir, mmap_mode=None):
+    recover_npy(os.path.join(outdir, AFC_INDEX_FILE))
+    recover_npy(os.path.join(outdir, AFC_PROFILES_FILE))
+    index = np.load(os.path.join(outdir, AFC_INDEX_FILE))
+    index = index[index['time'] > 0]
+    profiles = np.load(os.path.join(outdir, AFC_PROFILES_FILE), mmap_mode=mmap_mode)
+    return index, profiles
+
+
+def load_afc_index(outdir, latest=True):
+    """ Reads the AFC index.
+
+        Args:
+            outdir (str): session directory
+            latest (bool): only the last profile for each (section, frame,
+                z_index)
+
+        Returns:
+            numpy.ndarray: AFC_INDEX_DTYPE rows in the order they were saved
+    """
+    recover_npy(os.path.join(outdir, AFC_INDEX_FILE))
+    index = np.load(os.path.join(outdir, AFC_INDEX_FILE))
+    index = index[index['time'] > 0]
+    if latest:
+        index = index[latest_rows(index, ['section', 'frame', 'z_index'])]
+    return index
+
+
+def load_afc_profiles(outdir, latest=True, mmap_mode='r'):
+    """ Reads the session's AFC profiles as one array.
+
+        Args:
+            outdir (str): session directory
+            latest (bool): only the last profile for each (section, frame,
+                z_index)
+            mmap_mode (Optional[str]): how to open the profile file, see
+                numpy.load.  Only the profiles asked for are read.
+
+        Returns:
+            tuple: (index, profiles), profiles has a row per index row, padded
+                with NaN if the profiles aren't all the same length
+    """
+    index, profiles = _load(outdir, mmap_mode)
+    if latest:
+        index = index[latest_rows(index, ['section', 'frame', 'z_index'])]
+    return index, gather_profiles(index, profiles)
+
+
+def gather_profiles(index, profiles):
+    """ The profiles of `index` rows as a 2d array, see load_afc_profiles.
+    """
+    width = int(index['length'].max()) if len(index) else 0
+    columns = np.arange(width)
+    valid = columns < index['length'][:, np.newaxis]
+    positions = index['offset'][:, np.newaxis] + np.where(valid, columns, 0)
+    return np.where(valid, profiles[positions], np.nan)
@@ -0,0 +1,189 @@
+"""
+AutofocusSettle.py
+
+Adaptive settle detection for hardware autofocus.
+
+Instead of sleeping a fixed time and then polling at a fixed interval, the
+    SettleDetector polls quickly at first and backs off exponentially.  Focus
+    is declared settled as soon as the autofocus reports lock and the focus
+    score and offset have stopped changing (within a tolerance) for a few
+    polls in a row.
+
+A lock that is just left over from before the move doesn't count: the
+    autofocus has to show it has reacted (lost lock, or the score or offset
+    moved) first, and nothing counts as settled before a minimum settle time.
+    Call `mark` before issuing the move, so a reaction during the move is seen
+    too.  If the autofocus doesn't react at all the move didn't disturb it,
+    and a stable lock is accepted after the learned settle time (or
+    `unchanged_wait` until there is one).  Waits where no reaction is expected,
+    eg. a second wait after the first settled, pass `expect_reaction=False`
+    and return as soon as the readings are stable.
+
+    >>> detector.mark()
+    >>> imgSrc.move_stage(x, y)
+    >>> detector.wait()
+
+Settle times are remembered per microscope, so the detector can skip the
+    part of the wait where the focus is certainly not settled yet.
+
+"""
+import os
+import json
+import time
+import logging
+
+import numpy as np
+
+
+class SettleDetector(object):
+    """ Waits for the hardware autofocus to settle.
+
+        Args:
+            imgSrc (ImageSource): image source, must implement
+                `is_hardware_autofocus_done`, `get_focus_score` and
+                `get_autofocus_offset`
+            scope_name (str): name used to keep settle history per microscope
+            history_file (Optional[str]): json file to load/save settle history
+            first_poll (float): first poll interval (s)
+            max_poll (float): longest poll interval (s)
+            backoff (float): poll interval growth factor
+            score_tolerance (float): max change in focus score between polls
+            offset_tolerance (float): max change in autofocus offset between polls
+            stable_polls (int): consecutive stable polls needed
+            timeout (float): give up after this long (s)
+            min_settle (float): shortest possible settle time (s)
+            unchanged_wait (float): how long to wait for the autofocus to
+                react before accepting a lock it already had, until a settle
+                time has been learned (s)
+            history_length (int): settle times to keep per scope and kind
+    """
+    def __init__(self, imgSrc, scope_name="", history_file=None,
+                 first_poll=0.005, max_poll=0.2, backoff=1.6,
+                 score_tolerance=0.5, offset_tolerance=0.05,
+                 stable_polls=2, timeout=10.0, history_length=200,
+                 min_settle=0.05, unchanged_wait=0.5):
+        self.imgSrc = imgSrc
+        self.scope_name = scope_name
+        self.history_file = history_file
+        self.first_poll = first_poll
+        self.max_poll = max_poll
+        self.backoff = backoff
+        self.score_tolerance = score_tolerance
+        self.offset_tolerance = offset_tolerance
+        self.stable_polls = stable_polls
+        self.timeout = timeout
+        self.history_length = history_length
+        self.min_settle = min_settle
+        self.unchanged_wait = unchanged_wait
+
+        self.history = {}
+        self._before = None
+        self.load_history()
+
+    def load_history(self):
+        if self.history_file and os.path.isfile(self.history_file):
+            try:
+                with open(self.history_file, 'r') as f:
+                    self.history = json.load(f).get(self.scope_name, {})
+            except Exception:
+                logging.exception("Couldn't read autofocus settle history.")
+                self.history = {}
+
+    def save_history(self):
+        """ Saves this scope's settle history, keeping any other scopes' history
+                already in the file.
+        """
+        if not self.history_file:
+            return
+        everything = {}
+        if os.path.isfile(self.history_file):
+            try:
+                with open(self.history_file, 'r') as f:
+                    everything = json.load(f)
+            except Exception:
+                logging.exception("Couldn't read autofocus settle history.")
+        everything[self.scope_name] = self.history
+        with open(self.history_file, 'w') as f:
+            json.dump(everything, f)
+
+    def typical_settle_time(self, kind="lock"):
+        """ Median settle time for this scope, or None if we don't know yet.
+        """
+        times = self.history.get(kind, [])
+        if not times:
+            return None
+        return float(np.median(times))
+
+    def _record(self, kind, elapsed):
+        times = self.history.setdefault(kind, [])
+        times.append(round(elapsed, 4))
+        del times[:-self.history_length]
+
+    def _read(self):
+        return self.imgSrc.get_focus_score(), self.imgSrc.get_autofocus_offset()
+
+    def _stable(self, previous, current):
+        if previous is None or None in previous or None in current:
+            return previous is not None and previous == current
+        return (abs(current[0]-previous[0]) <= self.score_tolerance and
+                abs(current[1]-previous[1]) <= self.offset_tolerance)
+
+    def mark(self):
+        """ Takes the readings the next `wait` compares against to see the
+                autofocus react.  Call it before moving the stage.
+        """
+        self._before = self._read()
+
+    @property
+    def marked(self):
+        return self._before is not None
+
+    def wait(self, kind="lock", require_lock=True, expect_reaction=True):
+        """ Blocks until the autofocus has settled.
+
+            Args:
+                kind (str): what we are waiting for; settle times are learned
+                    separately for each kind
+                require_lock (bool): whether the autofocus also has to report lock
+                expect_reaction (bool): if False, stable readings are enough
+
+            Returns:
+                bool: True if it settled before the timeout
+        """
+        t0 = time.time()
+        before, self._before = self._before, None
+        if before is None:
+            before = self._read()
+        typical = self.typical_settle_time(kind)
+        # a lock that held through the move is trusted after the usual time
+        unchanged_wait = self.unchanged_wait if typical is None else min(typical, self.unchanged_wait)
+        if not expect_reaction:
+            unchanged_wait = 0
+        # nothing is going to be settled before about half the usual time
+        time.sleep(max(0.5*(typical or 0), self.min_settle))
+
+        interval = self.first_poll
+        previous = None
+        stable_count = 0
+        reacted = False
+        while True:
+            locked = (not require_lock) or self.imgSrc.is_hardware_autofocus_done()
+            current = self._read()
+            if not locked or not self._stable(before, current):
+                reacted = True
+            if locked and self._stable(previous, current):
+                stable_count += 1
+            else:
+                stable_count = 0
+            previous = current
+            elapsed = time.time() - t0
+            if stable_count >= self.stable_polls and (reacted or elapsed >= unchanged_wait):
+                if reacted and elapsed > self.min_settle:
+                    # a lock we didn't see being found says nothing about settle times
+                    self._record(kind, elapsed)
+                return True
+            if time.time() - t0 > self.timeout:
+                logging.warning("Autofocus didn't settle after {} seconds.".format(self.timeout))
+                return False
+            time.sleep(interval)
+            interval = min(interval*self.backoff, self.max_poll)
@@ -0,0 +1,147 @@
+"""
+Compression.py
+
+Lossless compression of saved images, done by the save workers (see
+    SaveThread.file_save_process) through tifffile.
+
+    deflate: zlib, levels 1-9, always available
+    zstd: levels 1-22, needs a tifffile with imagecodecs
+    lzw: no levels, needs a tifffile with imagecodecs
+
+If the tifffile we have can't write the chosen codec we fall back to deflate.
+
+In adaptive mode the level drops as the save queue backs up: the configured
+    level below the queue's low watermark, the fastest level above its high
+    watermark, and proportionally lower levels in between.
+
+CompressionStats keeps per channel compression ratio and write throughput.
+
+"""
+import io
+import logging
+import threading
+
+import numpy as np
+import tifffile
+
+NONE = "none"
+DEFLATE = "deflate"
+ZSTD = "zstd"
+LZW = "lzw"
+CODECS = (NONE, DEFLATE, ZSTD, LZW)
+
+MIN_LEVEL = 1
+MAX_LEVEL = {DEFLATE: 9, ZSTD: 22}
+
+
+class Compressor(object):
+    """ Chooses tifffile compression arguments for each image.
+
+        Args:
+            codec (str): NONE, DEFLATE, ZSTD or LZW
+            level (int): compression level
+            adaptive (bool): lower the level when the save queue backs up
+    """
+    def __init__(self, codec=DEFLATE, level=6, adaptive=False):
+        if codec not in CODECS:
+            raise ValueError("Unknown compression: {}".format(codec))
+        self.codec = codec
+        self.level = self._clamp(level)
+        self.adaptive = adaptive
+        self._checked = False
+
+    def _clamp(self, level):
+        """ `level` within what our codec accepts.
+        """
+        if self.codec not in MAX_LEVEL:
+            return level
+        return max(MIN_LEVEL, min(int(level), MAX_LEVEL[self.codec]))
+
+    def _tiff_compress(self, level):
+        if self.codec == DEFLATE:
+            return level
+        if self.codec == ZSTD:
+            return ('ZSTD', level)
+        return 'LZW'
+
+    def check(self):
+        """ Falls back to deflate if tifffile can't write our codec.  Call once
+                in each save process.
+        """
+        if self._checked or self.codec in (NONE, DEFLATE):
+            return
+        self._checked = True
+        try:
+            tifffile.imsave(io.BytesIO(), np.zeros((16, 16), np.uint16),
+                            compress=self._tiff_compress(self.level))
+        except Exception:
+            logging.warning("tifffile can't write {} compression, using deflate.".format(self.codec))
+            self.codec = DEFLATE
+            self.level = self._clamp(self.level)
+
+    def level_for(self, backlog=0.0, low=0.5, high=0.8):
+        """ Compression level to use when the save queue is `backlog` full.
+
+            Args:
+                backlog (float): see SaveQueue.backlog
+                low (float): backlog below which the full level is used
+                high (float): backlog above which the fastest level is used
+        """
+        if self.codec == NONE:
+            return None
+        if not self.adaptive or backlog <= low or self.codec == LZW:
+            return self._clamp(self.level)
+        if backlog >= high:
+            return MIN_LEVEL
+        fraction = (backlog - low)/(high - low)
+        return self._clamp(round(self.level - fraction*(self.level - MIN_LEVEL)))
+
+    def tiff_args(self, level):
+        """ Keyword arguments for tifffile's imsave/TiffWriter.save.
+        """
+        if self.codec == NONE:
+            return {}
+        return {'compress': self._tiff_compress(level)}
+
+
+class CompressionStats(object):
+    """ Per channel compression ratio and write throughput.
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._channels = {}
+
+    def record(self, channel, raw_bytes, stored_bytes, write_time, level):
+        with self._lock:
+            stats = self._channels.setdefault(channel, [0, 0, 0, 0.0, 0])
+            stats[0] += 1
+            stats[1] += raw_bytes
+            stats[2] += stored_bytes
+            stats[3] += write_time
+            stats[4] += level or 0
+
+    @property
+    def stored_bytes(self):
+        """ Bytes written so far, all channels together.
+        """
+        with self._lock:
+            return sum(stats[2] for stats in self._channels.values())
+
+    @property
+    def summary(self):
+        """ {channel: {images, raw_bytes, stored_bytes, ratio, mb_per_s, mean_level}}
+
+            mb_per_s is uncompressed MB per second of writing, per save worker.
+        """
+        summary = {}
+        with self._lock:
+            for channel, (images, raw, stored, write_time, levels) in self._channels.items():
+                summary[channel] = {
+                    'images': images,
+                    'raw_bytes': raw,
+                    'stored_bytes': stored,
+                    'ratio': raw/float(stored) if stored else None,
+                    'mb_per_s': raw/1024.0**2/write_time if write_time else None,
+                    'mean_level': levels/float(images),
+                }
+        return summary
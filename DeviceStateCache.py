@@ -0,0 +1,117 @@
+"""
+DeviceStateCache.py
+
+Write-through cache of microscope device state (channel, exposure, binning,
+    flip/transpose and z) for the ImageSource classes.
+
+Every setting we send to the hardware is remembered, so setting it again to
+    the same value, or reading it back, doesn't need a round trip to the
+    device.  Anything that changes the hardware behind our back (hardware
+    triggering, autofocus, piezo resets, etc) has to invalidate the affected
+    keys.
+
+"""
+
+# cache keys
+CHANNEL = "channel"
+CHANNELS = "channels"
+EXPOSURE = "exposure"
+BINNING = "binning"
+IMAGE_FLIP = "image_flip"
+XY_FLIP = "xy_flip"
+Z = "z"
+AUTOFOCUS = "autofocus"
+
+_MISSING = object()
+
+
+class DeviceStateCache(object):
+    """ Remembers the last known value of each device setting.
+
+        Args:
+            enabled (bool): if False nothing is cached and every call goes to
+                the device
+    """
+    def __init__(self, enabled=True):
+        self.enabled = enabled
+        self._values = {}
+        self.saved = {}
+        self.invalidations = 0
+
+    def lookup(self, key):
+        """ Returns (True, value) if `key` is cached, otherwise (False, None).
+                A hit counts as a saved device round trip.
+        """
+        value = self._values.get(key, _MISSING)
+        if value is _MISSING:
+            return False, None
+        self.saved[key] = self.saved.get(key, 0) + 1
+        return True, value
+
+    def peek(self, key, default=None):
+        """ Cached value of `key` without counting it as a saved round trip.
+        """
+        return self._values.get(key, default)
+
+    def matches(self, key, value):
+        """ True if `key` is already known to be set to `value`, in which case
+                setting it again can be skipped.
+        """
+        if self._values.get(key, _MISSING) == value:
+            self.saved[key] = self.saved.get(key, 0) + 1
+            return True
+        return False
+
+    def store(self, key, value):
+        if self.enabled:
+            self._values[key] = value
+
+    def invalidate(self, *keys):
+        """ Forgets the given keys, or everything if no keys are given.
+        """
+        if not keys:
+            self._values.clear()
+        for key in keys:
+            self._values.pop(key, None)
+        self.invalidations += 1
+
+    @property
+    def stats(self):
+        """ Saved device round trips per key, plus the total.
+        """
+        stats = dict(self.saved)
+        stats['total'] = sum(self.saved.values())
+        stats['invalidations'] = self.invalidations
+        return stats
+
+    def reset_stats(self):
+        self.saved = {}
+        self.invalidations = 0
+
+
+class InvalidatingCore(object):
+    """ Wraps an MMCore for windows that change the hardware directly (eg.
+            MMPropertyBrowser, ASI_AutoFocus): every set* call forgets the
+            whole cache first, so the ImageSource never skips a call based on
+            a value the window has changed.
+
+        Args:
+            mmc: the MMCore to wrap
+            cache (DeviceStateCache): cache to invalidate
+    """
+    def __init__(self, mmc, cache):
+        self._mmc = mmc
+        self._cache = cache
+
+    def __getattr__(self, name):
+        attr = getattr(self._mmc, name)
+        if not name.startswith('set') or not callable(attr):
+            return attr
+
+        def invalidating(*args, **kwargs):
+            self._cache.invalidate()
+            try:
+                return attr(*args, **kwargs)
+            finally:
+                self._cache.invalidate()
+        return invalidating
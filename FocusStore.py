@@ -0,0 +1,179 @@
+"""
+FocusStore.py
+
+Focus scores for a whole session in one file, <outdir>/focus_scores.npy,
+    instead of a _focus.csv per frame.
+
+The save workers compute the scores (see SaveThread.file_save_process) and
+    the save pool appends them here.  The file is a numpy array of FOCUS_DTYPE
+    rows, preallocated for the expected number of frames and doubled if a
+    session outgrows it.  Rows are buffered and written in batches, rows that
+    haven't been written yet have a time of 0.
+
+    >>> scores = load_focus_scores(outdir)
+    >>> scores['focus_median'][scores['section'] == 3]
+
+A frame that is saved again (eg. a retake) gets a new row, the last row for a
+    frame wins.
+
+"""
+import os
+import time
+import logging
+
+import numpy as np
+
+FOCUS_FILE = "focus_scores.npy"
+
+FOCUS_DTYPE = np.dtype([
+    ('section', np.int32),
+    ('frame', np.int32),
+    ('z_index', np.int32),
+    ('channel', 'S64'),
+    ('prot_name', 'S64'),
+    ('x', np.float64),
+    ('y', np.float64),
+    ('z', np.float64),
+    ('focus_mean', np.float64),
+    ('focus_median', np.float64),
+    ('focus_std', np.float64),
+    ('time', np.float64),
+])
+
+
+class FocusStore(object):
+    """ The session's focus scores, appended to by the save pool.
+
+        Args:
+            outdir (str): session directory
+            capacity (int): rows to preallocate, eg. the number of frames
+            batch_size (int): rows to buffer before writing
+            flush_interval (float): longest a row waits to be written (s)
+    """
+    def __init__(self, outdir, capacity=1024, batch_size=50, flush_interval=2.0):
+        self.path = os.path.join(outdir, FOCUS_FILE)
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        recover_npy(self.path)
+        if os.path.isfile(self.path):
+            # carry on with an earlier session, eg. for retakes.  The scores
+            # go in a new file first so a failure can't lose them.
+            existing = load_focus_scores(outdir, latest=False)
+            self.count = len(existing)
+            self._array = replace_npy(self.path, existing, max(capacity, 2*self.count, 1))
+        else:
+            self.count = 0
+            self._array = np.lib.format.open_memmap(self.path, mode='w+', dtype=FOCUS_DTYPE,
+                                                    shape=(max(capacity, 1),))
+        self._rows = np.zeros(batch_size, FOCUS_DTYPE)
+        self._buffered = 0
+        self._last_flush = time.time()
+        self.flushes = 0
+
+    def append(self, row):
+        """ Buffers a row, `row` is a save pool row with focus_mean,
+                focus_median and focus_std.
+        """
+        buffered = self._rows[self._buffered]
+        for name in FOCUS_DTYPE.names:
+            if name != 'time':
+                buffered[name] = row[name]
+        buffered['time'] = row.get('time') or time.time()
+        self._buffered += 1
+        if self._buffered >= self.batch_size or time.time() - self._last_flush > self.flush_interval:
+            self.flush()
+
+    def flush(self):
+        """ Writes buffered rows.
+        """
+        self._last_flush = time.time()
+        if not self._buffered:
+            return
+        if self.count + self._buffered > len(self._array):
+            rows, size = np.array(self._array[:self.count]), len(self._array)
+            # the old mapping has to be closed before its file is replaced
+            self._array = None
+            self._array = grow_npy(self.path, rows, size, self.count + self._buffered)
+        self._array[self.count:self.count+self._buffered] = self._rows[:self._buffered]
+        self._array.flush()
+        self.count += self._buffered
+        self._buffered = 0
+        self.flushes += 1
+
+    def close(self):
+        self.flush()
+        del self._array
+
+
+def grow_npy(path, rows, size, needed):
+    """ Replaces a .npy file with one `size` doubled until it has `needed`
+            rows, starting with `rows`.  Any memory map of the old file must be
+            closed first.
+
+        Returns:
+            numpy.memmap: the new file, memory mapped
+    """
+    while size < needed:
+        size *= 2
+    logging.info("Growing {} to {} rows".format(path, size))
+    return replace_npy(path, rows, size)
+
+
+def replace_npy(path, rows, size):
+    """ Replaces a .npy file with one of `size` rows starting with `rows`,
+            written to a temporary file first so the old file is only removed
+            once the new one is complete.  Any memory map of the old file
+            must be closed first.
+
+        Returns:
+            numpy.memmap: the new file, memory mapped
+    """
+    tmp_path = path + ".tmp"
+    replacement = np.lib.format.open_memmap(tmp_path, mode='w+', dtype=rows.dtype, shape=(size,))
+    replacement[:len(rows)] = rows
+    replacement.flush()
+    del replacement
+    # os.rename won't replace a file on windows
+    os.remove(path)
+    os.rename(tmp_path, path)
+    return np.lib.format.open_memmap(path, mode='r+')
+
+
+def recover_npy(path):
+    """ Finishes a replace_npy that was interrupted between removing the old
+            file and renaming the new one.
+    """
+    tmp_path = path + ".tmp"
+    if os.path.isfile(tmp_path) and not os.path.isfile(path):
+        logging.warning("Recovering {} from {}".format(path, tmp_path))
+        os.rename(tmp_path, path)
+
+
+def load_focus_scores(outdir, latest=True):
+    """ Reads the session's focus scores in one go.
+
+        Args:
+            outdir (str): session directory
+            latest (bool): only the last row for each (section, frame,
+                z_index, channel)
+
+        Returns:
+            numpy.ndarray: FOCUS_DTYPE rows in the order they were saved
+    """
+    recover_npy(os.path.join(outdir, FOCUS_FILE))
+    scores = np.load(os.path.join(outdir, FOCUS_FILE))
+    scores = scores[scores['time'] > 0]
+    if latest:
+        scores = scores[latest_rows(scores, ['section', 'frame', 'z_index', 'channel'])]
+    return scores
+
+
+def latest_rows(rows, fields):
+    """ Positions of the last row for each combination of `fields`, in the
+            order they were saved.
+    """
+    if not len(rows):
+        return np.arange(0)
+    # np.unique gives the first occurence, so look at the rows backwards
+    _, first = np.unique(rows[fields][::-1], return_index=True)
+    return np.sort(len(rows) - 1 - first)
@@ -0,0 +1,286 @@
+"""
+FramePublisher.py
+
+Publishes saved images to live viewers without slowing down saving.
+
+The save pool (see SavePool.py) offers frames with `offer`, which only takes a
+    frame when the rate limit says one is due and the channel is wanted, each
+    channel being saved getting an equal share of the rate.  It never waits:
+    the frame goes in a one per channel mailbox that a publishing thread
+    empties, so a newer frame replaces one that hasn't been sent yet.  The
+    thread bins the frame and sends it.
+
+There are two wire formats.  ZRO is what MosaicPlanner has always published:
+    a zro Publisher sending {'image': 8 bit thumbnail} for every frame, so
+    existing subscribers keep working.  FRAMES sends the image with its
+    position and encoding on a ZMQ PUB socket, which never blocks and silently
+    drops messages for subscribers that fall behind.  Each FRAMES message has
+    three parts:
+
+    topic: channel name and a NUL, so subscribers can filter by channel
+        without "DAPI" also matching "DAPI2"
+    header: json with channel, section, frame, z_index, shape, dtype, bin,
+        encoding ('raw' or 'jpeg') and time
+    payload: the raw image bytes, or a jpeg of the image scaled to 8 bits
+
+    >>> subscriber = FrameSubscriber("tcp://scope-pc:7779", channels=['DAPI'])
+    >>> header, image = subscriber.recv()
+
+"""
+import json
+import time
+import logging
+import threading
+
+import numpy as np
+import cv2
+
+from imgprocessing import bin_image, make_thumbnail
+
+PUBLISH_PORT = 7779
+
+# ends the topic, zmq subscriptions match topic prefixes
+TOPIC_END = "\0"
+
+RAW = "raw"
+JPEG = "jpeg"
+ENCODINGS = (RAW, JPEG)
+
+# wire formats
+ZRO = "zro"
+FRAMES = "frames"
+WIRES = (ZRO, FRAMES)
+
+
+class FramePublisher(object):
+    """ Rate limited publishing of saved images.  Create it with the settings,
+            then `start` it in the process that publishes.
+
+        Args:
+            max_rate (float): most frames published per second, all channels
+                together
+            channels (Optional[list]): only publish these channels, all if
+                empty
+            encoding (str): RAW or JPEG, for FRAMES
+            bin (int): binning of the published images
+            jpeg_quality (int): 0-100
+            port (int): port to publish on
+            high_water_mark (int): messages ZMQ keeps for a slow subscriber
+                before dropping, for FRAMES
+            wire (str): ZRO or FRAMES
+    """
+    def __init__(self, max_rate=5.0, channels=None, encoding=RAW, bin=2, jpeg_quality=80,
+                 port=PUBLISH_PORT, high_water_mark=2, wire=FRAMES):
+        if encoding not in ENCODINGS:
+            raise ValueError("Unknown encoding: {}".format(encoding))
+        if wire not in WIRES:
+            raise ValueError("Unknown wire format: {}".format(wire))
+        self.wire = wire
+        self.max_rate = max_rate
+        self.channels = set(channels or [])
+        self.encoding = encoding
+        self.bin = bin
+        self.jpeg_quality = jpeg_quality
+        self.port = port
+        self.high_water_mark = high_water_mark
+        self._socket = None
+        self._thread = None
+
+        self.offered = 0
+        self.skipped = 0
+        self.stale = 0
+        self.published = 0
+        self.encode_time = 0.0
+
+    def start(self):
+        """ Binds the socket and starts the publishing thread.
+        """
+        if self.wire == ZRO:
+            from zro import Publisher
+            self._socket = Publisher(pub_port=self.port)
+        else:
+            import zmq
+            self._context = zmq.Context.instance()
+            self._socket = self._context.socket(zmq.PUB)
+            self._socket.setsockopt(zmq.SNDHWM, self.high_water_mark)
+            self._socket.setsockopt(zmq.LINGER, 0)
+            self._socket.bind("tcp://*:{}".format(self.port))
+        self._condition = threading.Condition()
+        self._mailbox = {}  # channel -> (header, image)
+        self._next_due = 0.0
+        self._offered = {}  # channel -> last offered
+        self._taken = {}  # channel -> last taken
+        self._running = True
+        self._thread = threading.Thread(target=self._run, name="frame publisher")
+        self._thread.daemon = True
+        self._thread.start()
+
+    def wants(self, channel):
+        """ True if a frame from `channel` would be published now.  Cheap, so
+                the caller can skip copying frames that wouldn't be.  Counted
+                in the offered and skipped metrics.
+        """
+        self.offered += 1
+        if self._due(channel):
+            return True
+        self.skipped += 1
+        return False
+
+    def _due(self, channel):
+        if self._thread is None or (self.channels and channel not in self.channels):
+            return False
+        now = time.time()
+        self._offered[channel] = now
+        if self.max_rate <= 0:
+            return True
+        if now < self._next_due:
+            return False
+        # each of the channels offered in the last second gets a fair share
+        active = [ch for ch, offered in self._offered.items() if now - offered < 1.0]
+        return now - self._taken.get(channel, 0) >= len(active)/float(self.max_rate)
+
+    def offer(self, image, channel, section, frame, z_index=0, bin=1):
+        """ Hands a frame to the publishing thread if one is due, never
+                blocks.  `image` must not change afterwards, pass a copy of
+                anything that will be reused.
+
+            Args:
+                bin (int): binning `image` already has
+
+            Returns:
+                bool: whether the frame was taken
+        """
+        if not self._due(channel):
+            return False
+        self._taken[channel] = time.time()
+        if self.max_rate > 0:
+            self._next_due = self._taken[channel] + 1.0/self.max_rate
+        header = {'channel': channel, 'section': int(section), 'frame': int(frame),
+                  'z_index': int(z_index), 'bin': bin, 'time': time.time()}
+        with self._condition:
+            if channel in self._mailbox:
+                self.stale += 1
+            self._mailbox[channel] = (header, image)
+            self._condition.notify()
+        return True
+
+    def _bin(self, header, image):
+        if header['bin'] < self.bin and self.bin % header['bin'] == 0:
+            image = bin_image(image, self.bin//header['bin'])
+            header['bin'] = self.bin
+        return image
+
+    def _encode(self, header, image):
+        image = self._bin(header, image)
+        if self.encoding == JPEG:
+            if image.dtype != np.uint8:
+                image = cv2.normalize(image, None, 0, 255, cv2.NORM_MINMAX, cv2.CV_8U)
+            ok, payload = cv2.imencode('.jpg', image, [cv2.IMWRITE_JPEG_QUALITY, self.jpeg_quality])
+            payload = payload.tostring()
+        else:
+            image = np.ascontiguousarray(image)
+            payload = image.tostring()
+        header.update({'shape': list(image.shape), 'dtype': image.dtype.str, 'encoding': self.encoding})
+        return payload
+
+    def _run(self):
+        while True:
+            with self._condition:
+                while self._running and not self._mailbox:
+                    self._condition.wait()
+                if not self._mailbox:
+                    return
+                # oldest first
+                channel = min(self._mailbox, key=lambda ch: self._mailbox[ch][0]['time'])
+                header, image = self._mailbox.pop(channel)
+            try:
+                t0 = time.time()
+                if self.wire == ZRO:
+                    thumb = {'image': make_thumbnail(self._bin(header, image), bin=1)}
+                    self.encode_time += time.time() - t0
+                    self._socket.publish(thumb)
+                else:
+                    payload = self._encode(header, image)
+                    self.encode_time += time.time() - t0
+                    self._socket.send_multipart([topic(channel), json.dumps(header), payload])
+                self.published += 1
+            except Exception:
+                logging.exception("Failed to publish frame")
+
+    @property
+    def metrics(self):
+        return {
+            'offered': self.offered,
+            'skipped': self.skipped,
+            'stale': self.stale,
+            'published': self.published,
+            'encode_time': self.encode_time,
+        }
+
+    def close(self):
+        """ Sends what is already in the mailbox and stops.
+        """
+        if self._thread is None:
+            return
+        with self._condition:
+            self._running = False
+            self._condition.notify()
+        self._thread.join()
+        self._thread = None
+        if self.wire == FRAMES:
+            self._socket.close()
+        self._socket = None
+        logging.info("Frame publisher finished: {}".format(self.metrics))
+
+
+class FrameSubscriber(object):
+    """ Receives frames from a FramePublisher publishing FRAMES.
+
+        Args:
+            address (str): eg. "tcp://localhost:7779"
+            channels (Optional[list]): only receive these channels, all if
+                empty
+    """
+    def __init__(self, address="tcp://localhost:{}".format(PUBLISH_PORT), channels=None):
+        import zmq
+        self._zmq = zmq
+        self._socket = zmq.Context.instance().socket(zmq.SUB)
+        self._socket.setsockopt(zmq.RCVHWM, 2)
+        self._socket.connect(address)
+        for prefix in [topic(channel) for channel in channels] if channels else [""]:
+            self._socket.setsockopt(zmq.SUBSCRIBE, prefix)
+
+    def recv(self, timeout=None):
+        """ Waits for the next frame.
+
+            Args:
+                timeout (Optional[float]): seconds to wait, forever if None
+
+            Returns:
+                Optional[tuple]: (header, image), None on timeout
+        """
+        if timeout is not None and not self._socket.poll(int(timeout*1000)):
+            return None
+        topic, header, payload = self._socket.recv_multipart()
+        return decode_frame(header, payload)
+
+    def close(self):
+        self._socket.close()
+
+
+def topic(channel):
+    return str(channel) + TOPIC_END
+
+
+def decode_frame(header, payload):
+    """ Unpacks a published frame.
+
+        Returns:
+            tuple: (header dict, image)
+    """
+    header = json.loads(header)
+    if header['encoding'] == JPEG:
+        image = cv2.imdecode(np.frombuffer(payload, np.uint8), cv2.IMREAD_UNCHANGED)
+    else:
+        image = np.frombuffer(payload, np.dtype(header['dtype'])).reshape(header['shape'])
+    return header, image
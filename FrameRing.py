@@ -0,0 +1,128 @@
+"""
+FrameRing.py
+
+Shared memory ring of frame slots between the acquisition and the save process.
+
+Sending a frame through an mp.Queue pickles it, pushes it through a pipe and
+    unpickles it on the other side, which is several copies of 8 MB for every
+    2048x2048 channel and z plane.  With a FrameRing the frame is copied once
+    into a preallocated shared memory slot and only a small RingSlot
+    descriptor goes over the queue.  The save process reads the frame straight
+    out of the slot and hands the slot back when it is done with it.
+
+    >>> ring = FrameRing(slots=8, slot_bytes=2048*2048*2)
+    >>> slot = ring.store(data)       # None if the ring is full
+    >>> ... send slot to the save process ...
+    >>> data = ring.view(slot)        # no copy
+    >>> ring.release(slot)            # data must not be used after this
+
+Frames that don't fit in a slot, or that arrive when every slot is in use, are
+    not stored and the caller has to send them the old way (see
+    SaveQueue.SaveQueue, which does this).
+
+"""
+import time
+import Queue
+import collections
+import multiprocessing as mp
+
+import numpy as np
+
+RingSlot = collections.namedtuple('RingSlot', 'index shape dtype')
+
+
+class FrameRing(object):
+    """ Fixed number of fixed size frame slots in shared memory.
+
+        Args:
+            slots (int): number of slots
+            slot_bytes (int): size of each slot
+            wait (float): how long `store` waits for a free slot before giving
+                up (s)
+    """
+    def __init__(self, slots=8, slot_bytes=2048*2048*2, wait=0.0):
+        self.slots = slots
+        self.slot_bytes = slot_bytes
+        self.wait = wait
+        self._raw = mp.RawArray('B', slots*slot_bytes)
+        self._free = mp.Queue()
+        for index in range(slots):
+            self._free.put(index)
+        self._in_use = mp.Value('i', 0)
+        self._buffer = None
+
+        # producer side
+        self.stored = 0
+        self.overflows = 0
+        self.too_big = 0
+        self.wait_time = 0.0
+
+    def __getstate__(self):
+        # the numpy view of the shared memory is rebuilt in each process
+        state = self.__dict__.copy()
+        state['_buffer'] = None
+        return state
+
+    def _slot(self, index, shape, dtype):
+        if self._buffer is None:
+            self._buffer = np.frombuffer(self._raw, dtype=np.uint8)
+        dtype = np.dtype(dtype)
+        nbytes = int(np.prod(shape))*dtype.itemsize
+        start = index*self.slot_bytes
+        return self._buffer[start:start+nbytes].view(dtype).reshape(shape)
+
+    @property
+    def in_use(self):
+        """ Number of slots holding frames that haven't been released.
+        """
+        return self._in_use.value
+
+    @property
+    def metrics(self):
+        return {
+            'slots': self.slots,
+            'slot_bytes': self.slot_bytes,
+            'stored': self.stored,
+            'overflows': self.overflows,
+            'too_big': self.too_big,
+            'wait_time': self.wait_time,
+        }
+
+    def store(self, data):
+        """ Copies `data` into a free slot.
+
+            Returns:
+                Optional[RingSlot]: descriptor for the slot, None if `data`
+                    doesn't fit or no slot came free in time
+        """
+        if data.nbytes > self.slot_bytes:
+            self.too_big += 1
+            return None
+        t0 = time.time()
+        try:
+            if self.wait:
+                index = self._free.get(timeout=self.wait)
+            else:
+                index = self._free.get_nowait()
+        except Queue.Empty:
+            self.overflows += 1
+            return None
+        finally:
+            self.wait_time += time.time() - t0
+        self._slot(index, data.shape, data.dtype)[...] = data
+        with self._in_use.get_lock():
+            self._in_use.value += 1
+        self.stored += 1
+        return RingSlot(index, data.shape, data.dtype.str)
+
+    def view(self, slot):
+        """ The frame in `slot`, without copying it.
+        """
+        return self._slot(slot.index, slot.shape, slot.dtype)
+
+    def release(self, slot):
+        """ Hands a slot back for reuse.
+        """
+        with self._in_use.get_lock():
+            self._in_use.value -= 1
+        self._free.put(slot.index)
@@ -7,7 +7,11 @@ from tifffile import imsave
 import time
 import json
 from Rectangle import Rectangle
+from TileGrid import TileGrid
+from TileCache import tile_cache
 import traceback,sys
+from collections import deque
+from multiprocessing.pool import ThreadPool
 #from imageSourceMM import imageSource
 
         
@@ -69,10 +73,8 @@ class MyImage():
         '''
 
         if self.boundBox.contains_rect(box):
-            #load image from file
-            #todo
-            img=Image.open(self.imagePath,mode='r')
-            (width,height)=img.size
+            #read through the tile cache, see TileCache.py
+            (height,width)=tile_cache.get_shape(self.imagePath)[:2]
 
             
             rel_box=self.boundBox.find_relative_bounds(box)
@@ -82,11 +84,8 @@ class MyImage():
             top=int(rel_box.top*height)
             bottom=int(rel_box.bottom*height)
              
-            c_img=img.crop([left,top,right,bottom])
-            thedata=c_img.getdata()
-
-            (cutwidth,cutheight)=c_img.size
-            cut=np.reshape(np.array(thedata,np.dtype('uint8')),(cutheight,cutwidth))
+            #only the window is read when the tile is memory mapped
+            cut=tile_cache.get_window(self.imagePath,slice(top,bottom),slice(left,right))
            
             
             return cut
@@ -104,6 +103,8 @@ class MyImage():
     def save_data(self,data):
         #img = Image.fromarray(data)
         #img.save(self.imagePath)
+        #unmap the old tile first, windows won't overwrite a mapped file
+        tile_cache.invalidate(self.imagePath)
         imsave(self.imagePath,data)
 
         
@@ -113,12 +114,8 @@ class MyImage():
         return self.boundBox.contains_point(x,y)
         
     def get_data(self):
-        img=Image.open(self.imagePath,mode='r')
-        thedata=img.getdata()
-        
-        (width,height)=img.size
-        data=np.reshape(np.array(thedata,np.dtype('uint8')),(height,width))
-        return data
+        #read only, copy it to change it
+        return tile_cache.get(self.imagePath)
     
 class ImageCollection():
     
@@ -130,6 +127,7 @@ class ImageCollection():
         self.imageSource = imageSource #a source for new data usually a microscope, could be a virtual file
         #needs to implement numpy2darray=imageSource.take_image(x,y)
         self.images = [] #list of image objects
+        self.grid = TileGrid() #the images by position, see TileGrid.py
         self.imgCount=0 #counter of number of images in collection
         self.axis=axis #matplotlib.axis to plot images
         self.bigBox = None #bounding box to include all images
@@ -137,6 +135,7 @@ class ImageCollection():
         self.minvalue=0
         self.maxvalue=512
         self.working_area = working_area
+        self.stitching = 'feather' #how cutouts spanning tiles are put together, see assemble_cutout
 
     def display8bit(self,image, display_min, display_max): 
         image = np.array(image, copy=True)
@@ -183,17 +182,16 @@ class ImageCollection():
     def get_cutout(self,box):
         #from the collection of images return the pixels contained by the Rectangle box
         #look for an image which contains the desired cutout
-        for image in self.images:
-            if image.contains_rect(box):
-                return image.get_cutout(box)
+        for image in self.grid.containing_rect(box):
+            return image.get_cutout(box)
 
-        #TODO
-        #if you don't find the cutout in one image, see if you can get it from two
+        #if you don't find the cutout in one image, put it together from the images it overlaps
+        if self.stitching != 'off':
+            cut=self.assemble_cutout(box,self.stitching)
+            if cut is not None:
+                return cut
         
-        #TODO
-        #can you assemble the cutout from all overlapping images (probably harder than its worth)
-        
-        #if you can't get it from two, go get a new image from source
+        #if they don't cover it, go get a new image from source
         if self.imageSource is not None:
             return self.get_cutout_from_source(box)
             
@@ -201,11 +199,79 @@ class ImageCollection():
     
     
     
+    def assemble_cutout(self,box,stitching='feather'):
+        """ Puts together the pixels in the Rectangle box from all the images
+                it overlaps, at the pixel size of the first of them.
+
+            args:
+                stitching (str): where images overlap, 'nearest' takes the
+                    pixel from the image whose center is nearest, 'feather'
+                    blends them weighted by distance from the image edges
+
+            returns:
+                numpy.ndarray: the cutout, None if part of box isn't in any
+                    image
+        """
+        images=self.grid.overlapping(box)
+        if not images:
+            return None
+        first=images[0].boundBox
+        (height,width)=tile_cache.get_shape(images[0].imagePath)[:2]
+        #pixels per micron
+        xscale=width/(first.right-first.left)
+        yscale=height/(first.bottom-first.top)
+        cutwidth=int(round((box.right-box.left)*xscale))
+        cutheight=int(round((box.bottom-box.top)*yscale))
+        if cutwidth<1 or cutheight<1:
+            return None
+        #centers of the cutout's pixels in microns
+        xs=box.left+(np.arange(cutwidth)+.5)/xscale
+        ys=box.top+(np.arange(cutheight)+.5)/yscale
+
+        total=np.zeros((cutheight,cutwidth))
+        weights=np.zeros((cutheight,cutwidth))
+        for image in images:
+            bb=image.boundBox
+            (h,w)=tile_cache.get_shape(image.imagePath)[:2]
+            #pixel of this image each cutout pixel falls in
+            cols=np.floor((xs-bb.left)*w/(bb.right-bb.left)).astype(int)
+            rows=np.floor((ys-bb.top)*h/(bb.bottom-bb.top)).astype(int)
+            incols=np.flatnonzero((cols>=0)&(cols<w))
+            inrows=np.flatnonzero((rows>=0)&(rows<h))
+            if not len(incols) or not len(inrows):
+                continue
+            (c0,c1)=(incols[0],incols[-1]+1)
+            (r0,r1)=(inrows[0],inrows[-1]+1)
+            window=tile_cache.get_window(image.imagePath,slice(rows[r0],rows[r1-1]+1),slice(cols[c0],cols[c1-1]+1))
+            pixels=window[np.ix_(rows[r0:r1]-rows[r0],cols[c0:c1]-cols[c0])]
+
+            if stitching=='nearest':
+                #distance from the image center, as a fraction of its size
+                xnear=np.abs(xs[c0:c1]-(bb.left+bb.right)/2)/(bb.right-bb.left)
+                ynear=np.abs(ys[r0:r1]-(bb.top+bb.bottom)/2)/(bb.bottom-bb.top)
+                closeness=1-np.maximum(ynear[:,np.newaxis],xnear[np.newaxis,:])
+                nearer=closeness>weights[r0:r1,c0:c1]
+                total[r0:r1,c0:c1][nearer]=pixels[nearer]
+                weights[r0:r1,c0:c1][nearer]=closeness[nearer]
+            else:
+                #distance from the image edges, in microns
+                xedge=np.minimum(xs[c0:c1]-bb.left,bb.right-xs[c0:c1])
+                yedge=np.minimum(ys[r0:r1]-bb.top,bb.bottom-ys[r0:r1])
+                weight=np.maximum(np.minimum(yedge[:,np.newaxis],xedge[np.newaxis,:]),1e-6)
+                total[r0:r1,c0:c1]+=weight*pixels
+                weights[r0:r1,c0:c1]+=weight
+
+        if not weights.all():
+            #part of the box isn't in any image
+            return None
+        if stitching!='nearest':
+            total=np.rint(total/weights)
+        return total.astype(np.uint8)
+
     def add_covered_point(self,x,y):
     
-        for image in self.images:
-            if image.contains_point(x,y):
-                return True
+        if self.grid.containing_point(x,y):
+            return True
         
         self.add_image_at(x,y)
         return False
@@ -284,6 +350,7 @@ class ImageCollection():
         
         #append this image to the list of images
         self.images.append(theimage)
+        self.grid.add(bbox,theimage)
         
         #update the display
         self.add_image_to_display(thedata,bbox)
@@ -323,17 +390,35 @@ class ImageCollection():
         #todo
         self.save_all_the_things()
     
+    def get_images_overlapping(self,box):
+        #images that overlap the Rectangle box, in the order they were added
+        return self.grid.overlapping(box)
+
     def print_bounding_boxes(self):
         print "printing bounding boxes"
         for image in self.images:
             image.boundBox.printRect()
             
-    def load_image_collection(self, load_callback=None):
-        """ Loads all images from disk.
+    def _load_metadata(self,metafile):
+        theimage=self.imageClass()
+        theimage.load_from_metadata(metafile)
+        return theimage
+
+    def load_image_collection(self, load_callback=None, workers=4, redraw_interval=1.0):
+        """ Loads all images from disk.  Metadata is read and images are
+                decoded on a pool of threads, and the images are displayed
+                as they arrive, a row of the map at a time from the top.
 
             args:
                 load_callback (callable): called after each image load
-                    passed the image data
+                    passed the number of images loaded before it
+                workers (int): threads reading images
+                redraw_interval (float): how often to redraw the map while
+                    loading (s), 0 to only draw at the end
+
+            returns:
+                dict: `images`, `bytes`, `seconds`, `images_per_s` and
+                    `mb_per_s`
         """
         #testimage=self.imageClass()  # DW: what is this for?
         if not os.path.isdir(self.rootpath):
@@ -343,17 +428,52 @@ class ImageCollection():
         metafiles=[os.path.join(self.rootpath,f) for f in os.listdir(self.rootpath) if f.endswith('.txt') ]
         
         print("loading metadata")
-        #loop over files reading in metadata, and initializing Image objects, reading images to update display
-        for i, metafile in enumerate(metafiles):
-            theimage=self.imageClass()
-            theimage.load_from_metadata(metafile)
-            self.images.append(theimage)
-            data=theimage.get_data()
-            self.add_image_to_display(data,theimage.boundBox)
-            if load_callback:
-                load_callback(i)
-            self.imgCount+=1
-            logging.debug("Loaded img data from {}".format(metafile))
+        start=time.time()
+        pool=ThreadPool(max(int(workers),1))
+        try:
+            images=pool.map(self._load_metadata,metafiles)
+            #rows of the map from the top, each from the left.  A row starts
+            #where an image is more than half an image below the last row.
+            images.sort(key=lambda image:image.boundBox.top)
+            rows={}
+            row=0
+            rowtop=images[0].boundBox.top if images else 0
+            for image in images:
+                if image.boundBox.top-rowtop>image.boundBox.get_height()/2:
+                    row+=1
+                    rowtop=image.boundBox.top
+                rows[image]=row
+            images.sort(key=lambda image:(rows[image],image.boundBox.left))
+
+            #loop over images in order, with a few decoded ahead of the display
+            pending=deque()
+            nbytes=0
+            lastdraw=time.time()
+            for i in range(len(images)):
+                while len(pending)<2*workers and i+len(pending)<len(images):
+                    pending.append(pool.apply_async(images[i+len(pending)].get_data))
+                data=pending.popleft().get()
+                theimage=images[i]
+                self.images.append(theimage)
+                self.grid.add(theimage.boundBox,theimage)
+                self.add_image_to_display(data,theimage.boundBox)
+                nbytes+=data.nbytes
+                if load_callback:
+                    load_callback(i)
+                self.imgCount+=1
+                if redraw_interval and time.time()-lastdraw>redraw_interval:
+                    self.axis.figure.canvas.draw_idle()
+                    lastdraw=time.time()
+                logging.debug("Loaded img data from {}".format(theimage.imagePath))
+        finally:
+            pool.close()
+            pool.join()
 
         #del(testimage)
+        seconds=time.time()-start
+        stats={'images':len(images),'bytes':nbytes,'seconds':seconds,
+               'images_per_s':len(images)/seconds if seconds else None,
+               'mb_per_s':nbytes/1024.0**2/seconds if seconds else None}
+        logging.info("Loaded map: {}".format(stats))
+        return stats
       
\ No newline at end of file
@@ -132,7 +132,8 @@ class MosaicImage():
                  imgSrc,
                  rootPath,
                  figure=None,
-                 load_callback=None):
+                 load_callback=None,
+                 load_workers=4):
         """initialization function which will plot the imagematrix passed in and set the bounds according the bounds specified by extent
         
         keywords)
@@ -146,6 +147,8 @@ class MosaicImage():
         extent) a list [minx,maxx,miny,maxy] of the corners of the image.  This will specify the scale of the image, and allow the corresponding point functionality
         to specify how much the movable point should be shifted in the units given by this extent.  If omitted the units will be in pixels and extent will default to
         [0,width,height,0].
+        load_callback) called with the number of images loaded so far as the map is loaded
+        load_workers) the number of threads reading map images
        
         """
         #define the attributes of this class
@@ -164,7 +167,7 @@ class MosaicImage():
         (x,y)=imgSrc.get_xy()
         bbox=imgSrc.calc_bbox(x,y)
         self.imgCollection.set_view_home()
-        self.imgCollection.load_image_collection(load_callback=load_callback)
+        self.imgCollection.load_image_collection(load_callback=load_callback,workers=load_workers)
         
         self.maxvalue=512
         self.currentPosLine2D=Line2D([x],[y],marker='o',markersize=7,markeredgewidth=1.5,markeredgecolor='r',zorder=100)
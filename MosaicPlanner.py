@@ -96,7 +96,24 @@ except ImportError:
     Slacker = None
     logging.warning("Couldn't import slacker. No slack messages will be posted.")
 
-from SaveThread import file_save_process
+from SavePool import SavePool
+from SaveQueue import SaveQueue
+from FrameRing import FrameRing
+from Compression import Compressor
+from SessionContainer import SessionIndex
+from FocusStore import FocusStore
+from AfcStore import AfcStore
+from ThumbnailPyramid import load_thumbnail
+from TileCache import tile_cache
+from FramePublisher import FramePublisher
+from StorageMonitor import StorageMonitor, project_session_bytes
+from AcquisitionPipeline import FramePipeline
+from PathPlanner import StageModel, plan_acquisition, sections_from_position_list
+import AcquisitionTrace as trace
+from AutofocusSettle import SettleDetector
+from TimeEstimator import AcquisitionTimeEstimator
+import AcquisitionEngine as engine
+import DeviceStateCache as dsc
 from imgprocessing import make_thumbnail
 import scipy.optimize as opt #softwarea-autofocus
 
@@ -104,6 +121,8 @@ from Tokens import STOP_TOKEN,BUBBLE_TOKEN
 DEFAULT_SETTINGS_FILE = 'MosaicPlannerSettings.default.cfg'
 SETTINGS_FILE = 'MosaicPlannerSettings.cfg'
 SETTINGS_MODEL_FILE = 'MosaicPlannerSettingsModel.cfg'
+AUTOFOCUS_HISTORY_FILE = 'autofocus_settle_history.json'
+ACQUISITION_TIME_HISTORY_FILE = 'acquisition_time_history.json'
 
 
 
@@ -422,6 +441,28 @@ class MosaicPanel(FigureCanvas):
         self._is_acquiring = False
         self._frame_count = 0
 
+        # runs acquisitions on a worker thread, see AcquisitionEngine.py
+        self.engine = None
+        self.acq_progress = None
+
+        # remaining time estimation, see TimeEstimator.py
+        self.time_estimator = None
+        self._acq_frames = []
+        self._acq_frames_done = 0
+        # (settings, estimate) between acquisitions
+        self._idle_estimate = None
+
+        # set during pipelined acquisitions, see AcquisitionPipeline.py
+        self.pipeline = None
+        # whether the camera was put in sequence mode, see _finish_acquisition
+        self._hardware_triggering = False
+        # per-frame timing trace, see AcquisitionTrace.py
+        self.trace = trace.NullTrace()
+        # set during acquisitions with adaptive autofocus, see AutofocusSettle.py
+        self.settle_detector = None
+        # free space and write throughput of the output drive, see StorageMonitor.py
+        self.storage_monitor = None
+
         # DW, we don't want to do this unless we have to.
         # self.edit_Directory_settings()
         # dictvalue = self.get_output_dir(self.directory_settings)
@@ -527,6 +568,7 @@ class MosaicPanel(FigureCanvas):
         obj = self.imgSrc.objective
         starting_pos = self.getZPosition()
         self.imgSrc.mmc.setPosition(obj, position)
+        self.imgSrc.invalidate_device_cache(dsc.Z)
 
         if wait:
             # waits for the objective to reach the target position
@@ -597,7 +639,12 @@ class MosaicPanel(FigureCanvas):
         self.imgSrc=ImageSource(config_path,
                                 MasterArduinoPort=self.cfg['MMArduino']['port'],
                                 interframe_time=self.cfg['MMArduino']['interframe_time'],
-                                filtswitch = self.cfg['MosaicPlanner']['filter_switch'])
+                                filtswitch = self.cfg['MosaicPlanner']['filter_switch'],
+                                use_device_cache = self.cfg['MosaicPlanner']['cache_device_state'])
+        if self.cfg['MosaicPlanner']['demo_mode'] and self.cfg['MosaicPlanner']['demo_simulate']:
+            from ScopeSimulator import TimingModel
+            self.imgSrc.enable_simulation(TimingModel(time_scale=self.cfg['MosaicPlanner']['demo_time_scale']))
+            logging.info("Demo image source is simulating scope timing.")
         logging.debug("Image Source loaded successfully!")
         # DO WE NEED TO FIDDLE WITH CHANNEL SETTINGS HERE LIKE THEY DO IN THE INIT?
 
@@ -611,6 +658,8 @@ class MosaicPanel(FigureCanvas):
             self.clear_position_list()
             self.mosaicImage = None
         logging.info("Loading map images @ {}".format(self.rootPath))
+        tile_cache.set_budget(self.cfg['MosaicPlanner']['tile_cache_mb']*1024**2,
+                              self.cfg['MosaicPlanner']['tile_cache_maps'])
         self.setup_map_progress_bar(rootPath)
         self.mosaicImage=MosaicImage(self.subplot,
                                      self.posone_plot,
@@ -619,7 +668,9 @@ class MosaicPanel(FigureCanvas):
                                      self.imgSrc,
                                      rootPath,
                                      figure=self.figure,
-                                     load_callback=self._map_load_callback)
+                                     load_callback=self._map_load_callback,
+                                     load_workers=self.cfg['MosaicPlanner']['map_load_workers'])
+        self.mosaicImage.imgCollection.stitching = self.cfg['MosaicPlanner']['cutout_stitching']
         self.map_progress.destroy()
         self.on_crop_tool()
         self.draw()
@@ -672,17 +723,20 @@ class MosaicPanel(FigureCanvas):
         f.close()
 
 
-    def autofocus_loop(self,hold_focus,wait,sleep):
+    def autofocus_loop(self,hold_focus,wait,sleep,expect_reaction=True):
         attempts=0
         if self.imgSrc.has_hardware_autofocus():
-            #wait till autofocus settles
-            time.sleep(wait)
-            while not self.imgSrc.is_hardware_autofocus_done():
-                time.sleep(sleep)
-                attempts+=1
-                if attempts>50:
-                    print "not auto-focusing correctly.. giving up after 10 seconds"
-                    break
+            if self.settle_detector is not None:
+                self.settle_detector.wait(expect_reaction=expect_reaction)
+            else:
+                #wait till autofocus settles
+                time.sleep(wait)
+                while not self.imgSrc.is_hardware_autofocus_done():
+                    time.sleep(sleep)
+                    attempts+=1
+                    if attempts>50:
+                        print "not auto-focusing correctly.. giving up after 10 seconds"
+                        break
 
             if not hold_focus:
                 self.imgSrc.set_hardware_autofocus_state(False) #turn off autofocus
@@ -698,14 +752,25 @@ class MosaicPanel(FigureCanvas):
             if self.imgSrc.has_hardware_autofocus():
                 self.imgSrc.set_hardware_autofocus_state(True)
         #print datetime.datetime.now().time()," starting stage move"
-        self.imgSrc.move_stage(x,y)
+        self.trace.set_frame(slice_index, frame_index)
+        if self.settle_detector is not None and not self.settle_detector.marked:
+            # a pipelined move here has been marked when it was started
+            self.settle_detector.mark()
+        with self.trace.span(trace.STAGE_MOVE):
+            if self.pipeline is not None:
+                self.pipeline.arrive(x,y)
+            else:
+                self.imgSrc.move_stage(x,y)
         if autofocus_trigger:
             self.software_autofocus(acquisition_boolean=True)
         stagexy = self.imgSrc.get_xy()
-        wx.Yield()
-        self.autofocus_loop(hold_focus,self.cfg['MosaicPlanner']['autofocus_wait'],self.cfg['MosaicPlanner']['autofocus_sleep'])
+        self._yield_ui()
+        with self.trace.span(trace.AUTOFOCUS_WAIT):
+            self.autofocus_loop(hold_focus,self.cfg['MosaicPlanner']['autofocus_wait'],self.cfg['MosaicPlanner']['autofocus_sleep'])
         if self.cfg['MosaicPlanner']['do_second_autofocus_wait']:
-            self.autofocus_loop(hold_focus,self.cfg['MosaicPlanner']['second_autofocus_wait'],self.cfg['MosaicPlanner']['autofocus_sleep'])
+            with self.trace.span(trace.AUTOFOCUS_WAIT_2):
+                self.autofocus_loop(hold_focus,self.cfg['MosaicPlanner']['second_autofocus_wait'],self.cfg['MosaicPlanner']['autofocus_sleep'],
+                                    expect_reaction=False)
 
         if (self.dmi is not None) & (self.cfg['LeicaDMI']['take_afc_image']):
             afc_image = self.dmi.get_AFC_image()
@@ -742,29 +807,27 @@ class MosaicPanel(FigureCanvas):
                     prot_name=self.channel_settings.prot_names[ch]
                     path=os.path.join(outdir, prot_name)
                     if self.channel_settings.usechannels[ch]:
-                        #ti = time.clock()*1000
-                        #print time.clock(),'start'
                         if not hold_focus:
                             z = zplane + self.channel_settings.zoffsets[ch]
                             if not z == presentZ:
-                                self.imgSrc.set_z(z)
+                                with self.trace.span(trace.SET_Z):
+                                    self.imgSrc.set_z(z)
                                 presentZ = z
-                        self.imgSrc.set_exposure(self.channel_settings.exposure_times[ch])
-                        self.imgSrc.set_channel(ch)
-                        #t2 = time.clock()*1000
-                        #print time.clock(),t2-ti, 'ms to get to snap image from start'
-
-                        data=self.imgSrc.snap_image()
-                        #t3 = time.clock()*1000
-                        #print time.clock(),t3-t2, 'ms to snap image'
+                        with self.trace.span(trace.SET_EXPOSURE):
+                            self.imgSrc.set_exposure(self.channel_settings.exposure_times[ch])
+                        with self.trace.span(trace.SET_CHANNEL):
+                            self.imgSrc.set_channel(ch)
+
+                        with self.trace.span(trace.SNAP):
+                            data=self.imgSrc.snap_image()
                         if ch == self.cfg['ChannelSettings']['focusscore_chan']:
                             calcFocus = True
                         else:
                             calcFocus = False
                         if ch is not last_channel:
-                            self.dataQueue.put((slice_index,frame_index, z_index, prot_name,path,data,ch,stagexy[0],stagexy[1],z,False,calcFocus,None))
+                            self._queue_data((slice_index,frame_index, z_index, prot_name,path,data,ch,stagexy[0],stagexy[1],z,False,calcFocus,None))
                         else:
-                            self.dataQueue.put((slice_index,frame_index, z_index, prot_name,path,data,ch,stagexy[0],stagexy[1],z,triggerflag,calcFocus,afc_image))
+                            self._queue_data((slice_index,frame_index, z_index, prot_name,path,data,ch,stagexy[0],stagexy[1],z,triggerflag,calcFocus,afc_image))
 
         def hardware_acquire(z=presentZ):
             # currZ=self.imgSrc.get_z()
@@ -773,7 +836,8 @@ class MosaicPanel(FigureCanvas):
                 z = zplane
                 if not hold_focus:
                     if not z == presentZ:
-                        self.imgSrc.set_z(z)
+                        with self.trace.span(trace.SET_Z):
+                            self.imgSrc.set_z(z)
                         presentZ = z
                 self.imgSrc.startHardwareSequence()
                 for k,ch in enumerate(self.channel_settings.channels):
@@ -781,16 +845,17 @@ class MosaicPanel(FigureCanvas):
                     prot_name=self.channel_settings.prot_names[ch]
                     path=os.path.join(outdir,prot_name)
                     if self.channel_settings.usechannels[ch]:
-                        data = self.imgSrc.get_image()
+                        with self.trace.span(trace.SNAP):
+                            data = self.imgSrc.get_image()
 
                         if ch == self.cfg['ChannelSettings']['focusscore_chan']:
                             calcFocus = True
                         else:
                             calcFocus = False
                         if ch is not last_channel:
-                            self.dataQueue.put((slice_index,frame_index, z_index, prot_name,path,data,ch,stagexy[0],stagexy[1],z,False,calcFocus,None))
+                            self._queue_data((slice_index,frame_index, z_index, prot_name,path,data,ch,stagexy[0],stagexy[1],z,False,calcFocus,None))
                         else:
-                            self.dataQueue.put((slice_index,frame_index, z_index, prot_name,path,data,ch,stagexy[0],stagexy[1],z,triggerflag,calcFocus,afc_image))
+                            self._queue_data((slice_index,frame_index, z_index, prot_name,path,data,ch,stagexy[0],stagexy[1],z,triggerflag,calcFocus,afc_image))
 
 
         if self.cfg['MosaicPlanner']['autofocus_toggle']:
@@ -810,10 +875,299 @@ class MosaicPanel(FigureCanvas):
                 self.imgSrc.set_hardware_autofocus_state(True)
         #self.imgSrc.set_hardware_autofocus_state(True)
 
+    def setup_settle_detector(self):
+        """ Creates the adaptive autofocus settle detector from the config.
+        """
+        af_cfg = self.cfg['MosaicPlanner']
+        self.settle_detector = SettleDetector(self.imgSrc,
+                                              scope_name=af_cfg['microscope_name'],
+                                              history_file=AUTOFOCUS_HISTORY_FILE,
+                                              score_tolerance=af_cfg['autofocus_score_tolerance'],
+                                              offset_tolerance=af_cfg['autofocus_offset_tolerance'],
+                                              timeout=af_cfg['autofocus_timeout'],
+                                              min_settle=af_cfg['autofocus_min_settle'],
+                                              unchanged_wait=af_cfg['autofocus_unchanged_wait'])
+
+    def wait_for_autofocus_offset(self, wait):
+        """ Waits for the autofocus offset to settle after changing it.  Uses
+                the adaptive settle detector if there is one, otherwise just
+                sleeps `wait` seconds.
+        """
+        if self.settle_detector is not None:
+            # set_autofocus_offset has already waited for the device
+            self.settle_detector.wait(kind="offset", require_lock=False, expect_reaction=False)
+        else:
+            time.sleep(wait)
+
+    def make_save_queue(self):
+        """ Save queue with the byte budget and policy from the settings.
+        """
+        cfg = self.cfg['MosaicPlanner']
+        if cfg['save_ring_slots']:
+            # uint16 frames at full sensor size, anything else falls back to the queue
+            (width, height) = self.imgSrc.get_sensor_size()
+            ring = FrameRing(slots=cfg['save_ring_slots'], slot_bytes=width*height*2)
+        else:
+            ring = None
+        return SaveQueue(budget=int(cfg['save_queue_budget']*1024**2),
+                         high_watermark=cfg['save_queue_high_watermark'],
+                         low_watermark=cfg['save_queue_low_watermark'],
+                         policy=cfg['save_queue_policy'],
+                         scratch_dir=cfg['save_queue_scratch_dir'] or None,
+                         ring=ring)
+
+    def make_session_index(self, outdir, metadata_dictionary):
+        """ Session index table for per-frame metadata, None to write a
+                _metadata.txt per image.  Containers always need one.
+        """
+        cfg = self.cfg['MosaicPlanner']
+        if cfg['output_format'] != 'container' and cfg['frame_metadata'] != 'table':
+            return None
+        return SessionIndex(outdir, metadata_dictionary,
+                            batch_size=cfg['metadata_batch_size'],
+                            flush_interval=cfg['metadata_flush_interval'],
+                            fsync=cfg['metadata_fsync'])
+
+    def make_focus_store(self, outdir):
+        """ Session focus score store, None to write a _focus.csv per image.
+        """
+        cfg = self.cfg['MosaicPlanner']
+        if cfg['focus_scores'] != 'store':
+            return None
+        return FocusStore(outdir, self.count_acquisition_images(),
+                          batch_size=cfg['metadata_batch_size'],
+                          flush_interval=cfg['metadata_flush_interval'])
+
+    def make_afc_store(self, outdir):
+        """ Session AFC profile store, None to write AFC profiles with each
+                image.
+        """
+        cfg = self.cfg['MosaicPlanner']
+        if cfg['afc_profiles'] != 'store':
+            return None
+        return AfcStore(outdir, self.count_acquisition_images(),
+                        batch_size=cfg['metadata_batch_size'],
+                        flush_interval=cfg['metadata_flush_interval'])
+
+    def make_frame_publisher(self):
+        """ Publisher for the save pool, None to not publish saved images.
+        """
+        cfg = self.cfg['MosaicPlanner']
+        if not cfg['publish_frames']:
+            return None
+        return FramePublisher(max_rate=cfg['publish_rate'], channels=cfg['publish_channels'],
+                              encoding=cfg['publish_encoding'], bin=cfg['publish_bin'],
+                              wire=cfg['publish_format'])
+
+    def check_storage(self, outdir):
+        """ Checks the output drive has the space the acquisition needs, and
+                sets up monitoring it while it runs.  Write bandwidth is
+                checked by check_write_bandwidth once the acquisition thread
+                has started.
+
+            returns:
+                bool: False if the acquisition should not be started
+        """
+        cfg = self.cfg['MosaicPlanner']
+        self.storage_monitor = None
+        if cfg['storage_check'] == 'off':
+            return True
+        if not os.path.isdir(outdir):
+            os.makedirs(outdir)
+        numchan, _ = self.summarize_channel_settings()
+        height, width = self.imgSrc.get_sensor_size()
+        images = numchan*self.count_acquisition_images()
+        projected = project_session_bytes(images, height, width, thumbnail_bins=cfg['thumbnail_bins'])
+        monitor = StorageMonitor(outdir, projected, images, space_margin=cfg['storage_space_margin'],
+                                 bandwidth_margin=cfg['storage_bandwidth_margin'], notify=self.slack_notify)
+        problems = monitor.preflight(self.get_remaining_time_estimate()['seconds'])
+        self.storage_monitor = monitor
+        return self._accept_storage_problems(problems)
+
+    def check_write_bandwidth(self):
+        """ Measures the output drive's write bandwidth, on the acquisition
+                thread as the probe takes a while.
+
+            returns:
+                bool: False if the acquisition should not go on
+        """
+        probe_mb = self.cfg['MosaicPlanner']['storage_probe_mb']
+        if self.storage_monitor is None or not probe_mb:
+            return True
+        return self._accept_storage_problems(self.storage_monitor.check_bandwidth(int(probe_mb*1024**2)))
+
+    def _accept_storage_problems(self, problems):
+        """ Warns about or refuses storage problems, as storage_check says.
+        """
+        if not problems:
+            return True
+        message = "\n".join(problems)
+        if self.cfg['MosaicPlanner']['storage_check'] == 'refuse':
+            logging.error("Not starting the acquisition: {}".format(message))
+            wx.CallAfter(wx.MessageBox, message, "Not enough storage", wx.OK | wx.ICON_ERROR)
+            return False
+        logging.warning(message)
+        self.slack_notify(message)
+        return True
+
+    def get_storage_status(self):
+        """ Free space, write throughput and remaining bytes of the current
+                (or last) acquisition, see StorageMonitor.status.
+        """
+        if self.storage_monitor is None:
+            return {}
+        return self.storage_monitor.status
+
+    def make_compressor(self):
+        """ Compression settings for the save workers, None for no compression.
+        """
+        cfg = self.cfg['MosaicPlanner']
+        if cfg['compression'] == 'none':
+            return None
+        return Compressor(cfg['compression'], cfg['compression_level'], cfg['adaptive_compression'])
+
+    def get_save_queue_metrics(self):
+        """ Depth, bytes in flight and time blocked of the current (or last)
+                acquisition's save queue.
+        """
+        if isinstance(getattr(self, 'dataQueue', None), SaveQueue):
+            return self.dataQueue.metrics
+        return {}
+
+    def get_save_progress(self):
+        """ How much of the current (or last) acquisition is on disk.
+        """
+        pool = getattr(self, 'savePool', None)
+        if pool is None:
+            return {}
+        progress = pool.ledger.summary
+        progress['queued'] = self.dataQueue.queued
+        progress['compression'] = pool.compression_stats.summary
+        return progress
+
+    def is_frame_saved(self, slice_index, frame_index, z_index, ch):
+        """ True if the image has been written by the save workers.
+        """
+        pool = getattr(self, 'savePool', None)
+        return pool is not None and pool.ledger.is_durable((slice_index, frame_index, z_index, ch))
+
+    def get_saved_thumbnail(self, slice_index, frame_index, ch, bin=8, z_index=0):
+        """ Binned copy of a saved image from its thumbnail pyramid, None if
+                it doesn't have one.
+        """
+        outdir = self.directory_settings.get_data_folder()
+        thumb = load_thumbnail(outdir, self.channel_settings.prot_names[ch], ch,
+                               slice_index, frame_index, z_index, bin)
+        return thumb[1] if thumb is not None else None
+
+    def _queue_data(self, token):
+        """ Puts a data token on the save queue.  When pipelining, the token
+                is held until the move to the next frame has been started.
+        """
+        if self.pipeline is not None:
+            self.pipeline.defer(token)
+        else:
+            with self.trace.span(trace.QUEUE_PUT):
+                self.dataQueue.put(token)
+
+    def _flush_pipeline(self):
+        """ Hands the data held by the pipeline to the save queue.
+        """
+        with self.trace.span(trace.QUEUE_PUT):
+            self.pipeline.flush(self.dataQueue)
+
+    def get_next_active_frame(self, position, frame_indices):
+        """ Gets the first activated frame out of `frame_indices` (the frames
+                still to be visited in a section), or None if there isn't one.
+        """
+        for j in frame_indices:
+            fpos = position.frameList.slicePositions[j]
+            if fpos.activated:
+                return fpos
+        return None
+
+    def get_stage_model(self):
+        """ Stage travel time model from the stage settings.
+        """
+        stage_cfg = self.cfg['Stage_Settings']
+        return StageModel(max_speed_x=stage_cfg['max_speed_x'],
+                          max_speed_y=stage_cfg['max_speed_y'],
+                          move_overhead=stage_cfg['move_overhead'])
+
+    def get_acquisition_frames(self, acq_order):
+        """ Flattens an acquisition order into the frames that will be imaged.
+
+            returns:
+                list: (x, y, software_autofocus) for every activated frame, in
+                    visiting order.
+        """
+        frames = []
+        for (i,frame_order) in acq_order:
+            pos = self.posList.slicePositions[i]
+            if not pos.activated:
+                continue
+            if pos.frameList is None:
+                frames.append((pos.x, pos.y, False))
+                continue
+            for j in frame_order:
+                fpos = pos.frameList.slicePositions[j]
+                if fpos.activated:
+                    frames.append((fpos.x, fpos.y, bool(fpos.autofocus_trigger)))
+        return frames
+
+    def make_time_estimator(self):
+        """ Creates a remaining time estimator for the current channel and
+                z-stack settings, using the timing history of this scope.
+        """
+        numchan, exposure_time = self.summarize_channel_settings()
+        if self.zstack_settings.zstack_flag:
+            zplanes = self.zstack_settings.zstack_number
+        else:
+            zplanes = 1
+        estimator = AcquisitionTimeEstimator(self.get_stage_model(),
+                                             scope_name=self.cfg['MosaicPlanner']['microscope_name'],
+                                             history_file=ACQUISITION_TIME_HISTORY_FILE)
+        estimator.start_session(numchan, zplanes, exposure_time, start_xy=self.imgSrc.get_xy())
+        return estimator
+
+    def _frame_timing_done(self, x, y, software_autofocus):
+        """ Records the time taken by the frame that just finished.
+        """
+        now = time.time()
+        self.time_estimator.frame_done(x, y, now-self._frame_mark, software_autofocus)
+        self._frame_mark = now
+        self._acq_frames_done += 1
+
+    def get_acquisition_order(self):
+        """ Gets the order to visit sections and frames in.  Uses the path
+                planner if `optimize_path` is on, otherwise the position list order.
+
+            returns:
+                list: (section_index, [frame_index, ...]) in visiting order.
+                    Sections without a frame list have no frame indices.
+        """
+        slice_positions = self.posList.slicePositions
+        if not self.cfg['MosaicPlanner']['optimize_path']:
+            order = []
+            for i,pos in enumerate(slice_positions):
+                if pos.frameList is None:
+                    order.append((i, []))
+                else:
+                    order.append((i, range(len(pos.frameList.slicePositions))))
+            return order
+
+        t0 = time.time()
+        plan = plan_acquisition(sections_from_position_list(self.posList),
+                                self.get_stage_model(),
+                                start=self.imgSrc.get_xy())
+        logging.info("Planned visiting order for {} sections in {:.2f} s".format(len(plan), time.time()-t0))
+        return [(i, frames if slice_positions[i].frameList is not None else []) for (i, frames) in plan]
+
     def ResetPiezo(self):
         do_stage_reset=self.cfg['StageResetSettings']['enableStageReset']
         if do_stage_reset:
-            self.imgSrc.reset_piezo(self.cfg['StageResetSettings'])
+            with self.trace.span(trace.PIEZO_RESET):
+                self.imgSrc.reset_piezo(self.cfg['StageResetSettings'])
 
 
     def summarize_stage_settings(self):
@@ -1137,6 +1491,7 @@ class MosaicPanel(FigureCanvas):
         # DW: basically something about the arduino is fucking up
         #   and this could let me manually unload it
         self.imgSrc.mmc.unloadDevice("LaserArduino")
+        self.imgSrc.invalidate_device_cache()
 
     def summarize_autofocus_settings(self):
         auto_sleep = self.cfg['Mosaic Planner']['autofocus_sleep']
@@ -1162,15 +1517,37 @@ class MosaicPanel(FigureCanvas):
             if currpos is not None:
                 if not currpos.activated:
                     break
+            self._yield_ui()
+
+    def _yield_ui(self):
+        """ Lets the GUI process events, if we are on the GUI thread.  The
+                acquisition thread must not touch wx.
+        """
+        if wx.Thread_IsMain():
             wx.Yield()
 
-    def setup_acquisition_progress_bar(self):
+    def count_acquisition_frames(self):
+        """ Gets frames per section and number of sections.
+        """
         hasFrameList = self.posList.slicePositions[0].frameList is not None
         numSections = len(self.posList.slicePositions)
         if hasFrameList:
             numFrames = len(self.posList.slicePositions[0].frameList.slicePositions)
         else:
             numFrames = 1
+        return numFrames,numSections
+
+    def count_acquisition_images(self):
+        """ Gets the number of frames times z planes, ie. images per channel.
+        """
+        numFrames,numSections = self.count_acquisition_frames()
+        images = numFrames*numSections
+        if self.zstack_settings.zstack_flag:
+            images *= self.zstack_settings.zstack_number
+        return images
+
+    def setup_acquisition_progress_bar(self):
+        numFrames,numSections = self.count_acquisition_frames()
         maxProgress = numSections*numFrames
 
         self.acq_progress = ProgressDialog("Acquisition Progress",
@@ -1212,10 +1589,43 @@ class MosaicPanel(FigureCanvas):
     def get_remaining_time(self):
         """ Gets time remaining in the acquisition with the current settings.
         """
-        _, exposure_time = self.summarize_channel_settings()
-        remaining_frames = self.get_remaining_frames()
-        stage_step = 200 #ms
-        return (stage_step + exposure_time) / 1000.0 * remaining_frames
+        return self.get_remaining_time_estimate()['seconds']
+
+    def get_remaining_time_estimate(self):
+        """ Gets time remaining in the acquisition with a 95% confidence
+                interval.  During an acquisition this uses the timings measured
+                so far, otherwise it uses timings from previous sessions.
+
+            returns:
+                dict: `seconds`, `low`, `high`, `confidence` and `frames`
+        """
+        if self._is_acquiring and self.time_estimator is not None:
+            return self.time_estimator.estimate(self._acq_frames[self._acq_frames_done:])
+        if not self.posList.slicePositions:
+            # nothing loaded yet
+            return {'seconds': 0.0, 'low': 0.0, 'high': 0.0, 'confidence': 0.95, 'frames': 0}
+        # planning the path and fitting is slow, only redo it when something changed
+        key = self._time_estimate_key()
+        if self._idle_estimate is None or self._idle_estimate[0] != key:
+            estimator = self.make_time_estimator()
+            self._idle_estimate = (key, estimator.estimate(self.get_acquisition_frames(self.get_acquisition_order())))
+        return dict(self._idle_estimate[1])
+
+    def _time_estimate_key(self):
+        """ Everything the remaining time estimate between acquisitions
+                depends on: the positions, channel, z-stack and path settings.
+        """
+        positions = []
+        for pos in self.posList.slicePositions:
+            frames = ()
+            if pos.frameList is not None:
+                frames = tuple((f.x, f.y, f.activated, bool(f.autofocus_trigger))
+                               for f in pos.frameList.slicePositions)
+            positions.append((pos.x, pos.y, pos.activated, frames))
+        channels = tuple((ch, self.channel_settings.usechannels[ch], self.channel_settings.exposure_times[ch])
+                         for ch in self.channel_settings.channels)
+        return (tuple(positions), channels, self.zstack_settings.zstack_flag, self.zstack_settings.zstack_number,
+                self.cfg['MosaicPlanner']['optimize_path'], self.cfg['MosaicPlanner']['microscope_name'])
 
     def get_output_dir(self,directory_settings):
         assert(isinstance(directory_settings, DirectorySettings))
@@ -1377,27 +1787,178 @@ class MosaicPanel(FigureCanvas):
         return pos
 
     def on_run_acq(self, outdir=None, event="none"):
-        """ Main acquisition loop.
+        """ Starts an acquisition on a worker thread.  Progress is shown in a
+                progress dialog, and the acquisition can be paused, resumed
+                and aborted from here or from the remote interface.
+
+            returns:
+                bool: False if an acquisition is already running, or there
+                    isn't enough storage for it
         """
+        if self.engine is not None and self.engine.is_alive():
+            logging.warning("Can't start an acquisition, one is already running.")
+            return False
         print("running")
 
+        if not outdir:
+            outdir = self.directory_settings.get_data_folder()
+
+        if not self.check_storage(outdir):
+            return False
+
+        self._is_acquiring = True
+        numFrames,numSections = self.setup_acquisition_progress_bar()
+        self.engine = engine.AcquisitionEngine(self._acquire, args=(outdir,),
+                                               max_val=numFrames*numSections)
+        self.engine.add_listener(lambda event: wx.CallAfter(self._on_acquisition_event, event))
+        self.engine.start()
+        return True
+
+    def _on_acquisition_event(self, event):
+        """ Shows acquisition progress, on the GUI thread.
+        """
+        status = event.status
+        if self.acq_progress is not None:
+            if event.kind == engine.DONE:
+                self.acq_progress.destroy()
+                self.acq_progress = None
+            else:
+                if event.kind == engine.PAUSED_EVENT:
+                    message = 'PAUSED -- ' + status['message']
+                else:
+                    message = status['message']
+                (goahead, skip) = self.acq_progress.update(min(status['value'], status['max_val']), message)
+                if not goahead and self.engine.state != engine.ABORTING:
+                    self.engine.abort()
+        if self.interface:
+            self.interface.publish({'acquisition_event': event.kind, 'acquisition_status': status,
+                                    'save_queue': self.get_save_queue_metrics(),
+                                    'storage': self.get_storage_status()})
+
+    def pause_acquisition(self):
+        if self.engine is not None:
+            self.engine.pause()
+
+    def resume_acquisition(self):
+        if self.engine is not None:
+            self.engine.resume()
+
+    def abort_acquisition(self):
+        if self.engine is not None:
+            self.engine.abort()
+
+    def get_acquisition_status(self):
+        """ Gets the state and progress of the current (or last) acquisition.
+        """
+        if self.engine is None:
+            return {'state': engine.IDLE}
+        return self.engine.status
+
+    def _acquire(self, acq_engine, outdir):
+        """ Main acquisition loop, runs on the acquisition thread.  Nothing
+                here may touch wx, see _yield_ui.
+        """
+        # set once the loop has started them, for _finish_acquisition
+        self.savePool = None
+        self._hardware_triggering = False
+        try:
+            if not self.check_write_bandwidth():
+                return
+            self._acquisition_loop(acq_engine, outdir)
+        finally:
+            try:
+                self._finish_acquisition()
+            finally:
+                self._is_acquiring = False
+                self._frame_count = 0
+        logging.info("Imaging Complete! Data saved to: {}".format(outdir))
+
+    def _finish_acquisition(self):
+        """ Stops whatever the acquisition loop started, whether it finished
+                or failed part way through.  Every step is tried even if an
+                earlier one fails, so the save workers, trace file and camera
+                are never left running.
+        """
+        for step in (self._finish_pipeline, self._finish_saving, self._finish_trace,
+                     self._finish_history, self._finish_hardware):
+            try:
+                step()
+            except Exception:
+                logging.exception("Failed to clean up after the acquisition.")
+
+    def _finish_pipeline(self):
+        if self.pipeline is None:
+            return
+        try:
+            self.pipeline.finish(self.dataQueue)
+            logging.info("Pipelined acquisition summary: {}".format(self.pipeline.summary))
+        finally:
+            self.pipeline = None
+
+    def _finish_saving(self):
+        if self.savePool is None:
+            return
+        try:
+            self.savePool.stop()
+        finally:
+            if self.storage_monitor is not None:
+                self.storage_monitor.stop()
+        if self.savePool.ledger.completed_through < self.dataQueue.queued - self.savePool.workers:
+            logging.warning("Not everything was saved: {}".format(self.savePool.ledger.summary))
+        logging.info("Save queue summary: {}".format(self.dataQueue.metrics))
+
+    def _finish_trace(self):
+        try:
+            self.trace.close()
+        finally:
+            self.trace = trace.NullTrace()
+
+    def _finish_history(self):
+        """ Saves what the acquisition learned about settle and frame times.
+        """
+        if self.settle_detector is not None:
+            detector, self.settle_detector = self.settle_detector, None
+            detector.save_history()
+            logging.info("Typical autofocus settle time: {} s".format(detector.typical_settle_time()))
+
+        logging.info("Device round trips saved by cache: {}".format(self.imgSrc.get_device_cache_stats()))
+
+        if self.time_estimator is not None:
+            estimator, self.time_estimator = self.time_estimator, None
+            estimator.save_history()
+            # the history has changed
+            self._idle_estimate = None
+        self._acq_frames = []
+
+    def _finish_hardware(self):
+        try:
+            if self._hardware_triggering:
+                self._hardware_triggering = False
+                self.imgSrc.stop_hardware_triggering()
+        finally:
+            self.imgSrc.set_binning(2)
+
+    def _acquisition_loop(self, acq_engine, outdir):
         self.imgSrc.set_binning(1)
         binning=self.imgSrc.get_binning()
         numchan, _ = self.summarize_channel_settings()
         chrom_correction = False  # can we get rid of this?
 
-        if not outdir:
-            outdir = self.directory_settings.get_data_folder()
-
         self.make_channel_directories(outdir)
 
         self.write_session_metadata(outdir)
 
         self.move_safe_to_start()
 
-        self.dataQueue = mp.Queue()
+        self.dataQueue = self.make_save_queue()
         self.messageQueue = mp.Queue()
 
+        if self.cfg['MosaicPlanner']['trace_acquisition']:
+            self.trace = trace.AcquisitionTrace(os.path.join(outdir, 'acquisition_trace.csv'))
+            save_trace_path = os.path.join(outdir, 'acquisition_trace_save.csv')
+        else:
+            save_trace_path = None
+
         metadata_dictionary = {
         'channelname'    : self.channel_settings.prot_names,
         '(height,width)' : self.imgSrc.get_sensor_size(),
@@ -1408,14 +1969,30 @@ class MosaicPanel(FigureCanvas):
         # DW: lets remove hard-coded SSH stuff
         #ssh_opts = dict(self.cfg['SSH'])
         #ssh_opts['mount_point']=self.lookup_mountpoint(outdir)
-        self.saveProcess =  mp.Process(target=file_save_process,args=(self.dataQueue, self.messageQueue, metadata_dictionary))
-        self.saveProcess.start()
-
-
-        numFrames,numSections = self.setup_acquisition_progress_bar()
+        self.savePool = SavePool(self.dataQueue, self.messageQueue, metadata_dictionary,
+                                 workers=self.cfg['MosaicPlanner']['save_workers'], trace_path=save_trace_path,
+                                 index=self.make_session_index(outdir, metadata_dictionary),
+                                 container=self.cfg['MosaicPlanner']['output_format'] == 'container',
+                                 compression=self.make_compressor(),
+                                 focus_store=self.make_focus_store(outdir),
+                                 afc_store=self.make_afc_store(outdir),
+                                 thumbnail_bins=self.cfg['MosaicPlanner']['thumbnail_bins'],
+                                 publisher=self.make_frame_publisher())
+        self.savePool.start()
+        if self.storage_monitor is not None:
+            self.storage_monitor.start(lambda: self.savePool.bytes_written,
+                                       lambda: self.savePool.images_saved)
+
+
+        numFrames,numSections = self.count_acquisition_frames()
 
         hold_focus = not (self.zstack_settings.zstack_flag or chrom_correction)
 
+        if self.cfg['MosaicPlanner']['pipelined_acquisition']:
+            self.pipeline = FramePipeline(self.imgSrc)
+
+        if self.cfg['MosaicPlanner']['adaptive_autofocus']:
+            self.setup_settle_detector()
 
         if self.cfg['MosaicPlanner']['hardware_trigger']:
             #iterates over channels/exposure times in appropriate order
@@ -1423,6 +2000,7 @@ class MosaicPanel(FigureCanvas):
             exp_times = [self.channel_settings.exposure_times[ch] for ch in self.channel_settings.channels if self.channel_settings.usechannels[ch]]
             print(channels)
             print (exp_times)
+            self._hardware_triggering = True
             success=self.imgSrc.setup_hardware_triggering(channels,exp_times)
         else:
             success = False
@@ -1436,8 +2014,13 @@ class MosaicPanel(FigureCanvas):
 
 
         #loop over positions
-        self._is_acquiring = True
-        for i,pos in enumerate(self.posList.slicePositions):
+        acq_order = self.get_acquisition_order()
+        self._acq_frames = self.get_acquisition_frames(acq_order)
+        self._acq_frames_done = 0
+        self.time_estimator = self.make_time_estimator()
+        self._frame_mark = time.time()
+        for n,(i,frame_order) in enumerate(acq_order):
+            pos = self.posList.slicePositions[i]
             if pos.activated:
                 if not goahead:
                     break
@@ -1445,7 +2028,10 @@ class MosaicPanel(FigureCanvas):
                     self.slack_notify('HELP! lost autofocus between sections',notify=True)
                     goahead=False
                     break
-                (goahead, skip) = self.acq_progress.update(i*numFrames,'section %d of %d'%(i,numSections-1))
+                acq_engine.progress(n*numFrames,'section %d of %d'%(i,numSections-1))
+                goahead = acq_engine.checkpoint()
+                if not goahead:
+                    break
                 #turn on autofocus
                 self.ResetPiezo()
                 current_z = self.imgSrc.get_z()
@@ -1453,6 +2039,9 @@ class MosaicPanel(FigureCanvas):
                     triggerflag = False
                     autofocus_trigger = False
                     self.multiDacq(success,outdir,chrom_correction,autofocus_trigger,triggerflag,pos.x,pos.y,current_z,i,hold_focus=hold_focus)
+                    if self.pipeline is not None:
+                        self._flush_pipeline()
+                    self._frame_timing_done(pos.x,pos.y,autofocus_trigger)
                 else:
 
                     triggerflag = False
@@ -1464,8 +2053,9 @@ class MosaicPanel(FigureCanvas):
                         self.move_to_xy_and_focus(initx,inity)
 
                     #move to initial position and focus function goes here
-                    for j,fpos in enumerate(pos.frameList.slicePositions):
-                        if j == (len(pos.frameList.slicePositions) - 1):
+                    for m,j in enumerate(frame_order):
+                        fpos = pos.frameList.slicePositions[j]
+                        if m == (len(frame_order) - 1):
                             triggerflag = True
 
                         if not goahead:
@@ -1490,21 +2080,24 @@ class MosaicPanel(FigureCanvas):
                             # print 'moving on'
                             pass
                         self.ResetPiezo()
-                        if i==(len(self.posList.slicePositions)-1):
-                            if j == (len(pos.frameList.slicePositions) - 1):
+                        if self.pipeline is not None and fpos.activated:
+                            # start moving before handing off the data we just took
+                            next_frame = self.get_next_active_frame(pos, frame_order[m+1:])
+                            if next_frame is not None:
+                                if self.settle_detector is not None:
+                                    self.settle_detector.mark()
+                                self.pipeline.start_move(next_frame.x, next_frame.y)
+                            self._flush_pipeline()
+                        if fpos.activated:
+                            self._frame_timing_done(fpos.x,fpos.y,fpos.autofocus_trigger)
+                        if n==(len(acq_order)-1):
+                            if m == (len(frame_order) - 1):
                                 self.slack_notify('Done Imaging!')
-                        (goahead, skip)=self.acq_progress.update((i*numFrames) + j+1,'section %d of %d, frame %d'%(i,numSections-1,j))
-                        #======================================================
-                        if self.interface and self.interface.pause == True:
-                            while self.interface.pause == True:
-                                self._check_sock(True)
-                                (goahead, skip)=self.acq_progress.update((i*numFrames) + j+1,'REMOTELY PAUSED -- section %d of %d, frame %d'%(i,numSections-1,j))
-                                #time.sleep(0.1)
-                                wx.Yield()
-                        #======================================================
+                        acq_engine.progress((n*numFrames) + m+1,'section %d of %d, frame %d'%(i,numSections-1,j))
+                        #blocks here while paused
+                        goahead = acq_engine.checkpoint()
                         self._frame_count += 1
 
-                wx.Yield()
         if not goahead:
             self.slack_notify('Imaging stopped prematurely')
             self.slack_notify('on section %d'%i)
@@ -1516,18 +2109,6 @@ class MosaicPanel(FigureCanvas):
             if pos.frameList is not None:
                 print("frame %d"%(j))
 
-        self.dataQueue.put(STOP_TOKEN)
-        self.saveProcess.join()
-
-        self.acq_progress.destroy()
-        self.imgSrc.set_binning(2)
-        if (self.cfg['MosaicPlanner']['hardware_trigger']):
-            self.imgSrc.stop_hardware_triggering()
-
-        self._is_acquiring = False
-        self._frame_count = 0
-        logging.info("Imaging Complete! Data saved to: {}".format(outdir))
-
     def edit_channels(self,event="none"):
         dlg = ChangeChannelSettings(None, -1, title = "Channel Settings", settings = self.channel_settings,style=wx.OK)
         ret=dlg.ShowModal()
@@ -1608,7 +2189,9 @@ class MosaicPanel(FigureCanvas):
 
     def launch_MManager_browser(self, event=None):
         global win
-        win = MMPropertyBrowser(self.imgSrc.mmc)
+        #the browser sets properties directly, so the device cache can't be trusted
+        self.imgSrc.invalidate_device_cache()
+        win = MMPropertyBrowser(dsc.InvalidatingCore(self.imgSrc.mmc, self.imgSrc.device_cache))
         win.show()
 
     def launch_retake(self,event=None):
@@ -1633,7 +2216,9 @@ class MosaicPanel(FigureCanvas):
 
     def launch_ASI(self, event=None):
          global win
-         win = ASI_AutoFocus(self.imgSrc.mmc)
+         #the window sets channels, exposures and CRISP directly, so the device cache can't be trusted
+         self.imgSrc.invalidate_device_cache()
+         win = ASI_AutoFocus(dsc.InvalidatingCore(self.imgSrc.mmc, self.imgSrc.device_cache))
          win.show()
 
     def repaint_image(self, evt):
@@ -1940,6 +2525,7 @@ class MosaicPanel(FigureCanvas):
                 #check if the progress bar has been cancelled and update it
                (goahead, skip) = ffprogress.Update(numsections,'section %d'%(numsections))
 
+        logging.info("Map tile cache: {}".format(tile_cache.stats))
         #call up a box and make a beep alerting the user for help
         wx.MessageBox('Fast Forward Aborted, Help me','Info')
         ffprogress.Destroy()
@@ -2107,7 +2693,7 @@ class MosaicPanel(FigureCanvas):
             self.imgSrc.set_z(zplane)
             stack[:,:,z_index]=self.imgSrc.snap_image()
             self.imgSrc.set_autofocus_offset(-1)
-            time.sleep(2*self.cfg['MosaicPlanner']['autofocus_wait'])
+            self.wait_for_autofocus_offset(2*self.cfg['MosaicPlanner']['autofocus_wait'])
             offsets.append(self.imgSrc.get_autofocus_offset())
 
         #calculate best z
@@ -2139,7 +2725,7 @@ class MosaicPanel(FigureCanvas):
         best_offset = popt[2]
         print("best_offset: ", best_offset)
         self.imgSrc.set_autofocus_offset(best_offset) #reset autofocus offset
-        time.sleep(2*self.cfg['MosaicPlanner']['autofocus_wait'])
+        self.wait_for_autofocus_offset(2*self.cfg['MosaicPlanner']['autofocus_wait'])
         self.imgSrc.set_hardware_autofocus_state(True) #turn on autofocus
         self.imgSrc.set_exposure(self.channel_settings.exposure_times[ch])
         if (acquisition_boolean) and (self.cfg['MosaicPlanner']['hardware_trigger']):
@@ -0,0 +1,314 @@
+"""
+PathPlanner.py
+
+Plans a short visiting order over the sections and frames of a position list.
+
+Sections are ordered first (nearest neighbour + 2-opt over section centers),
+    then the frames inside each section are ordered starting from wherever the
+    stage left the previous section.  Distances are stage travel times, so
+    a stage that is slower in one axis is handled correctly.
+
+The plan only changes the order things are visited in.  Section and frame
+    indices (and therefore the S/F indices in the output file names) stay the
+    same as in the position list.
+
+Doesn't depend on wx or matplotlib, so it can be run on a saved position list:
+
+    $ python PathPlanner.py pos_list_map0.json --frame-size 211.3 211.3
+
+"""
+import os
+import json
+import time
+
+import numpy as np
+
+
+class StageModel(object):
+    """ Travel time model for an XY stage whose axes move independently.
+
+        Args:
+            max_speed_x (float): max x speed (um/s)
+            max_speed_y (float): max y speed (um/s)
+            move_overhead (float): fixed cost of any move (s)
+    """
+    def __init__(self, max_speed_x=5000.0, max_speed_y=5000.0, move_overhead=0.0):
+        if max_speed_x <= 0 or max_speed_y <= 0:
+            raise ValueError("Stage speeds must be positive: {}, {}".format(max_speed_x, max_speed_y))
+        self.max_speed_x = float(max_speed_x)
+        self.max_speed_y = float(max_speed_y)
+        self.move_overhead = float(move_overhead)
+
+    def travel_time(self, p0, p1):
+        """ Time to move from p0 to p1 (s).
+        """
+        dx = abs(p1[0]-p0[0])
+        dy = abs(p1[1]-p0[1])
+        if dx == 0 and dy == 0:
+            return 0.0
+        return max(dx/self.max_speed_x, dy/self.max_speed_y) + self.move_overhead
+
+    def cost_matrix(self, points, start=None):
+        """ Pairwise travel times between `points`.  If `start` is given it is
+                prepended as node 0.
+        """
+        points = np.asarray(points, dtype=np.float64).reshape(-1, 2)
+        if start is not None:
+            points = np.vstack([np.asarray(start, dtype=np.float64).reshape(1, 2), points])
+        dx = np.abs(points[:, 0, None] - points[None, :, 0])
+        dy = np.abs(points[:, 1, None] - points[None, :, 1])
+        cost = np.maximum(dx/self.max_speed_x, dy/self.max_speed_y)
+        cost[cost > 0] += self.move_overhead
+        return cost
+
+
+def path_cost(order, cost):
+    """ Total cost of visiting `order` as an open path.
+    """
+    order = np.asarray(order)
+    if len(order) < 2:
+        return 0.0
+    return float(cost[order[:-1], order[1:]].sum())
+
+
+def nearest_neighbour(cost, start=0):
+    """ Greedy open path through all nodes of `cost` beginning at `start`.
+    """
+    n = cost.shape[0]
+    visited = np.zeros(n, dtype=bool)
+    order = [start]
+    visited[start] = True
+    for _ in range(n-1):
+        row = np.where(visited, np.inf, cost[order[-1]])
+        nxt = int(np.argmin(row))
+        order.append(nxt)
+        visited[nxt] = True
+    return order
+
+
+def two_opt(order, cost, max_passes=50):
+    """ Improves an open path by reversing segments until no reversal helps.
+            The first node is kept fixed, the last one is free.
+
+        Args:
+            order (list): initial node order
+            cost (numpy.ndarray): square cost matrix
+            max_passes (int): give up after this many passes
+
+        Returns:
+            list: improved order
+    """
+    n = len(order)
+    if n < 3:
+        return list(order)
+    # add a free "end" node so the open path can be treated as a closed one
+    ext = np.zeros((cost.shape[0]+1, cost.shape[1]+1))
+    ext[:-1, :-1] = cost
+    end = cost.shape[0]
+    route = np.array(list(order) + [end])
+
+    for _ in range(max_passes):
+        improved = False
+        for i in range(1, n-1):
+            a = route[i-1]
+            b = route[i]
+            ks = np.arange(i+1, n)
+            c = route[ks]
+            d = route[ks+1]
+            delta = ext[a, c] + ext[b, d] - ext[a, b] - ext[c, d]
+            k = int(np.argmin(delta))
+            if delta[k] < -1e-9:
+                k = ks[k]
+                route[i:k+1] = route[i:k+1][::-1]
+                improved = True
+        if not improved:
+            break
+    return [int(node) for node in route[:-1]]
+
+
+def plan_order(points, stage, start=None):
+    """ Plans an open path through `points`.
+
+        Args:
+            points (list): (x, y) positions
+            stage (StageModel): travel time model
+            start (Optional[tuple]): where the stage is now
+
+        Returns:
+            list: indices into `points` in visiting order
+    """
+    if len(points) == 0:
+        return []
+    if start is None:
+        # begin at the left-most point, like the default sort order
+        cost = stage.cost_matrix(points)
+        first = int(np.argmin(np.asarray(points)[:, 0]))
+        return two_opt(nearest_neighbour(cost, first), cost)
+    cost = stage.cost_matrix(points, start=start)
+    order = two_opt(nearest_neighbour(cost, 0), cost)
+    return [node-1 for node in order[1:]]
+
+
+def plan_acquisition(sections, stage, start=None):
+    """ Plans the visiting order for a whole acquisition.
+
+        Args:
+            sections (list): (section_index, [(frame_index, x, y), ...]) for each
+                section to acquire.  Only include activated sections/frames.
+            stage (StageModel): travel time model
+            start (Optional[tuple]): current stage position
+
+        Returns:
+            list: (section_index, [frame_index, ...]) in visiting order
+    """
+    sections = [(s, frames) for (s, frames) in sections if len(frames)]
+    if not sections:
+        return []
+    centers = [np.mean([(x, y) for (_, x, y) in frames], axis=0) for (_, frames) in sections]
+    section_order = plan_order(centers, stage, start)
+
+    plan = []
+    here = start
+    for k in section_order:
+        section_index, frames = sections[k]
+        frame_order = plan_order([(x, y) for (_, x, y) in frames], stage, here)
+        plan.append((section_index, [frames[f][0] for f in frame_order]))
+        last = frames[frame_order[-1]]
+        here = (last[1], last[2])
+    return plan
+
+
+def plan_travel_time(plan, positions, stage, start=None):
+    """ Total stage travel time for a plan.
+
+        Args:
+            plan (list): output of `plan_acquisition`
+            positions (dict): (section_index, frame_index) -> (x, y)
+            stage (StageModel): travel time model
+            start (Optional[tuple]): starting stage position
+    """
+    total = 0.0
+    here = start
+    for section_index, frame_order in plan:
+        for frame_index in frame_order:
+            pos = positions[(section_index, frame_index)]
+            if here is not None:
+                total += stage.travel_time(here, pos)
+            here = pos
+    return total
+
+
+def grid_frame_positions(x, y, mx, my, overlap, frame_width, frame_height):
+    """ Frame centers for an untilted mx by my mosaic centered on (x, y), in
+            the same serpentine order as slicePosition's frame grid.
+    """
+    alpha = overlap/100.0
+    w = frame_width*mx - (mx-1)*alpha*frame_width
+    h = frame_height*my - (my-1)*alpha*frame_height
+    left = x - w/2.0
+    top = y - h/2.0
+    positions = []
+    for row in range(my):
+        if row % 2 == 0:
+            cols = range(mx)
+        else:
+            cols = range(mx-1, -1, -1)
+        for col in cols:
+            fx = left + col*frame_width + frame_width/2.0 - col*alpha*frame_width
+            fy = top + row*frame_height + frame_height/2.0 - row*alpha*frame_height
+            positions.append((fx, fy))
+    return positions
+
+
+def sections_from_position_list(pos_list):
+    """ Builds `plan_acquisition` input from a PosList.  Positions without a
+            frame list are treated as a single frame.
+    """
+    sections = []
+    for i, pos in enumerate(pos_list.slicePositions):
+        if not pos.activated:
+            continue
+        if pos.frameList is None:
+            frames = [(0, pos.x, pos.y)]
+        else:
+            frames = [(j, fpos.x, fpos.y) for j, fpos in enumerate(pos.frameList.slicePositions)
+                      if fpos.activated]
+        sections.append((i, frames))
+    return sections
+
+
+def sections_from_json(filename, frame_width, frame_height):
+    """ Builds `plan_acquisition` input from a saved position list (.json) and
+            its frame state table, if there is one.
+    """
+    with open(filename, 'r') as f:
+        thedict = json.load(f)
+    mx = thedict["MOSAIC"]["MOSAICX"]
+    my = thedict["MOSAIC"]["MOSAICY"]
+    overlap = thedict["MOSAIC"]["OVERLAP"]
+
+    # same naming as PosList.load_frame_state_table
+    state_file = filename.split('.')[0] + 'frame_state_table.json'
+    states = {}
+    if os.path.exists(state_file):
+        with open(state_file, 'r') as f:
+            table = json.load(f)
+        for i, key in enumerate(sorted(table)):
+            states[i] = table[key]
+
+    sections = []
+    for i, pos in enumerate(thedict["POSITIONS"]):
+        frames = []
+        grid = grid_frame_positions(pos["X"], pos["Y"], mx, my, overlap, frame_width, frame_height)
+        for j, (fx, fy) in enumerate(grid):
+            if i in states and states[i] and states[i][j] == 0:
+                continue
+            frames.append((j, fx, fy))
+        sections.append((i, frames))
+    return sections
+
+
+def default_plan(sections):
+    """ The order MosaicPlanner uses without the planner.
+    """
+    return [(s, [f[0] for f in frames]) for (s, frames) in sections if len(frames)]
+
+
+def main():
+    import argparse
+    parser = argparse.ArgumentParser(description="Plan and benchmark a visiting order for a position list.")
+    parser.add_argument("position_list", help="position list (.json)")
+    parser.add_argument("--frame-size", nargs=2, type=float, default=(2048*6.5/63.0, 2048*6.5/63.0),
+                        metavar=("WIDTH", "HEIGHT"), help="frame size in microns")
+    parser.add_argument("--speed", nargs=2, type=float, default=(5000.0, 5000.0),
+                        metavar=("VX", "VY"), help="max stage speed in um/s")
+    parser.add_argument("--overhead", type=float, default=0.0, help="fixed cost per move in s")
+    parser.add_argument("--output", default="", help="write the plan to this .json file")
+    args = parser.parse_args()
+
+    stage = StageModel(args.speed[0], args.speed[1], args.overhead)
+    sections = sections_from_json(args.position_list, *args.frame_size)
+    positions = dict(((s, f), (x, y)) for (s, frames) in sections for (f, x, y) in frames)
+
+    baseline = default_plan(sections)
+    start = positions[(baseline[0][0], baseline[0][1][0])] if baseline else None
+
+    t0 = time.time()
+    plan = plan_acquisition(sections, stage, start)
+    planning_time = time.time() - t0
+
+    before = plan_travel_time(baseline, positions, stage, start)
+    after = plan_travel_time(plan, positions, stage, start)
+    print("sections: {}  frames: {}".format(len(sections), len(positions)))
+    print("default travel time: {:.2f} s".format(before))
+    print("planned travel time: {:.2f} s ({:.1f}% less)".format(
+        after, 100.0*(before-after)/before if before else 0.0))
+    print("planning took: {:.3f} s".format(planning_time))
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(plan, f)
+
+
+if __name__ == '__main__':
+    main()
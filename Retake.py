@@ -11,7 +11,10 @@ import tifffile
 from functools import partial
 import shutil
 import multiprocessing as mp
-from SaveThread import file_save_process
+from SavePool import SavePool
+from FocusStore import FOCUS_FILE, load_focus_scores
+from ThumbnailPyramid import load_thumbnail
+from SessionContainer import INDEX_FILE, load_index, read_page
 from Tokens import STOP_TOKEN
 from LeicaDMI import LeicaDMI
 
@@ -298,6 +301,9 @@ class RetakeView(QtGui.QWidget):
         self.section = 0
         self.frame = 0
         self.ch = self.mp.cfg['ChannelSettings']['focusscore_chan']
+        #session index table, if the session has one, see sessionIndex
+        self._index = None
+        self._index_stamp = None
 
         #get the outdirectory from mosaicplanner settings
         for key,value in self.mp.outdirdict.iteritems():
@@ -414,7 +420,7 @@ class RetakeView(QtGui.QWidget):
 
         self.mp.imgSrc.set_binning(1)
         numchan, chrom_correction = self.mp.summarize_channel_settings()
-        self.mp.dataQueue = mp.Queue()
+        self.mp.dataQueue = self.mp.make_save_queue()
         self.mp.messageQueue = mp.Queue()
         metadata_dictionary = {
             'channelname': self.mp.channel_settings.prot_names,
@@ -429,19 +435,22 @@ class RetakeView(QtGui.QWidget):
             exp_times = [self.mp.channel_settings.exposure_times[ch] for ch in self.mp.channel_settings.channels if self.mp.channel_settings.usechannels[ch]]
             success=self.mp.imgSrc.setup_hardware_triggering(channels,exp_times)
 
-        ssh_opts = dict(self.mp.cfg['SSH'])
-        ssh_opts['mount_point'] = self.mp.lookup_mountpoint(self.outdir)
-        self.mp.saveProcess = mp.Process(target=file_save_process,
-                                        args=(self.mp.dataQueue,
-                                              self.mp.messageQueue,
-                                              metadata_dictionary,
-                                              ssh_opts))
-        self.mp.saveProcess.start()
+        self.mp.savePool = SavePool(self.mp.dataQueue,
+                                    self.mp.messageQueue,
+                                    metadata_dictionary,
+                                    workers=self.mp.cfg['MosaicPlanner']['save_workers'],
+                                    index=self.mp.make_session_index(self.outdir, metadata_dictionary),
+                                    container=self.mp.cfg['MosaicPlanner']['output_format'] == 'container',
+                                    compression=self.mp.make_compressor(),
+                                    focus_store=self.mp.make_focus_store(self.outdir),
+                                    afc_store=self.mp.make_afc_store(self.outdir),
+                                    thumbnail_bins=self.mp.cfg['MosaicPlanner']['thumbnail_bins'],
+                                    publisher=self.mp.make_frame_publisher())
+        self.mp.savePool.start()
         return success,chrom_correction
 
     def teardownAcq(self):
-        self.mp.dataQueue.put(STOP_TOKEN)
-        self.mp.saveProcess.join()
+        self.mp.savePool.stop()
         if self.mp.cfg['MosaicPlanner']['hardware_trigger']:
             self.mp.imgSrc.stop_hardware_triggering()
 
@@ -492,19 +501,20 @@ class RetakeView(QtGui.QWidget):
                 tif_file = prot_name + "_S%04d_F%04d_Z%02d.tif" % (section, frame, 0)
                 metadata_file =  prot_name + "_S%04d_F%04d_Z%02d_metadata.txt"%(section, frame, 0)
                 focus_file = prot_name + "_S%04d_F%04d_Z%02d_focus.csv" %(section, frame, 0)
+                #sessions saved as containers (or with a metadata table) don't
+                #have some or all of these, a retake there adds a page and an
+                #index row and the old page stays in the container
+                frame_files = [f for f in (tif_file, metadata_file, focus_file)
+                               if os.path.exists(os.path.join(ch_dir, f))]
 
                 if not os.path.exists(os.path.join(out_ch_dir,tif_file)):
-                    shutil.move(os.path.join(ch_dir,tif_file),os.path.join(out_ch_dir,tif_file))
-                    shutil.move(os.path.join(ch_dir,metadata_file),os.path.join(out_ch_dir,metadata_file))
-                    if os.path.exists(os.path.join(ch_dir,focus_file)):
-                        shutil.move(os.path.join(ch_dir,focus_file),os.path.join(out_ch_dir,focus_file))
+                    for f in frame_files:
+                        shutil.move(os.path.join(ch_dir,f),os.path.join(out_ch_dir,f))
                 else:
 
                     try:
-                        os.remove(os.path.join(ch_dir, tif_file))
-                        os.remove(os.path.join(ch_dir, metadata_file))
-                        if os.path.exists(os.path.join(ch_dir,focus_file)):
-                            os.remove(os.path.join(ch_dir, focus_file))
+                        for f in frame_files:
+                            os.remove(os.path.join(ch_dir, f))
                     except:
                         print "no data to remove"
                         pass
@@ -516,21 +526,46 @@ class RetakeView(QtGui.QWidget):
     def loadFocusScoreData(self,evt=None):
         score_ch=self.mp.cfg['ChannelSettings']['focusscore_chan']
         protName = self.mp.channel_settings.prot_names[score_ch]
-        ch_dir = os.path.join(self.outdir,protName)
-        data_files = [os.path.join(ch_dir,f) for f in os.listdir(ch_dir) if f.endswith('.csv') ]
-        df = pd.DataFrame()
-        data_files.sort()
-        for data_file in data_files:
-            dft = pd.read_csv(data_file)
-            df = df.append(dft,ignore_index=True)
-        
+        if os.path.isfile(os.path.join(self.outdir, FOCUS_FILE)):
+            # the whole session in one read, see FocusStore.py
+            scores = load_focus_scores(self.outdir)
+            scores = scores[scores['prot_name'] == protName]
+            df = pd.DataFrame({
+                'score1_mean': scores['focus_mean'],
+                'score1_median': scores['focus_median'],
+                'score1_std': scores['focus_std'],
+                'ch': scores['channel'],
+                'xpos': scores['x'],
+                'ypos': scores['y'],
+                'slide_index': scores['section'],
+                'frame_index': scores['frame'],
+                'prot_name': scores['prot_name'],
+            })
+        elif self.sessionIndex() is not None:
+            # no _focus.csv files, eg. saved as containers
+            rows = [row for row in self.sessionIndex().values()
+                    if row['prot_name'] == protName and row['focus_median'] is not None]
+            df = pd.DataFrame({
+                'score1_mean': [row['focus_mean'] for row in rows],
+                'score1_median': [row['focus_median'] for row in rows],
+                'score1_std': [row['focus_std'] for row in rows],
+                'ch': [row['channel'] for row in rows],
+                'xpos': [row['x'] for row in rows],
+                'ypos': [row['y'] for row in rows],
+                'slide_index': [row['section'] for row in rows],
+                'frame_index': [row['frame'] for row in rows],
+                'prot_name': [row['prot_name'] for row in rows],
+            })
+        else:
+            ch_dir = os.path.join(self.outdir,protName)
+            data_files = [os.path.join(ch_dir,f) for f in os.listdir(ch_dir) if f.endswith('_focus.csv') ]
+            data_files.sort()
+            df = pd.concat([pd.read_csv(data_file) for data_file in data_files],ignore_index=True)
 
-        frame_medians = df.groupby('frame_index')['score1_median'].median()
-        frame_stds = df.groupby('frame_index')['score1_std'].median()
+        frame_medians = df.groupby('frame_index')['score1_median'].transform('median')
+        frame_stds = df.groupby('frame_index')['score1_std'].transform('median')
+        df['score1_norm'] = (df.score1_median - frame_medians)/frame_stds
 
-        for i,row in df.iterrows():
-            df.loc[i,'score1_norm'] = (row.score1_median - frame_medians[row.frame_index])/frame_stds[row.frame_index]
-        
         self.focus_df = df
         print self.focus_df.score1_norm
         cmap = pg.ColorMap(pos=np.linspace(start=-.04,stop=.04,num=256), color=viridis)
@@ -600,8 +635,21 @@ class RetakeView(QtGui.QWidget):
     def changeReviewData(self,evt=None):
         prot_name = self.mp.channel_settings.prot_names[self.ch]
         ch_dir = os.path.join(self.outdir,prot_name)
-        tif_filepath = os.path.join(ch_dir, prot_name + "_S%04d_F%04d_Z%02d.tif" % (self.section, self.frame, 0))
-        data = tifffile.imread(tif_filepath)
+        review_bin = self.mp.cfg['MosaicPlanner']['review_thumbnail_bin']
+        thumb = None
+        if review_bin > 1:
+            thumb = load_thumbnail(self.outdir, prot_name, self.ch, self.section, self.frame, 0, review_bin)
+        row = None
+        if thumb is None and self.sessionIndex() is not None:
+            #works for containers and per-frame tifs alike
+            row = self.sessionIndex().get((self.section, self.frame, 0, self.ch))
+        if thumb is not None:
+            data = thumb[1]
+        elif row is not None:
+            data = read_page(self.outdir, row['file'], row['page'])
+        else:
+            tif_filepath = os.path.join(ch_dir, prot_name + "_S%04d_F%04d_Z%02d.tif" % (self.section, self.frame, 0))
+            data = tifffile.imread(tif_filepath)
         self.review_data = data
 
         self.currPointScatterPlot.clear()
@@ -609,6 +657,20 @@ class RetakeView(QtGui.QWidget):
         d = {'pos': (x, y), 'symbol': 'o', 'pen': pg.mkPen('r', width=1)}
         self.currPointScatterPlot.addPoints([d])
 
+    def sessionIndex(self):
+        """ The session's index table (see SessionContainer.py), read again
+                when it has changed, or None if the session doesn't have one.
+        """
+        path = os.path.join(self.outdir, INDEX_FILE)
+        if not os.path.isfile(path):
+            return None
+        stat = os.stat(path)
+        stamp = (stat.st_mtime, stat.st_size)
+        if stamp != self._index_stamp:
+            self._index = load_index(self.outdir)
+            self._index_stamp = stamp
+        return self._index
+
     def changeChannel(self,ch):
         self.ch = ch
         if self.isLive == False:
@@ -0,0 +1,241 @@
+"""
+SavePool.py
+
+Several save processes (see SaveThread.file_save_process) taking tokens off
+    the same SaveQueue, so writing keeps up with fast cameras.
+
+Every worker reports each token it finishes to a ledger, so the acquisition
+    knows exactly which (section, frame, z, channel) images are on disk and
+    how far into the acquisition everything has been saved.  Failures still
+    go to the acquisition's message queue as (STOP_TOKEN, message), the first
+    one to fail is the first one there.
+
+    >>> pool = SavePool(dataQueue, messageQueue, metadata_dict, workers=4)
+    >>> pool.start()
+    >>> ... acquire ...
+    >>> pool.ledger.is_durable((section, frame, z, ch))
+    >>> pool.stop()                   # waits for everything to be saved
+
+Saved images are published (see FramePublisher.py) from this process, as
+    there is only one publisher port: when the publisher wants an image from
+    a channel the pool reads it back, from its thumbnail when there is a
+    suitable one, so images saved by every worker are published.
+
+With a SessionIndex the pool records every saved image in the session's
+    index table (see SessionContainer.py) instead of the workers writing a
+    _metadata.txt per image.  With `container` the workers also write per
+    channel containers instead of per-frame tifs.  Likewise with a FocusStore
+    the pool keeps the session's focus scores instead of the workers writing
+    a _focus.csv per image, and with an AfcStore it keeps the AFC profiles.
+
+"""
+import os
+import Queue
+import logging
+import threading
+import multiprocessing as mp
+
+from Tokens import STOP_TOKEN, SAVED_TOKEN
+from SaveThread import file_save_process
+from Compression import CompressionStats
+from SessionContainer import read_page
+from ThumbnailPyramid import read_thumbnail
+
+
+class SaveLedger(object):
+    """ Which save tokens have been written.
+
+        `completed_through` is the number of tokens, in the order they were
+            queued, that have all been dealt with (saved or failed).
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._durable = set()
+        self._finished = set()  # sequence numbers past completed_through
+        self.completed_through = 0
+        self.failures = []
+
+    def record(self, status, sequence, key):
+        with self._lock:
+            if status == SAVED_TOKEN:
+                self._durable.add(key)
+            else:
+                self.failures.append(key)
+            self._finished.add(sequence)
+            while self.completed_through in self._finished:
+                self._finished.remove(self.completed_through)
+                self.completed_through += 1
+
+    def is_durable(self, key):
+        """ True if the (section, frame, z, channel) image has been saved.
+        """
+        with self._lock:
+            return key in self._durable
+
+    @property
+    def durable(self):
+        with self._lock:
+            return frozenset(self._durable)
+
+    @property
+    def summary(self):
+        with self._lock:
+            return {
+                'durable': len(self._durable),
+                'failed': len(self.failures),
+                'completed_through': self.completed_through,
+            }
+
+
+class SavePool(object):
+    """ Runs `workers` save processes on one SaveQueue.
+
+        Args:
+            queue (SaveQueue.SaveQueue): tokens to save
+            message_queue (multiprocessing.Queue): gets (STOP_TOKEN, message)
+                when a save fails
+            metadata_dict (dict): see file_save_process
+            workers (int): number of save processes
+            trace_path (Optional[str]): trace file for the first worker, the
+                others add _1, _2, ... to the name
+            target (callable): the worker, called with file_save_process's
+                arguments
+            index (Optional[SessionContainer.SessionIndex]): session index
+                table to record saved images in
+            container (bool): write per channel containers, needs an index
+            compression (Optional[Compression.Compressor]): how the workers
+                compress images
+            focus_store (Optional[FocusStore.FocusStore]): where to keep focus
+                scores
+            afc_store (Optional[AfcStore.AfcStore]): where to keep AFC profiles
+            thumbnail_bins (list): binnings of the thumbnail pyramid to save with
+                every image, see ThumbnailPyramid.py
+            publisher (Optional[FramePublisher.FramePublisher]): publishes
+                saved images, started and closed by the pool
+    """
+    def __init__(self, queue, message_queue, metadata_dict, workers=1, trace_path=None,
+                 target=file_save_process, index=None, container=False, compression=None,
+                 focus_store=None, afc_store=None, thumbnail_bins=(), publisher=None):
+        if container and index is None:
+            raise ValueError("Saving containers needs a session index.")
+        self.queue = queue
+        self.message_queue = message_queue
+        self.metadata_dict = metadata_dict
+        self.workers = max(int(workers), 1)
+        self.trace_path = trace_path
+        self.target = target
+        self.index = index
+        self.container = container
+        self.compression = compression
+        self.focus_store = focus_store
+        self.afc_store = afc_store
+        self.thumbnail_bins = tuple(thumbnail_bins)
+        self.publisher = publisher
+        self.ledger = SaveLedger()
+        self.compression_stats = CompressionStats()
+        self.written_bytes = 0
+        self.images_saved = 0
+        self._ledger_queue = mp.Queue()
+        self._processes = []
+        self._collector = None
+
+    def worker_trace_path(self, index):
+        if not self.trace_path or index == 0:
+            return self.trace_path
+        root, ext = os.path.splitext(self.trace_path)
+        return "{}_{}{}".format(root, index, ext)
+
+    def start(self):
+        if self.publisher is not None:
+            try:
+                self.publisher.start()
+            except Exception:
+                logging.exception("Save pool failed to init publisher. Data will not be published.")
+                self.publisher = None
+        for index in range(self.workers):
+            p = mp.Process(target=self.target,
+                           args=(self.queue, self.message_queue, self.metadata_dict,
+                                 self.worker_trace_path(index), self._ledger_queue,
+                                 self.container, index, self.compression, self.index is None,
+                                 self.focus_store is None, self.afc_store is None, self.thumbnail_bins))
+            p.start()
+            self._processes.append(p)
+        self._collector = threading.Thread(target=self._collect, name="save ledger")
+        self._collector.daemon = True
+        self._collector.start()
+
+    def _tables(self):
+        return [table for table in (self.index, self.focus_store, self.afc_store) if table is not None]
+
+    def _collect(self):
+        tables = self._tables()
+        timeout = min(table.flush_interval for table in tables) if tables else None
+        while True:
+            try:
+                entry = self._ledger_queue.get(timeout=timeout)
+            except Queue.Empty:
+                # nothing saved for a while, don't sit on buffered rows
+                for table in tables:
+                    table.flush()
+                continue
+            if entry == STOP_TOKEN:
+                return
+            status, sequence, key, row = entry
+            if row is not None:
+                if self.index is not None:
+                    self.index.append(row)
+                if self.focus_store is not None and row.get('focus_mean') is not None:
+                    self.focus_store.append(row)
+                if self.afc_store is not None and row.get('afc_image') is not None:
+                    self.afc_store.append(row)
+                self.compression_stats.record(row['prot_name'], row['raw_bytes'], row['stored_bytes'],
+                                              row['write_time'], row.get('level'))
+                self.written_bytes += row.get('written_bytes', row['stored_bytes'])
+                self.images_saved += 1
+                if self.publisher is not None and self.publisher.wants(row['channel']):
+                    self._publish(row)
+            self.ledger.record(status, sequence, key)
+
+    def _publish(self, row):
+        """ Reads a saved image back and offers it to the publisher, from the
+                most binned thumbnail level the publisher can bin further.
+        """
+        try:
+            bins = [bin for bin in self.thumbnail_bins if self.publisher.bin % bin == 0]
+            if bins and row.get('thumb_file'):
+                bin, image = read_thumbnail(row['thumb_file'], max(bins), row['thumb_page'])
+            else:
+                path = row['file']
+                bin, image = 1, read_page(os.path.dirname(path), os.path.basename(path), row['page'])
+            self.publisher.offer(image, row['channel'], row['section'], row['frame'], row['z_index'], bin)
+        except Exception:
+            logging.exception("Failed to publish a saved image.")
+
+    def is_alive(self):
+        return any(p.is_alive() for p in self._processes)
+
+    @property
+    def bytes_written(self):
+        """ Bytes on disk so far, after compression: images, thumbnails and
+                sidecar files.
+        """
+        return self.written_bytes
+
+    def stop(self):
+        """ Waits for everything queued so far to be saved, then stops the
+                workers.
+        """
+        # the queue is first in first out, so every worker only sees a stop
+        # token once everything before it has been taken
+        for p in self._processes:
+            self.queue.put(STOP_TOKEN)
+        for p in self._processes:
+            p.join()
+        self._ledger_queue.put(STOP_TOKEN)
+        self._collector.join()
+        if self.publisher is not None:
+            self.publisher.close()
+        for table in self._tables():
+            table.close()
+        logging.info("Save pool finished: {}".format(self.ledger.summary))
+        logging.info("Compression: {}".format(self.compression_stats.summary))
@@ -0,0 +1,259 @@
+"""
+SaveQueue.py
+
+Bounded save queue between the acquisition and the save process.
+
+A plain mp.Queue takes full frames for as long as we keep snapping them, so if
+    the disk stalls (eg. a network share hiccup) memory grows until the machine
+    swaps.  SaveQueue counts the bytes of image data in flight, from `put`
+    until the save process calls `task_done`, against a byte budget.
+
+Once the bytes in flight go over the high watermark the queue applies its
+    policy until they are back under the low watermark:
+
+    block: `put` waits
+    slow: `put` sleeps, longer the closer we are to the budget
+    spill: image data is written to local scratch and only its path is queued
+
+    Whatever the policy, a put that would go over the budget waits.
+
+With a FrameRing (see FrameRing.py) image data goes through shared memory
+    instead of being pickled.  Frames in the ring don't count against the
+    budget, the ring is already allocated.  Frames that don't make it into the
+    ring go through the queue as usual.
+
+    >>> queue = SaveQueue(budget=2*1024**3, policy=SPILL, scratch_dir="D:/scratch")
+    >>> queue.put(token)           # acquisition
+    >>> token = queue.get()        # save process
+    >>> ... write it ...
+    >>> queue.task_done()
+
+"""
+import os
+import time
+import logging
+import tempfile
+import collections
+import multiprocessing as mp
+
+import numpy as np
+
+from FrameRing import RingSlot
+
+BLOCK = "block"
+SLOW = "slow"
+SPILL = "spill"
+POLICIES = (BLOCK, SLOW, SPILL)
+
+# index of the image data in a save token
+DATA_INDEX = 5
+
+# how often a blocked put checks in, and complains
+WAIT_POLL = 0.5
+WAIT_WARNING = 10.0
+
+SpilledArray = collections.namedtuple('SpilledArray', 'path nbytes')
+
+
+def token_nbytes(token):
+    """ Bytes of array data in a save token.
+    """
+    if not isinstance(token, tuple):
+        return 0
+    return sum(item.nbytes for item in token if isinstance(item, np.ndarray))
+
+
+class SaveQueue(object):
+    """ Multiprocessing queue for save tokens with a byte budget.
+
+        Args:
+            budget (int): max bytes of image data in flight
+            high_watermark (float): fraction of the budget at which the policy
+                kicks in
+            low_watermark (float): fraction of the budget at which it stops
+            policy (str): BLOCK, SLOW or SPILL
+            scratch_dir (Optional[str]): where to spill to, defaults to the
+                temp dir
+            max_delay (float): longest sleep per put for the SLOW policy (s)
+            ring (Optional[FrameRing.FrameRing]): shared memory transport for
+                image data
+    """
+    def __init__(self, budget=2*1024**3, high_watermark=0.8, low_watermark=0.5,
+                 policy=BLOCK, scratch_dir=None, max_delay=0.5, ring=None):
+        if policy not in POLICIES:
+            raise ValueError("Unknown save queue policy: {}".format(policy))
+        if not 0 < low_watermark <= high_watermark <= 1:
+            raise ValueError("Save queue watermarks must satisfy 0 < low <= high <= 1")
+        self.budget = budget
+        self.high_watermark = high_watermark
+        self.low_watermark = low_watermark
+        self.high = high_watermark*budget
+        self.low = low_watermark*budget
+        self.policy = policy
+        self.scratch_dir = scratch_dir or tempfile.gettempdir()
+        self.max_delay = max_delay
+        self.ring = ring
+
+        self._queue = mp.Queue()
+        # shared with the save process, guarded by _cond
+        self._cond = mp.Condition()
+        self._bytes = mp.Value('d', 0.0, lock=False)
+        self._depth = mp.Value('i', 0, lock=False)
+
+        # producer side
+        self._pressure = False
+        self.peak_bytes = 0
+        self.peak_depth = 0
+        self.blocked_time = 0.0
+        self.blocks = 0
+        self.slowed_time = 0.0
+        self.spilled = 0
+        self.spilled_bytes = 0
+
+        # tokens are numbered in the order they are put
+        self._next_sequence = 0
+
+        # consumer side, bytes, ring slot and sequence number of the token
+        # currently being saved
+        self._in_hand = 0
+        self._slot_in_hand = None
+        self.sequence = None
+
+    @property
+    def bytes_in_flight(self):
+        return self._bytes.value
+
+    @property
+    def backlog(self):
+        """ How full the queue is, as a fraction of the budget (or of the ring,
+                whichever is fuller).  Can be read by the save processes.
+        """
+        backlog = self._bytes.value/float(self.budget) if self.budget else 0.0
+        if self.ring is not None:
+            backlog = max(backlog, self.ring.in_use/float(self.ring.slots))
+        return backlog
+
+    @property
+    def queued(self):
+        """ Number of tokens put so far.
+        """
+        return self._next_sequence
+
+    @property
+    def depth(self):
+        return self._depth.value
+
+    @property
+    def metrics(self):
+        """ Snapshot of queue depth, bytes in flight and time spent waiting.
+        """
+        metrics = {
+            'policy': self.policy,
+            'budget': self.budget,
+            'depth': self.depth,
+            'peak_depth': self.peak_depth,
+            'bytes_in_flight': int(self.bytes_in_flight),
+            'peak_bytes': int(self.peak_bytes),
+            'blocked_time': self.blocked_time,
+            'blocks': self.blocks,
+            'slowed_time': self.slowed_time,
+            'spilled': self.spilled,
+            'spilled_bytes': self.spilled_bytes,
+        }
+        if self.ring is not None:
+            metrics['ring'] = self.ring.metrics
+        return metrics
+
+    def _wait_below(self, limit):
+        t0 = time.time()
+        warned = t0
+        self.blocks += 1
+        with self._cond:
+            while self._bytes.value > limit:
+                self._cond.wait(WAIT_POLL)
+                if time.time() - warned > WAIT_WARNING:
+                    warned = time.time()
+                    logging.warning("Save queue blocked for {:.0f} s, {:.0f} MB in flight".format(
+                        warned - t0, self._bytes.value/1024.0**2))
+        self.blocked_time += time.time() - t0
+
+    def _spill(self, token):
+        data = token[DATA_INDEX]
+        fd, path = tempfile.mkstemp(prefix="spill_", suffix=".npy", dir=self.scratch_dir)
+        with os.fdopen(fd, 'wb') as f:
+            np.save(f, data)
+        self.spilled += 1
+        self.spilled_bytes += data.nbytes
+        return token[:DATA_INDEX] + (SpilledArray(path, data.nbytes),) + token[DATA_INDEX+1:]
+
+    def put(self, token):
+        """ Queues a save token, applying the policy if we are over the high
+                watermark.
+        """
+        if self.ring is not None and isinstance(token, tuple) and isinstance(token[DATA_INDEX], np.ndarray):
+            slot = self.ring.store(token[DATA_INDEX])
+            if slot is not None:
+                token = token[:DATA_INDEX] + (slot,) + token[DATA_INDEX+1:]
+
+        nbytes = token_nbytes(token)
+        in_flight = self._bytes.value
+        if in_flight > self.high:
+            self._pressure = True
+        elif in_flight <= self.low:
+            self._pressure = False
+
+        if self._pressure and nbytes:
+            if self.policy == BLOCK:
+                self._wait_below(self.low)
+                self._pressure = False
+            elif self.policy == SLOW:
+                delay = self.max_delay*min((in_flight - self.low)/max(self.budget - self.low, 1), 1.0)
+                time.sleep(delay)
+                self.slowed_time += delay
+            elif self.policy == SPILL and isinstance(token[DATA_INDEX], np.ndarray):
+                token = self._spill(token)
+                nbytes = token_nbytes(token)
+
+        if nbytes and self._bytes.value + nbytes > self.budget:
+            self._wait_below(max(self.budget - nbytes, 0))
+
+        with self._cond:
+            self._bytes.value += nbytes
+            self._depth.value += 1
+            self.peak_bytes = max(self.peak_bytes, self._bytes.value)
+            self.peak_depth = max(self.peak_depth, self._depth.value)
+        self._queue.put((self._next_sequence, nbytes, token))
+        self._next_sequence += 1
+
+    def get(self, block=True, timeout=None):
+        """ Gets the next token, reading back spilled data.  Call `task_done`
+                once it has been saved.  Data from the ring is a view of shared
+                memory, which is reused after `task_done`, so copy anything
+                that needs to be kept.
+        """
+        self.sequence, nbytes, token = self._queue.get(block, timeout)
+        self._in_hand = nbytes
+        if isinstance(token, tuple) and isinstance(token[DATA_INDEX], RingSlot):
+            self._slot_in_hand = token[DATA_INDEX]
+            token = token[:DATA_INDEX] + (self.ring.view(self._slot_in_hand),) + token[DATA_INDEX+1:]
+        elif isinstance(token, tuple) and isinstance(token[DATA_INDEX], SpilledArray):
+            path = token[DATA_INDEX].path
+            data = np.load(path)
+            os.remove(path)
+            token = token[:DATA_INDEX] + (data,) + token[DATA_INDEX+1:]
+        return token
+
+    def task_done(self):
+        """ Releases the bytes (and ring slot) of the last token from `get`.
+        """
+        if self._slot_in_hand is not None:
+            self.ring.release(self._slot_in_hand)
+            self._slot_in_hand = None
+        with self._cond:
+            self._bytes.value -= self._in_hand
+            self._depth.value -= 1
+            self._cond.notify_all()
+        self._in_hand = 0
+
+    def empty(self):
+        return self._queue.empty()
@@ -8,86 +8,178 @@ Multiprocessing Queue to save images and potentially do some preprocessing / pub
 """
 import os
 from tifffile import imsave
-import pandas as pd
 import cv2
 import numpy as np
 import sys
 import traceback
-from Tokens import STOP_TOKEN,BUBBLE_TOKEN
+from Tokens import STOP_TOKEN,BUBBLE_TOKEN,SAVED_TOKEN,FAILED_TOKEN
+import csv
 import json
 import logging
 import time
 
-from imgprocessing import make_thumbnail, get_focus_score
+from imgprocessing import get_focus_score
+from AcquisitionTrace import AcquisitionTrace, NullTrace, DISK_WRITE
+from SessionContainer import ContainerWriter
+from Compression import NONE
+from ThumbnailPyramid import make_pyramid, save_pyramid
 
 
 
-def file_save_process(queue, message_queue, metadata_dict):
+def file_save_process(queue, message_queue, metadata_dict, trace_path=None, ledger=None,
+                      container=False, worker=0, compression=None, write_metadata=True, write_focus=True,
+                      write_afc=True, thumbnail_bins=()):
+    """ Saves tokens from `queue` (a SaveQueue.SaveQueue) until STOP_TOKEN.
+
+    args:
+        queue (SaveQueue.SaveQueue): tokens to save
+        message_queue (multiprocessing.Queue): gets (STOP_TOKEN, message) when
+            a save fails
+        metadata_dict (dict): channel names, sensor size, pixel size and
+            exposure times
+        trace_path (Optional[str]): where to write DISK_WRITE spans
+        ledger (Optional[multiprocessing.Queue]): gets (SAVED_TOKEN or
+            FAILED_TOKEN, sequence, key, index row) for every token, see
+            SavePool.py
+        container (bool): append to per channel containers instead of writing
+            a tif and sidecar files per image, see SessionContainer.py
+        worker (int): save worker number, used to name container files
+        compression (Optional[Compression.Compressor]): how to compress images
+        write_metadata (bool): write a _metadata.txt per image, turned off when
+            the save pool records metadata in the session index table
+        write_focus (bool): write a _focus.csv per focus channel image, turned
+            off when the save pool keeps focus scores in a FocusStore
+        write_afc (bool): write AFC profiles with the image, turned off when
+            the save pool keeps them in an AfcStore
+        thumbnail_bins (list): binnings of the thumbnail pyramid saved with
+            every image, empty for none, see ThumbnailPyramid.py
+    """
 
     logging.basicConfig(level=logging.DEBUG)
 
-    try:
-        from zro import Publisher
-        publisher = Publisher(pub_port=7779)
-    except Exception as e:
-        publisher = None
-        logging.warning("Save thread failed to init publisher. Data will not be published.")
+    if trace_path:
+        trace = AcquisitionTrace(trace_path)
+    else:
+        trace = NullTrace()
+
+    writer = ContainerWriter(worker) if container else None
+    if compression is not None:
+        compression.check()
 
     while True:
         token = queue.get()
         if token == STOP_TOKEN:
+            queue.task_done()
+            if writer is not None:
+                writer.close()
+            trace.close()
             return
         else:
+            key = None
             try:
-                t0_t = time.clock()
                 (slice_index,frame_index, z_index, prot_name, path, data, ch, x, y, z,triggerflag,calcfocus,afc_image) = token
-                tif_filepath = os.path.join(path, prot_name + "_S%04d_F%04d_Z%02d.tif" % (slice_index, frame_index, z_index))
-                metadata_filepath = os.path.join(path, prot_name + "_S%04d_F%04d_Z%02d_metadata.txt"%(slice_index, frame_index, z_index))
-                write_img(tif_filepath, data)
-                if publisher:
-                    t0_p = time.clock()
-                    thumb = {'image': make_thumbnail(data, bin=2)}
-                    publisher.publish(thumb)
-                    #logging.debug("Publishing took: {} seconds".format(time.clock()-t0_p))
-                write_slice_metadata(metadata_filepath, ch, x, y, z, slice_index, triggerflag, metadata_dict)
-                if calcfocus:
-                    focus_filepath = os.path.join(path, prot_name + "_S%04d_F%04d_Z%02d_focus.csv"%(slice_index, frame_index, z_index))
-                    write_focus_score(focus_filepath, data,ch,x,y,slice_index,frame_index,prot_name)
-                if afc_image is not None:
-                    afc_image_filepath = os.path.join(path, prot_name + "_S%04d_F%04d_Z%02d_afc.json"%(slice_index, frame_index, z_index))
-                    #np.savetxt(afc_image_filepath, afc_image)
-                    write_afc_image(afc_image_filepath, afc_image,x,y,slice_index,frame_index)
-                #logging.debug("Entire save operation took: {} seconds".format(time.clock()-t0_t))
+                key = (slice_index, frame_index, z_index, ch)
+                if compression is not None:
+                    level = compression.level_for(queue.backlog, queue.low_watermark, queue.high_watermark)
+                    tiff_args = compression.tiff_args(level)
+                    row = {'compression': compression.codec, 'level': level}
+                else:
+                    tiff_args = {}
+                    row = {'compression': NONE}
+                focus_score = get_focus_score(data) if calcfocus else None
+                if focus_score is not None:
+                    row['focus_mean'], row['focus_median'], row['focus_std'] = focus_score
+                if afc_image is not None and not write_afc:
+                    # the save pool stores it
+                    row['afc_image'] = afc_image
+                if writer is not None:
+                    with trace.span(DISK_WRITE, slice_index, frame_index):
+                        row.update(writer.write(path, prot_name, data, afc_image if write_afc else None,
+                                                tiff_args))
+                else:
+                    row.update(write_frame_files(token, metadata_dict, trace, tiff_args, write_metadata,
+                                                 write_focus, focus_score, write_afc))
+                pyramid = make_pyramid(data, thumbnail_bins) if thumbnail_bins else None
+                if pyramid:
+                    row.update(save_pyramid(pyramid, path, prot_name, slice_index, frame_index, z_index, writer))
+                row.update({'section': slice_index, 'frame': frame_index, 'z_index': z_index,
+                            'channel': ch, 'prot_name': prot_name, 'x': x, 'y': y, 'z': z,
+                            'triggerflag': triggerflag, 'raw_bytes': data.nbytes})
+                # everything this image put on disk, for StorageMonitor.py
+                row['written_bytes'] = row['stored_bytes'] + row.get('sidecar_bytes', 0) + row.get('thumb_bytes', 0)
+                if ledger is not None:
+                    ledger.put((SAVED_TOKEN, queue.sequence, key, row))
             except:
-                message_queue.put((STOP_TOKEN,traceback.print_exc()))
+                message = traceback.format_exc()
+                logging.error(message)
+                message_queue.put((STOP_TOKEN,message))
+                if ledger is not None:
+                    ledger.put((FAILED_TOKEN, queue.sequence, key, None))
+            finally:
+                queue.task_done()
+
+def write_frame_files(token, metadata_dict, trace=NullTrace(), tiff_args={}, write_metadata=True,
+                      write_focus=True, focus_score=None, write_afc=True):
+    """ Writes a save token as a tif plus metadata, focus score and AFC sidecar
+            files.
+
+    args:
+        focus_score (Optional[tuple]): (mean, median, std) if already
+            computed, see get_focus_score
 
-def write_img(path, img):
+    returns:
+        dict: `file`, `page`, `stored_bytes` and `write_time` of the tif,
+            and `sidecar_bytes` of the other files
+    """
+    (slice_index,frame_index, z_index, prot_name, path, data, ch, x, y, z,triggerflag,calcfocus,afc_image) = token
+    tif_filepath = os.path.join(path, prot_name + "_S%04d_F%04d_Z%02d.tif" % (slice_index, frame_index, z_index))
+    metadata_filepath = os.path.join(path, prot_name + "_S%04d_F%04d_Z%02d_metadata.txt"%(slice_index, frame_index, z_index))
+    t0 = time.time()
+    with trace.span(DISK_WRITE, slice_index, frame_index):
+        write_img(tif_filepath, data, **tiff_args)
+    write_time = time.time() - t0
+    sidecars = []
+    if write_metadata:
+        write_slice_metadata(metadata_filepath, ch, x, y, z, slice_index, triggerflag, metadata_dict)
+        sidecars.append(metadata_filepath)
+    if calcfocus and write_focus:
+        focus_filepath = os.path.join(path, prot_name + "_S%04d_F%04d_Z%02d_focus.csv"%(slice_index, frame_index, z_index))
+        write_focus_score(focus_filepath, data,ch,x,y,slice_index,frame_index,prot_name,focus_score)
+        sidecars.append(focus_filepath)
+    if afc_image is not None and write_afc:
+        afc_image_filepath = os.path.join(path, prot_name + "_S%04d_F%04d_Z%02d_afc.json"%(slice_index, frame_index, z_index))
+        #np.savetxt(afc_image_filepath, afc_image)
+        write_afc_image(afc_image_filepath, afc_image,x,y,slice_index,frame_index)
+        sidecars.append(afc_image_filepath)
+    return {'file': tif_filepath, 'page': 0, 'stored_bytes': os.path.getsize(tif_filepath), 'write_time': write_time,
+            'sidecar_bytes': sum(os.path.getsize(sidecar) for sidecar in sidecars)}
+
+def write_img(path, img, **kwargs):
     """ Writes a numpy image as a tif file.
 
     args:
         path (str): file path to save img to
         img (numpy.ndarray): img data
+        kwargs: passed on to tifffile, eg. `compress`
+    """
+    imsave(path, img, **kwargs)
+
+
+FOCUS_COLUMNS = ['score1_mean','score1_median','score1_std',
+                 'ch','xpos','ypos','slide_index','frame_index','prot_name']
+
+def write_focus_score(filename, data, ch,xpos,ypos,slide_index,frame_index,prot_name,focus_score=None):
+    """ Writes a one row focus score csv, laid out the way pandas' to_csv
+            wrote it so old readers still work.
     """
-    imsave(path, img)
-
-
-def write_focus_score(filename, data, ch,xpos,ypos,slide_index,frame_index,prot_name):
-    df = pd.DataFrame(columns = ['score1_mean','score1_median','score1_std',
-                                 'ch','xpos','ypos','slide_index','frame_index','prot_name'])
-    score1_mean,score1_median,score1_std = get_focus_score(data)
-    d = {
-            'score1_mean':score1_mean,
-            'score1_median':score1_median,
-            'score1_std':score1_std,
-            'ch':ch,
-            'xpos':xpos,
-            'ypos':ypos,
-            'slide_index':slide_index,
-            'frame_index':frame_index,
-            'prot_name':prot_name
-        }
-    df = df.append(d,ignore_index=True)
-    df.to_csv(filename)
+    if focus_score is None:
+        focus_score = get_focus_score(data)
+    score1_mean,score1_median,score1_std = focus_score
+    with open(filename, 'wb') as f:
+        writer = csv.writer(f)
+        writer.writerow([''] + FOCUS_COLUMNS)
+        writer.writerow([0, score1_mean, score1_median, score1_std,
+                         ch, xpos, ypos, slide_index, frame_index, prot_name])
 
 def write_afc_image(filename, afc_image, xpos, ypos, slice_index, frame_index):
     dict = {'afc_image': afc_image.tolist(),'xpos': xpos,'ypos': ypos, 'slice_index': slice_index, 'frame_index': frame_index}
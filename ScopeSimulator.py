@@ -0,0 +1,250 @@
+"""
+ScopeSimulator.py
+
+Timing and image models for the demo image source (imageSourceDemo.py), so
+    acquisitions can be run and benchmarked without hardware.
+
+TimingModel says how long things take on a real scope: XY moves (trapezoidal
+    velocity profile plus settling), z moves, channel switches, exposure,
+    readout and autofocus settling.
+
+RibbonSpecimen is a procedurally generated ribbon of sections.  Images are
+    rendered from stage coordinates, so overlapping frames show the same
+    structure and the correlation/stitching tools have something to work with.
+
+    >>> specimen = RibbonSpecimen(n_sections=20)
+    >>> img = specimen.render(x0, y0, pixel_size=0.1, shape=(2048, 2048), channel=1)
+
+"""
+import time
+
+import numpy as np
+
+
+class TimingModel(object):
+    """ Latencies of a simulated microscope.
+
+        Args:
+            xy_velocity (float): max stage speed (um/s)
+            xy_acceleration (float): stage acceleration (um/s^2)
+            xy_settle (float): settling time after every XY move (s)
+            z_velocity (float): focus drive speed (um/s)
+            z_settle (float): settling time after every z move (s)
+            channel_switch (float): time to change channel config (s)
+            readout (float): camera readout time (s)
+            autofocus_settle (float): mean time for the autofocus to lock after
+                a move (s)
+            autofocus_jitter (float): standard deviation of autofocus settle (s)
+            time_scale (float): multiplies every latency, eg 0.1 to run 10x
+                faster than real time
+    """
+    def __init__(self, xy_velocity=5000.0, xy_acceleration=20000.0,
+                 xy_settle=0.03, z_velocity=500.0, z_settle=0.01,
+                 channel_switch=0.05, readout=0.03, autofocus_settle=0.15,
+                 autofocus_jitter=0.05, time_scale=1.0):
+        self.xy_velocity = xy_velocity
+        self.xy_acceleration = xy_acceleration
+        self.xy_settle = xy_settle
+        self.z_velocity = z_velocity
+        self.z_settle = z_settle
+        self.channel_switch = channel_switch
+        self.readout = readout
+        self.autofocus_settle = autofocus_settle
+        self.autofocus_jitter = autofocus_jitter
+        self.time_scale = time_scale
+
+    def _axis_time(self, distance):
+        # trapezoidal profile, triangular if we never reach full speed
+        distance = abs(distance)
+        if distance == 0:
+            return 0.0
+        ramp = self.xy_velocity**2/self.xy_acceleration
+        if distance < ramp:
+            return 2.0*np.sqrt(distance/self.xy_acceleration)
+        return distance/self.xy_velocity + self.xy_velocity/self.xy_acceleration
+
+    def xy_move_time(self, dx, dy):
+        """ Time for an XY move, axes move simultaneously.
+        """
+        t = max(self._axis_time(dx), self._axis_time(dy))
+        if t == 0:
+            return 0.0
+        return self.time_scale*(t + self.xy_settle)
+
+    def z_move_time(self, dz):
+        if dz == 0:
+            return 0.0
+        return self.time_scale*(abs(dz)/self.z_velocity + self.z_settle)
+
+    def channel_switch_time(self):
+        return self.time_scale*self.channel_switch
+
+    def snap_time(self, exposure_ms):
+        return self.time_scale*(exposure_ms/1000.0 + self.readout)
+
+    def autofocus_time(self):
+        t = np.random.normal(self.autofocus_settle, self.autofocus_jitter)
+        return self.time_scale*max(t, 0.0)
+
+
+def wait_until(t):
+    """ Sleeps until time.time() reaches `t`.
+    """
+    remaining = t - time.time()
+    if remaining > 0:
+        time.sleep(remaining)
+
+
+def _hash_noise(ix, iy, seed):
+    """ Repeatable pseudo random values in [0,1) for integer lattice points.
+    """
+    h = (ix.astype(np.uint64)*np.uint64(73856093)) ^ \
+        (iy.astype(np.uint64)*np.uint64(19349663)) ^ \
+        np.uint64(seed*83492791 & 0xffffffff)
+    h = (h ^ (h >> np.uint64(13)))*np.uint64(1274126177)
+    h = h ^ (h >> np.uint64(16))
+    return (h & np.uint64(0xffffff)).astype(np.float32)/float(0x1000000)
+
+
+def _interp_matrix(coords, scale):
+    """ Smoothstep interpolation weights from lattice points to pixel coords.
+
+        Returns:
+            tuple: (weights, first lattice index)
+    """
+    u = coords/scale
+    lo = int(np.floor(u.min()))
+    n = int(np.floor(u.max())) - lo + 2
+    i = np.floor(u).astype(np.int64) - lo
+    f = u - np.floor(u)
+    f = f*f*(3 - 2*f)
+    w = np.zeros((len(coords), n), np.float32)
+    rows = np.arange(len(coords))
+    w[rows, i] = 1 - f
+    w[rows, i+1] = f
+    return w, lo
+
+
+def value_noise(xs, ys, scale, seed):
+    """ Smooth 2d noise sampled on the grid xs (columns) by ys (rows), both in
+            um.  Bilinear interpolation is separable, so this is two small
+            matrix products instead of per pixel work.
+    """
+    wx, lox = _interp_matrix(xs, scale)
+    wy, loy = _interp_matrix(ys, scale)
+    iy, ix = np.mgrid[loy:loy+wy.shape[1], lox:lox+wx.shape[1]]
+    lattice = _hash_noise(ix, iy, seed)
+    return np.dot(np.dot(wy, lattice), wx.T).astype(np.float32)
+
+
+class RibbonSpecimen(object):
+    """ A ribbon of serial sections with procedural texture.
+
+        Args:
+            n_sections (int): number of sections in the ribbon
+            section_size (tuple): (width, height) of each section (um)
+            gap (float): space between sections (um)
+            origin (tuple): stage position of the center of the first section
+            angle (float): ribbon angle (degrees)
+            focal_plane (tuple): (ax, ay, b), specimen z = ax*x + ay*y + b
+            depth_of_field (float): defocus at which contrast halves (um)
+            seed (int): seed for section layout and texture
+    """
+    def __init__(self, n_sections=20, section_size=(700.0, 400.0), gap=30.0,
+                 origin=(0.0, 0.0), angle=2.0, focal_plane=(0.0, 0.0, 0.0),
+                 depth_of_field=2.0, seed=0):
+        self.section_size = section_size
+        self.focal_plane = focal_plane
+        self.depth_of_field = depth_of_field
+        self.seed = seed
+        self._noise_pool = None
+        rng = np.random.RandomState(seed)
+        theta = np.radians(angle)
+        pitch = section_size[0] + gap
+        self.sections = []
+        for k in range(n_sections):
+            # sections wander a bit and aren't all quite the same size
+            cx = origin[0] + k*pitch*np.cos(theta) + rng.normal(0, gap/4)
+            cy = origin[1] + k*pitch*np.sin(theta) + rng.normal(0, gap/4)
+            w = section_size[0]*rng.uniform(0.95, 1.05)
+            h = section_size[1]*rng.uniform(0.95, 1.05)
+            rot = theta + np.radians(rng.normal(0, 1.0))
+            self.sections.append((cx, cy, w, h, rot))
+
+    def section_centers(self):
+        return [(s[0], s[1]) for s in self.sections]
+
+    def focal_z(self, x, y):
+        ax, ay, b = self.focal_plane
+        return ax*x + ay*y + b
+
+    def _mask(self, xs, ys, edge=2.0, step=4):
+        # section edges are soft, so the mask is computed on a coarser grid
+        full_shape = (len(ys), len(xs))
+        xs = xs[::step]
+        ys = ys[::step]
+        mask = np.zeros((len(ys), len(xs)), np.float32)
+        reach = 0.5*np.hypot(self.section_size[0], self.section_size[1])*1.1
+        for cx, cy, w, h, rot in self.sections:
+            if (cx + reach < xs[0] or cx - reach > xs[-1] or
+                    cy + reach < ys[0] or cy - reach > ys[-1]):
+                continue
+            dx = (xs - cx)[np.newaxis, :]
+            dy = (ys - cy)[:, np.newaxis]
+            u = dx*np.cos(rot) + dy*np.sin(rot)
+            v = -dx*np.sin(rot) + dy*np.cos(rot)
+            inside = np.minimum((0.5*w - np.abs(u))/edge, (0.5*h - np.abs(v))/edge)
+            np.maximum(mask, np.clip(inside, 0, 1), out=mask)
+        mask = np.repeat(np.repeat(mask, step, axis=0), step, axis=1)
+        return mask[:full_shape[0], :full_shape[1]]
+
+    def render(self, x0, y0, pixel_size, shape, channel=0, z=None,
+               exposure=100.0, noise=True):
+        """ Renders the specimen as a camera would see it.
+
+            Args:
+                x0 (float): stage x of the left edge of the image (um)
+                y0 (float): stage y of the top edge of the image (um)
+                pixel_size (float): um per pixel
+                shape (tuple): (rows, cols)
+                channel (int): channel index, each channel has its own structure
+                z (Optional[float]): focus position, None means in focus
+                exposure (float): exposure time (ms), scales the signal
+
+            Returns:
+                numpy.ndarray: uint16 image, rows are y and columns are x
+        """
+        rows, cols = shape
+        xs = x0 + pixel_size*np.arange(cols, dtype=np.float64)
+        ys = y0 + pixel_size*np.arange(rows, dtype=np.float64)
+        seed = self.seed*101 + channel*7919
+
+        # a coarse tissue texture with finer structure on top
+        texture = 0.6*value_noise(xs, ys, 40.0, seed)
+        texture += 0.4*value_noise(xs, ys, 4.0, seed+1)
+        if channel > 0:
+            # fluorescent channels look punctate
+            puncta = value_noise(xs, ys, 1.5, seed+2)
+            texture += 2.0*np.clip(puncta - 0.75, 0, None)
+
+        contrast = 1.0
+        if z is not None:
+            defocus = z - self.focal_z(xs.mean(), ys.mean())
+            contrast = 1.0/(1.0 + (defocus/self.depth_of_field)**2)
+
+        texture *= contrast
+        texture += 0.3
+        texture *= self._mask(xs, ys)
+        texture *= 20000.0*(exposure/100.0)
+        texture += 500.0
+        if noise:
+            texture += self._camera_noise(texture.size).reshape(texture.shape)
+        return np.clip(texture, 0, 65535).astype(np.uint16)
+
+    def _camera_noise(self, size):
+        # drawing fresh gaussian noise costs more than the rest of the render,
+        # so take a random window out of a pool that is drawn once
+        if self._noise_pool is None or len(self._noise_pool) < 2*size:
+            self._noise_pool = np.random.normal(0, 50.0, 2*size).astype(np.float32)
+        start = np.random.randint(0, len(self._noise_pool) - size)
+        return self._noise_pool[start:start+size]
@@ -0,0 +1,231 @@
+"""
+SessionContainer.py
+
+Optional output format that keeps a session in a handful of files instead of
+    a tif plus up to three sidecar files for every image.
+
+Each save worker appends the images of each channel to its own BigTIFF,
+    <outdir>/<channel>/<prot_name>_part<worker>.tif, one page per image, and
+    AFC profiles to <prot_name>_afc_part<worker>.tif next to it.  What used to
+    go in the sidecar files (stage position, focus score, etc) goes in a
+    single index table, <outdir>/session_index.csv, with a row per image
+    saying which file and page it is in.  Session wide metadata (channel
+    names, sensor and pixel size, exposure times) is in
+    <outdir>/session_container.json.
+
+Thumbnail pyramids (see ThumbnailPyramid.py) go in
+    <prot_name>_thumbs_part<worker>.tif, the index row says which page their
+    first level is on.
+
+An image that is saved again (eg. a retake) gets a new page and a new row, the
+    last row for an image wins.
+
+The index table can also be kept for sessions saved as per-frame tifs, instead
+    of writing a _metadata.txt for every image.  Rows then point at page 0 of
+    the image's own tif.
+
+    >>> index = load_index(outdir)
+    >>> row = index[(section, frame, z_index, ch)]
+    >>> img = read_page(outdir, row['file'], row['page'])
+
+Use export_container.py to convert a session to the per-frame layout, or just
+    to regenerate the _metadata.txt files.
+
+"""
+import os
+import csv
+import json
+import time
+import collections
+
+import numpy as np
+import tifffile
+
+INDEX_FILE = "session_index.csv"
+METADATA_FILE = "session_container.json"
+
+INDEX_COLUMNS = ('section', 'frame', 'z_index', 'channel', 'prot_name', 'file', 'page',
+                 'x', 'y', 'z', 'triggerflag', 'focus_mean', 'focus_median', 'focus_std',
+                 'afc_file', 'afc_page', 'compression', 'level', 'stored_bytes', 'thumb_file', 'thumb_page',
+                 'time')
+
+FSYNC_BATCH = "batch"
+FSYNC_CLOSE = "close"
+FSYNC_NEVER = "never"
+FSYNC_POLICIES = (FSYNC_BATCH, FSYNC_CLOSE, FSYNC_NEVER)
+
+_INT_COLUMNS = ('section', 'frame', 'z_index', 'page', 'afc_page', 'level', 'stored_bytes', 'thumb_page')
+_FLOAT_COLUMNS = ('x', 'y', 'z', 'focus_mean', 'focus_median', 'focus_std', 'time')
+
+
+def count_pages(filename):
+    with tifffile.TiffFile(filename) as tif:
+        return len(tif.pages)
+
+
+class ContainerWriter(object):
+    """ Appends images to per channel BigTIFFs for one save worker.
+
+        Args:
+            worker (int): save worker number, each worker has its own files
+    """
+    def __init__(self, worker=0):
+        self.worker = worker
+        self._files = {}  # filename -> [TiffWriter, pages]
+
+    def append(self, filename, data, tiff_args={}):
+        """ Appends `data` as a new page.
+
+            Args:
+                tiff_args (dict): extra arguments for TiffWriter.save, eg.
+                    compression
+
+            Returns:
+                tuple: (page number, bytes written)
+        """
+        entry = self._files.get(filename)
+        if entry is None:
+            pages = count_pages(filename) if os.path.isfile(filename) else 0
+            entry = [tifffile.TiffWriter(filename, bigtiff=True, append=True), pages]
+            self._files[filename] = entry
+        # pages are always written at the end of the file, and flushed
+        start = os.path.getsize(filename)
+        entry[0].save(data, contiguous=False, **tiff_args)
+        entry[1] += 1
+        return entry[1] - 1, os.path.getsize(filename) - start
+
+    def write(self, path, prot_name, data, afc_image=None, tiff_args={}):
+        """ Writes an image (and AFC profile) to the containers in `path`.
+
+            Returns:
+                dict: index columns for where the data went
+        """
+        filename = os.path.join(path, "%s_part%02d.tif" % (prot_name, self.worker))
+        t0 = time.time()
+        page, stored_bytes = self.append(filename, data, tiff_args)
+        row = {'file': filename, 'page': page, 'stored_bytes': stored_bytes,
+               'write_time': time.time() - t0}
+        if afc_image is not None:
+            afc_filename = os.path.join(path, "%s_afc_part%02d.tif" % (prot_name, self.worker))
+            row['afc_file'] = afc_filename
+            row['afc_page'], row['sidecar_bytes'] = self.append(afc_filename, afc_image.reshape(1, -1))
+        return row
+
+    def close(self):
+        for writer, pages in self._files.values():
+            writer.close()
+        self._files = {}
+
+
+class SessionIndex(object):
+    """ The index table, appended to by the save pool as images are saved.
+            Also writes the session wide metadata.
+
+        Rows are buffered and written in batches.  The fsync policy says when
+            written rows are forced to disk: FSYNC_BATCH after every batch,
+            FSYNC_CLOSE only when the index is closed, FSYNC_NEVER leaves it
+            to the OS.
+
+        Args:
+            outdir (str): session directory
+            metadata_dict (Optional[dict]): session wide metadata, see
+                file_save_process
+            batch_size (int): rows to buffer before writing
+            flush_interval (float): longest a row waits to be written (s), the
+                save pool flushes when no images have been saved for this long
+            fsync (str): FSYNC_BATCH, FSYNC_CLOSE or FSYNC_NEVER
+    """
+    def __init__(self, outdir, metadata_dict=None, batch_size=50, flush_interval=2.0, fsync=FSYNC_BATCH):
+        if fsync not in FSYNC_POLICIES:
+            raise ValueError("Unknown fsync policy: {}".format(fsync))
+        self.outdir = outdir
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.fsync = fsync
+        if metadata_dict is not None:
+            write_metadata(outdir, metadata_dict)
+        path = os.path.join(outdir, INDEX_FILE)
+        new = not os.path.isfile(path)
+        self._file = open(path, 'ab')
+        self._writer = csv.DictWriter(self._file, INDEX_COLUMNS, extrasaction='ignore')
+        if new:
+            self._writer.writeheader()
+        self._rows = []
+        self._last_flush = time.time()
+        self.rows_written = 0
+        self.flushes = 0
+
+    def append(self, row):
+        row = dict(row)
+        # file names relative to the session, so sessions can be moved
+        for column in ('file', 'afc_file', 'thumb_file'):
+            if row.get(column):
+                row[column] = os.path.relpath(row[column], self.outdir)
+        row.setdefault('time', time.time())
+        self._rows.append(row)
+        if len(self._rows) >= self.batch_size or time.time() - self._last_flush > self.flush_interval:
+            self.flush()
+
+    def flush(self):
+        """ Writes buffered rows.
+        """
+        self._last_flush = time.time()
+        if not self._rows:
+            return
+        self._writer.writerows(self._rows)
+        self.rows_written += len(self._rows)
+        self._rows = []
+        self._file.flush()
+        if self.fsync == FSYNC_BATCH:
+            os.fsync(self._file.fileno())
+        self.flushes += 1
+
+    def close(self):
+        self.flush()
+        if self.fsync == FSYNC_CLOSE:
+            os.fsync(self._file.fileno())
+        self._file.close()
+
+
+def write_metadata(outdir, metadata_dict):
+    """ Writes the session wide metadata, see file_save_process.
+    """
+    with open(os.path.join(outdir, METADATA_FILE), 'w') as f:
+        json.dump(metadata_dict, f, indent=2)
+
+
+def load_metadata(outdir):
+    with open(os.path.join(outdir, METADATA_FILE), 'r') as f:
+        metadata = json.load(f)
+    metadata['(height,width)'] = tuple(metadata['(height,width)'])
+    return metadata
+
+
+def load_index(outdir):
+    """ Reads the index table.
+
+        Returns:
+            collections.OrderedDict: (section, frame, z_index, channel) -> row,
+                the last row for each image, in the order they were saved
+    """
+    index = collections.OrderedDict()
+    with open(os.path.join(outdir, INDEX_FILE), 'rb') as f:
+        for row in csv.DictReader(f):
+            for column in _INT_COLUMNS:
+                row[column] = int(row[column]) if row[column] else None
+            for column in _FLOAT_COLUMNS:
+                # float64 so positions print at full precision, like when saved
+                row[column] = np.float64(row[column]) if row[column] else None
+            row['triggerflag'] = row['triggerflag'] == 'True'
+            key = (row['section'], row['frame'], row['z_index'], row['channel'])
+            index.pop(key, None)
+            index[key] = row
+    return index
+
+
+def read_page(outdir, filename, page):
+    """ Reads one image out of a container.  To read many, open the file once
+            with tifffile.TiffFile instead.
+    """
+    with tifffile.TiffFile(os.path.join(outdir, filename)) as tif:
+        return tif.pages[page].asarray()
@@ -0,0 +1,271 @@
+"""
+StorageMonitor.py
+
+Checks that the output volume can take an acquisition before it starts, and
+    keeps an eye on it while it runs.
+
+Before: compares free space with what the acquisition will need, then
+    measures the sustained write bandwidth of the output directory by writing
+    (and fsyncing) a probe file and compares it with what the acquisition
+    needs.  The probe takes a while, so run it off the GUI thread:
+
+    bytes = channels x z planes x frames x sections x bytes per image
+    bandwidth = bytes / estimated acquisition time (see TimeEstimator.py)
+
+During: samples free space and the bytes and images the save workers have
+    written, giving the actual write throughput and a forecast of whether the
+    rest of the acquisition will fit.  Once images have been saved the
+    forecast is the images still to save times the bytes written per image
+    so far, which takes compression into account; before that it is the
+    projection.
+
+    >>> monitor = StorageMonitor(outdir, projected_bytes, images)
+    >>> problems = monitor.preflight(seconds=estimated_time)
+    >>> problems = monitor.check_bandwidth()
+    >>> monitor.start(lambda: savePool.bytes_written, lambda: savePool.images_saved)
+    >>> monitor.status
+    >>> monitor.stop()
+
+"""
+import os
+import sys
+import time
+import logging
+import threading
+
+import numpy as np
+
+MB = 1024.0**2
+
+# tifs, sidecar files and index rows
+PER_IMAGE_OVERHEAD = 4096
+
+
+def free_bytes(path):
+    """ Bytes free to the current user on the volume holding `path`.
+    """
+    if sys.platform == 'win32':
+        import ctypes
+        free = ctypes.c_ulonglong(0)
+        ctypes.windll.kernel32.GetDiskFreeSpaceExW(ctypes.c_wchar_p(path), ctypes.byref(free), None, None)
+        return free.value
+    stat = os.statvfs(path)
+    return stat.f_bavail*stat.f_frsize
+
+
+def measure_write_bandwidth(directory, probe_bytes=256*1024**2, block_bytes=8*1024**2):
+    """ Sustained write bandwidth of `directory`, from writing and fsyncing a
+            probe file.  Random data, so compressing file systems don't
+            flatter it.
+
+        Returns:
+            float: bytes per second
+    """
+    block = np.random.randint(0, 256, block_bytes).astype(np.uint8).tostring()
+    blocks = max(int(probe_bytes//block_bytes), 1)
+    filename = os.path.join(directory, "storage_probe_{}.tmp".format(os.getpid()))
+    flags = os.O_WRONLY | os.O_CREAT | os.O_TRUNC | getattr(os, 'O_BINARY', 0)
+    fd = os.open(filename, flags)
+    try:
+        t0 = time.time()
+        for i in range(blocks):
+            os.write(fd, block)
+        os.fsync(fd)
+        elapsed = time.time() - t0
+    finally:
+        os.close(fd)
+        os.remove(filename)
+    return blocks*block_bytes/max(elapsed, 1e-6)
+
+
+def project_session_bytes(images, height, width, bytes_per_pixel=2, thumbnail_bins=()):
+    """ Bytes an acquisition will write, without compression.
+
+        Args:
+            images (int): channels x z planes x frames x sections
+            height (int): image rows
+            width (int): image columns
+            thumbnail_bins (list): see ThumbnailPyramid.py
+    """
+    image_bytes = height*width*bytes_per_pixel
+    image_bytes *= 1 + sum(1.0/bin**2 for bin in thumbnail_bins)
+    return int(images*(image_bytes + PER_IMAGE_OVERHEAD))
+
+
+class StorageMonitor(object):
+    """ Free space and write throughput of an acquisition's output directory.
+
+        Args:
+            directory (str): output directory
+            projected_bytes (int): bytes the acquisition will write, see
+                project_session_bytes
+            images (Optional[int]): images the acquisition will save
+            interval (float): how often to sample while running (s)
+            space_margin (float): free space needed, as a multiple of what is
+                left to write
+            bandwidth_margin (float): write bandwidth needed, as a multiple of
+                the acquisition's average data rate
+            notify (Optional[callable]): called with a message when a problem
+                is found while running
+    """
+    def __init__(self, directory, projected_bytes, images=None, interval=5.0, space_margin=1.1,
+                 bandwidth_margin=1.5, notify=None):
+        self.directory = directory
+        self.projected_bytes = projected_bytes
+        self.images = images
+        self.interval = interval
+        self.space_margin = space_margin
+        self.bandwidth_margin = bandwidth_margin
+        self.notify = notify
+
+        self.probe_bandwidth = None
+        self.required_bandwidth = None
+        self.problems = []
+        self._lock = threading.Lock()
+        self._written = None
+        self._saved = None
+        self._thread = None
+        self._stopping = threading.Event()
+        self._samples = []  # (time, bytes written, free bytes, images saved)
+
+    def preflight(self, seconds=None):
+        """ Checks free space, quickly.
+
+            Args:
+                seconds (Optional[float]): estimated acquisition time, for
+                    check_bandwidth
+
+            Returns:
+                list: problems found, as messages, empty if all is well
+        """
+        problems = []
+        free = free_bytes(self.directory)
+        needed = self.projected_bytes*self.space_margin
+        if free < needed:
+            problems.append("Not enough space in {}: {:.1f} GB free, the acquisition needs {:.1f} GB".format(
+                self.directory, free/MB/1024, needed/MB/1024))
+        if seconds:
+            self.required_bandwidth = self.projected_bytes/float(seconds)
+        with self._lock:
+            self.problems = list(problems)
+        return problems
+
+    def check_bandwidth(self, probe_bytes=64*1024**2):
+        """ Measures write bandwidth and checks it against the acquisition's
+                data rate from preflight.  Blocks while the probe is written.
+
+            Args:
+                probe_bytes (int): size of the bandwidth probe
+
+            Returns:
+                list: problems found, as messages, empty if all is well
+        """
+        if not probe_bytes or free_bytes(self.directory) < 2*probe_bytes:
+            return []
+        self.probe_bandwidth = measure_write_bandwidth(self.directory, probe_bytes)
+        logging.info("Write bandwidth of {}: {:.0f} MB/s".format(self.directory, self.probe_bandwidth/MB))
+        problems = []
+        if self.required_bandwidth and self.probe_bandwidth < self.required_bandwidth*self.bandwidth_margin:
+            problems.append("{} writes {:.0f} MB/s, the acquisition needs {:.0f} MB/s".format(
+                self.directory, self.probe_bandwidth/MB, self.required_bandwidth*self.bandwidth_margin/MB))
+        with self._lock:
+            self.problems.extend(problems)
+        return problems
+
+    def start(self, written, saved=None):
+        """ Starts sampling.
+
+            Args:
+                written (callable): returns the bytes written so far
+                saved (Optional[callable]): returns the images saved so far
+        """
+        self._written = written
+        self._saved = saved
+        self._stopping.clear()
+        self._sample()
+        self._thread = threading.Thread(target=self._run, name="storage monitor")
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        if self._thread is None:
+            return
+        self._stopping.set()
+        self._thread.join()
+        self._thread = None
+        self._sample()
+        logging.info("Storage summary: {}".format(self.status))
+
+    def _sample(self):
+        saved = self._saved() if self._saved is not None else None
+        sample = (time.time(), self._written(), free_bytes(self.directory), saved)
+        with self._lock:
+            self._samples.append(sample)
+            # the first sample, and enough for a throughput over the last minute
+            del self._samples[1:-max(int(60/self.interval), 2)]
+        return sample
+
+    def _run(self):
+        while not self._stopping.wait(self.interval):
+            try:
+                self._sample()
+                self._check()
+            except Exception:
+                logging.exception("Storage monitor failed to sample")
+
+    def _check(self):
+        status = self.status
+        problem = None
+        if status['remaining_bytes']*self.space_margin > status['free_bytes']:
+            problem = "{} will run out of space: {:.1f} GB free, {:.1f} GB still to write".format(
+                self.directory, status['free_bytes']/MB/1024, status['remaining_bytes']/MB/1024)
+        with self._lock:
+            if problem is None or problem.split(':')[0] in [p.split(':')[0] for p in self.problems]:
+                return
+            self.problems.append(problem)
+        logging.warning(problem)
+        if self.notify is not None:
+            self.notify(problem)
+
+    @property
+    def status(self):
+        """ dict: free_bytes, projected_bytes, written_bytes, images_saved,
+                bytes_per_image, remaining_bytes, write_mb_per_s (last
+                minute), mean_write_mb_per_s, probe_mb_per_s,
+                required_mb_per_s, seconds_until_full and problems
+        """
+        with self._lock:
+            samples = list(self._samples)
+            problems = list(self.problems)
+        status = {
+            'projected_bytes': self.projected_bytes,
+            'probe_mb_per_s': self.probe_bandwidth/MB if self.probe_bandwidth else None,
+            'required_mb_per_s': self.required_bandwidth/MB if self.required_bandwidth else None,
+            'problems': problems,
+        }
+        if not samples:
+            status['free_bytes'] = free_bytes(self.directory)
+            status['written_bytes'] = 0
+            status['images_saved'] = None
+        else:
+            status['written_bytes'] = samples[-1][1]
+            status['free_bytes'] = samples[-1][2]
+            status['images_saved'] = samples[-1][3]
+        saved = status['images_saved']
+        if self.images and saved:
+            status['bytes_per_image'] = status['written_bytes']/float(saved)
+            status['remaining_bytes'] = int(max(self.images - saved, 0)*status['bytes_per_image'])
+        else:
+            status['bytes_per_image'] = None
+            status['remaining_bytes'] = max(self.projected_bytes - status['written_bytes'], 0)
+        status['write_mb_per_s'] = _rate(samples[1:] if len(samples) > 2 else samples)
+        status['mean_write_mb_per_s'] = _rate(samples)
+        rate = status['write_mb_per_s']
+        status['seconds_until_full'] = status['free_bytes']/(rate*MB) if rate else None
+        return status
+
+
+def _rate(samples):
+    if len(samples) < 2 or samples[-1][0] <= samples[0][0]:
+        return None
+    return (samples[-1][1] - samples[0][1])/(samples[-1][0] - samples[0][0])/MB
@@ -0,0 +1,121 @@
+"""
+ThumbnailPyramid.py
+
+Small block mean binned copies of every saved image (eg. 2x, 4x and 8x), made
+    by the save workers so review tools can load kilobytes instead of the full
+    image.
+
+Each level is a page of a tif, tagged with its binning:
+
+    files: <prot_name>_S0000_F0000_Z00_thumbs.tif next to the image
+    container: appended to <prot_name>_thumbs_part<worker>.tif, the session
+        index row says which page the first level is on
+
+    >>> thumb = load_thumbnail(outdir, prot_name, ch, section, frame, bin=8)
+
+"""
+import os
+import json
+
+import numpy as np
+import tifffile
+
+import SessionContainer
+from imgprocessing import bin_image
+
+
+def make_pyramid(img, bins=(2, 4, 8)):
+    """ Bins `img` at each of `bins`.
+
+        Returns:
+            list: (bin, binned image), smallest bin first
+    """
+    pyramid = []
+    source_bin, source = 1, img
+    for bin in sorted(bins):
+        if bin % source_bin:
+            source_bin, source = 1, img
+        # bin the last level, it's much smaller than the image.  Levels are
+        # kept as unrounded means so every level is the mean of the image.
+        means = bin_image(source, bin//source_bin, np.float32)
+        if np.issubdtype(img.dtype, np.integer):
+            binned = np.rint(means).astype(img.dtype)
+        else:
+            binned = means.astype(img.dtype)
+        pyramid.append((bin, binned))
+        source_bin, source = bin, means
+    return pyramid
+
+
+def thumbnail_filename(path, prot_name, section, frame, z_index=0):
+    return os.path.join(path, prot_name + "_S%04d_F%04d_Z%02d_thumbs.tif" % (section, frame, z_index))
+
+
+def level_args(bin, levels):
+    """ TiffWriter.save arguments that tag a page as a pyramid level.
+    """
+    return {'metadata': {'bin': bin, 'levels': levels}}
+
+
+def write_pyramid(filename, pyramid):
+    """ Writes a pyramid to its own file.
+    """
+    with tifffile.TiffWriter(filename) as tif:
+        for bin, binned in pyramid:
+            tif.save(binned, contiguous=False, **level_args(bin, len(pyramid)))
+
+
+def save_pyramid(pyramid, path, prot_name, section, frame, z_index=0, writer=None):
+    """ Saves an image's pyramid, to its own file or with a
+            SessionContainer.ContainerWriter.
+
+        Returns:
+            dict: `thumb_file` and `thumb_page` index columns, and the
+                `thumb_bytes` written
+    """
+    if writer is None:
+        filename = thumbnail_filename(path, prot_name, section, frame, z_index)
+        write_pyramid(filename, pyramid)
+        return {'thumb_file': filename, 'thumb_page': 0, 'thumb_bytes': os.path.getsize(filename)}
+    filename = os.path.join(path, "%s_thumbs_part%02d.tif" % (prot_name, writer.worker))
+    pages = [writer.append(filename, binned, level_args(bin, len(pyramid))) for bin, binned in pyramid]
+    return {'thumb_file': filename, 'thumb_page': pages[0][0], 'thumb_bytes': sum(size for page, size in pages)}
+
+
+def read_thumbnail(filename, bin=8, first_page=0):
+    """ Reads one level of the pyramid starting at `first_page`: the one
+            binned by `bin`, or the most detailed one binned more than that,
+            or failing that the least detailed one.
+
+        Returns:
+            tuple: (bin, binned image)
+    """
+    with tifffile.TiffFile(filename) as tif:
+        levels = json.loads(tif.pages[first_page].description)['levels']
+        pages = [tif.pages[first_page + i] for i in range(levels)]
+        bins = [json.loads(page.description)['bin'] for page in pages]
+        coarser = [i for i, b in enumerate(bins) if b >= bin]
+        level = coarser[0] if coarser else len(bins) - 1
+        return bins[level], pages[level].asarray()
+
+
+def load_thumbnail(outdir, prot_name, ch, section, frame, z_index=0, bin=8):
+    """ Reads a saved image's thumbnail, see read_thumbnail.
+
+        Args:
+            outdir (str): session directory
+            prot_name (str): channel directory and file prefix
+            ch (str): channel, for sessions saved as containers
+
+        Returns:
+            Optional[tuple]: (bin, binned image), None if there isn't one
+    """
+    filename = thumbnail_filename(os.path.join(outdir, prot_name), prot_name, section, frame, z_index)
+    if os.path.isfile(filename):
+        return read_thumbnail(filename, bin)
+    if not os.path.isfile(os.path.join(outdir, SessionContainer.INDEX_FILE)):
+        return None
+    row = SessionContainer.load_index(outdir).get((section, frame, z_index, ch))
+    if row is None or not row['thumb_file']:
+        return None
+    return read_thumbnail(os.path.join(outdir, row['thumb_file']), bin, row['thumb_page'])
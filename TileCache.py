@@ -0,0 +1,236 @@
+"""
+TileCache.py
+
+Decoded map tiles kept in memory, so cutouts around the same tiles (eg.
+    align_by_correlation and align_by_sift at every step of a fast forward)
+    don't read and decode the tif every time.
+
+Uncompressed tiles, which is what MyImage.save_data writes, are also memory
+    mapped, so a cutout only reads the pages of the window it needs and takes
+    about as long for a large tile as for a small one.  Compressed or
+    otherwise unmappable tiles are decoded instead.
+
+One cache is shared by the whole process, `tile_cache`.  It is least recently
+    used first out within a byte budget, and keyed by path, modification time
+    and size, so a tile written again is read again.  Tiles and windows come
+    back read only, copy them to change them.
+
+    >>> data = tile_cache.get(image.imagePath)
+    >>> cut = tile_cache.get_window(image.imagePath, rows, columns)
+    >>> tile_cache.stats
+
+"""
+import os
+import time
+import threading
+from collections import OrderedDict
+
+import numpy as np
+import tifffile
+from PIL import Image
+
+
+def read_tile(path):
+    """ Reads a map tile as 8 bit, like MyImage always has.
+    """
+    try:
+        data = tifffile.imread(path)
+    except Exception:
+        # not something tifffile reads, eg. a png
+        data = np.asarray(Image.open(path, mode='r'))
+    return to_8bit(data)
+
+
+def to_8bit(data):
+    if data.dtype != np.uint8:
+        data = data.astype(np.uint8)
+    return data
+
+
+def map_tile(path):
+    """ Memory maps a map tile, read only.
+
+        Returns:
+            Optional[numpy.memmap]: None if the tile can't be mapped, eg. it
+                is compressed
+    """
+    try:
+        return tifffile.memmap(path, mode='r')
+    except Exception:
+        return None
+
+
+class TileCache(object):
+    """ Decoded and memory mapped tiles by path.
+
+        Args:
+            max_bytes (int): most bytes of tiles to keep, 0 to not cache
+            loader (callable): reads a tile given its path
+            max_maps (int): most tiles to keep mapped, 0 to not map
+    """
+    def __init__(self, max_bytes=512*1024**2, loader=read_tile, max_maps=256):
+        self.max_bytes = max_bytes
+        self.loader = loader
+        self.max_maps = max_maps
+        self._lock = threading.Lock()
+        self._tiles = OrderedDict()  # path -> ((mtime, size), data), least recently used first
+        self._maps = OrderedDict()  # path -> ((mtime, size), memmap or None if it can't be)
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.stale = 0
+        self.evictions = 0
+        self.decode_time = 0.0
+        self.mapped = 0
+        self.unmappable = 0
+
+    def get(self, path):
+        """ The decoded tile at `path`, read only.
+        """
+        return self._get(path, _stamp(path))
+
+    def get_window(self, path, rows, columns):
+        """ Part of the tile at `path`, 8 bit and read only.  From the
+                decoded tile if it is cached, otherwise read from the tile
+                memory mapped, otherwise from the tile decoded.
+
+            Args:
+                rows (slice): eg. slice(top, bottom)
+                columns (slice): eg. slice(left, right)
+        """
+        stamp = _stamp(path)
+        with self._lock:
+            entry = self._tiles.get(path)
+            if entry is not None and entry[0] == stamp:
+                self._tiles[path] = self._tiles.pop(path)
+                self.hits += 1
+                return entry[1][rows, columns]
+        mapped = self._map(path, stamp)
+        if mapped is None:
+            return self._get(path, stamp)[rows, columns]
+        # only reads the pages of the window
+        window = to_8bit(np.array(mapped[rows, columns]))
+        window.setflags(write=False)
+        with self._lock:
+            self.mapped += 1
+        return window
+
+    def get_shape(self, path):
+        """ Shape of the tile at `path`, decoding it only if it can't be
+                mapped.
+        """
+        stamp = _stamp(path)
+        with self._lock:
+            entry = self._tiles.get(path)
+            if entry is not None and entry[0] == stamp:
+                return entry[1].shape
+        mapped = self._map(path, stamp)
+        if mapped is None:
+            return self._get(path, stamp).shape
+        return mapped.shape
+
+    def _map(self, path, stamp):
+        if not self.max_maps:
+            return None
+        with self._lock:
+            entry = self._maps.pop(path, None)
+            if entry is not None and entry[0] == stamp:
+                self._maps[path] = entry
+                return entry[1]
+        mapped = map_tile(path)
+        with self._lock:
+            if mapped is None:
+                self.unmappable += 1
+            self._maps[path] = (stamp, mapped)
+            while len(self._maps) > self.max_maps:
+                self._maps.popitem(last=False)
+        return mapped
+
+    def _get(self, path, stamp):
+        with self._lock:
+            entry = self._tiles.pop(path, None)
+            if entry is not None:
+                if entry[0] == stamp:
+                    self._tiles[path] = entry
+                    self.hits += 1
+                    return entry[1]
+                # the file has been written since
+                self.stale += 1
+                self.bytes -= entry[1].nbytes
+            self.misses += 1
+
+        t0 = time.time()
+        data = self.loader(path)
+        data.setflags(write=False)
+        with self._lock:
+            self.decode_time += time.time() - t0
+            if data.nbytes <= self.max_bytes:
+                if path in self._tiles:
+                    # read by another thread meanwhile
+                    self.bytes -= self._tiles.pop(path)[1].nbytes
+                self._tiles[path] = (stamp, data)
+                self.bytes += data.nbytes
+                self._evict()
+        return data
+
+    def _evict(self):
+        while self.bytes > self.max_bytes:
+            path, (stamp, data) = self._tiles.popitem(last=False)
+            self.bytes -= data.nbytes
+            self.evictions += 1
+
+    def set_budget(self, max_bytes, max_maps=None):
+        with self._lock:
+            self.max_bytes = max_bytes
+            self._evict()
+            if max_maps is not None:
+                self.max_maps = max_maps
+                while len(self._maps) > self.max_maps:
+                    self._maps.popitem(last=False)
+
+    def invalidate(self, path):
+        """ Forgets the tile at `path`, this has to be done before writing
+                it as windows won't replace a memory mapped file.
+        """
+        with self._lock:
+            entry = self._tiles.pop(path, None)
+            if entry is not None:
+                self.bytes -= entry[1].nbytes
+            self._maps.pop(path, None)
+
+    def clear(self):
+        with self._lock:
+            self._tiles.clear()
+            self._maps.clear()
+            self.bytes = 0
+
+    @property
+    def stats(self):
+        """ dict: tiles, bytes, max_bytes, hits, misses, stale, evictions,
+                hit_rate, decode_time (s spent reading tiles), maps, mapped
+                (windows read from maps) and unmappable
+        """
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                'tiles': len(self._tiles),
+                'bytes': self.bytes,
+                'max_bytes': self.max_bytes,
+                'hits': self.hits,
+                'misses': self.misses,
+                'stale': self.stale,
+                'evictions': self.evictions,
+                'hit_rate': self.hits/float(lookups) if lookups else None,
+                'decode_time': self.decode_time,
+                'maps': sum(1 for stamp, mapped in self._maps.values() if mapped is not None),
+                'mapped': self.mapped,
+                'unmappable': self.unmappable,
+            }
+
+
+def _stamp(path):
+    stat = os.stat(path)
+    return (stat.st_mtime, stat.st_size)
+
+
+tile_cache = TileCache()
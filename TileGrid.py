@@ -0,0 +1,100 @@
+"""
+TileGrid.py
+
+Uniform grid index over the bounding boxes of an ImageCollection's tiles, so
+    finding the tiles at a point or around a rectangle looks at a few grid
+    cells instead of every tile.
+
+Tiles are all about the same size, so the cells are the size of the first
+    tile added: every tile is in at most 4 cells, and a query only looks at
+    the cells it touches.  Adding a tile updates the grid in place.
+
+    >>> grid = TileGrid()
+    >>> grid.add(image.boundBox, image)
+    >>> grid.containing_point(x, y)
+    [image]
+
+Queries use the strict comparisons of Rectangle.contains_point and
+    contains_rect and give tiles in the order they were added, so the first
+    tile found is the one a scan of the tile list would find first.
+
+"""
+import math
+from collections import defaultdict
+
+
+class TileGrid(object):
+    """ Tiles by position.
+
+        Args:
+            cell_size (Optional[float]): grid spacing, the size of the first
+                tile if None
+    """
+    def __init__(self, cell_size=None):
+        self.cell_size = cell_size
+        self._cells = defaultdict(list)  # (column, row) -> tile numbers
+        self._bounds = []  # (left, right, top, bottom) of each tile
+        self._items = []
+
+    def __len__(self):
+        return len(self._items)
+
+    def add(self, rect, item):
+        """ Adds a tile.
+
+            Args:
+                rect (Rectangle.Rectangle): bounding box of the tile, which
+                    mustn't change afterwards
+                item: what queries give for this tile
+        """
+        if self.cell_size is None:
+            self.cell_size = float(max(rect.right - rect.left, rect.bottom - rect.top)) or 1.0
+        number = len(self._items)
+        self._bounds.append((rect.left, rect.right, rect.top, rect.bottom))
+        self._items.append(item)
+        for cell in self._cells_in(rect.left, rect.right, rect.top, rect.bottom):
+            self._cells[cell].append(number)
+
+    def _cells_in(self, left, right, top, bottom):
+        size = self.cell_size
+        columns = range(int(math.floor(left/size)), int(math.floor(right/size)) + 1)
+        rows = range(int(math.floor(top/size)), int(math.floor(bottom/size)) + 1)
+        return [(column, row) for column in columns for row in rows]
+
+    def _candidates(self, left, right, top, bottom):
+        if self.cell_size is None:
+            return []
+        size = self.cell_size
+        columns = math.floor(right/size) - math.floor(left/size) + 1
+        rows = math.floor(bottom/size) - math.floor(top/size) + 1
+        if columns*rows > len(self._items):
+            # a rectangle the size of the map, checking every tile is quicker
+            return range(len(self._items))
+        numbers = set()
+        for cell in self._cells_in(left, right, top, bottom):
+            numbers.update(self._cells.get(cell, ()))
+        return sorted(numbers)
+
+    def containing_point(self, x, y):
+        """ Tiles with (x, y) inside them.
+        """
+        bounds = self._bounds
+        return [self._items[n] for n in self._candidates(x, x, y, y)
+                if bounds[n][0] < x < bounds[n][1] and bounds[n][2] < y < bounds[n][3]]
+
+    def containing_rect(self, rect):
+        """ Tiles with `rect` inside them.
+        """
+        bounds = self._bounds
+        return [self._items[n] for n in self._candidates(rect.left, rect.right, rect.top, rect.bottom)
+                if bounds[n][0] < rect.left and rect.right < bounds[n][1]
+                and bounds[n][2] < rect.top and rect.bottom < bounds[n][3]]
+
+    def overlapping(self, rect):
+        """ Tiles that overlap `rect`, including ones it is inside of and
+                ones inside it.
+        """
+        bounds = self._bounds
+        return [self._items[n] for n in self._candidates(rect.left, rect.right, rect.top, rect.bottom)
+                if bounds[n][0] < rect.right and rect.left < bounds[n][1]
+                and bounds[n][2] < rect.bottom and rect.top < bounds[n][3]]
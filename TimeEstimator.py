@@ -0,0 +1,188 @@
+"""
+TimeEstimator.py
+
+Estimates how long the rest of an acquisition will take, from timings
+    measured in the current session and in earlier sessions on the same scope.
+
+Each frame's time (excluding exposure, which we know) is modelled as
+
+    overhead + a*travel + b*images + c*z_moves + d*software_autofocus
+
+    where travel is the stage travel time to the frame (see PathPlanner.py),
+    images is channels x z planes, z_moves is the number of z moves and
+    software_autofocus is 1 if the frame triggers a software autofocus.
+
+The coefficients are fit with Bayesian linear regression.  The prior is the
+    fit from previous sessions on this scope (or rough defaults), so early
+    estimates are sensible and get better as frames come in.  The posterior
+    also gives a confidence interval for the remaining time.
+
+"""
+import os
+import json
+import logging
+
+import numpy as np
+
+from PathPlanner import StageModel
+
+FEATURES = ("overhead", "travel", "images", "z_moves", "software_autofocus")
+
+# rough per frame costs (s) for a scope we haven't seen before
+DEFAULT_COEFFICIENTS = (0.2, 1.0, 0.05, 0.05, 5.0)
+DEFAULT_SIGMA = 0.1
+
+# how many frames of evidence the prior is worth
+DEFAULT_PRIOR_WEIGHT = 2.0
+HISTORY_PRIOR_WEIGHT = 20.0
+
+Z_95 = 1.96
+
+
+class AcquisitionTimeEstimator(object):
+    """ Learns per frame timings and predicts remaining acquisition time.
+
+        Args:
+            stage (Optional[PathPlanner.StageModel]): stage travel time model
+            scope_name (str): name used to keep history per microscope
+            history_file (Optional[str]): json file to load/save fits from
+                previous sessions
+    """
+    def __init__(self, stage=None, scope_name="", history_file=None):
+        self.stage = stage if stage is not None else StageModel()
+        self.scope_name = scope_name
+        self.history_file = history_file
+
+        self.prior_mean = np.array(DEFAULT_COEFFICIENTS)
+        self.prior_weight = DEFAULT_PRIOR_WEIGHT
+        self.prior_sigma2 = DEFAULT_SIGMA**2
+        self.load_history()
+        self.sigma2 = self.prior_sigma2
+
+        self.images = 1
+        self.z_moves = 0
+        self.exposure = 0.0
+        self._last_xy = None
+        # sufficient statistics of the frames so far, so a refit doesn't
+        # depend on how many frames there have been
+        self._XtX = np.zeros((len(FEATURES), len(FEATURES)))
+        self._Xty = np.zeros(len(FEATURES))
+        self._yty = 0.0
+        self._n = 0
+        self._fit()
+
+    def load_history(self):
+        if self.history_file and os.path.isfile(self.history_file):
+            try:
+                with open(self.history_file, 'r') as f:
+                    history = json.load(f).get(self.scope_name)
+            except Exception:
+                logging.exception("Couldn't read acquisition time history.")
+                return
+            if history:
+                self.prior_mean = np.array(history['coefficients'])
+                self.prior_sigma2 = history['sigma2']
+                self.prior_weight = HISTORY_PRIOR_WEIGHT
+
+    def save_history(self):
+        """ Saves this session's fit as the prior for the next session, keeping
+                other scopes' history already in the file.
+        """
+        if not self.history_file or not self._n:
+            return
+        everything = {}
+        if os.path.isfile(self.history_file):
+            try:
+                with open(self.history_file, 'r') as f:
+                    everything = json.load(f)
+            except Exception:
+                logging.exception("Couldn't read acquisition time history.")
+        everything[self.scope_name] = {
+            'coefficients': self.mean.tolist(),
+            'sigma2': self.sigma2,
+            'frames': self._n,
+        }
+        with open(self.history_file, 'w') as f:
+            json.dump(everything, f)
+
+    def start_session(self, channels, zplanes, exposure, start_xy=None):
+        """ Sets what every frame in this acquisition looks like.
+
+            Args:
+                channels (int): active channels
+                zplanes (int): z planes per frame, 1 for no z-stack
+                exposure (float): summed exposure time of one z plane (ms)
+                start_xy (Optional[tuple]): where the stage is now
+        """
+        self.images = channels*zplanes
+        # a z-stack visits every plane and then goes back
+        self.z_moves = zplanes + 1 if zplanes > 1 else 0
+        self.exposure = zplanes*exposure/1000.0
+        self._last_xy = start_xy
+
+    def _features(self, xy, software_autofocus, last_xy):
+        travel = self.stage.travel_time(last_xy, xy) if last_xy is not None else 0.0
+        return [1.0, travel, self.images, self.z_moves, 1.0 if software_autofocus else 0.0]
+
+    def frame_done(self, x, y, duration, software_autofocus=False):
+        """ Records how long a frame took, from the end of the previous frame.
+        """
+        features = np.array(self._features((x, y), software_autofocus, self._last_xy))
+        measured = duration - self.exposure
+        self._XtX += np.outer(features, features)
+        self._Xty += features*measured
+        self._yty += measured**2
+        self._n += 1
+        self._last_xy = (x, y)
+        self._fit()
+
+    def _fit(self):
+        # Bayesian linear regression, the prior is worth `prior_weight` typical frames
+        typical = np.array(self._features((0, 0), False, None))
+        typical[1] = 1.0
+        typical[4] = 0.1
+        prior_precision = self.prior_weight*np.diag(np.maximum(typical, 0.1)**2)/self.prior_sigma2
+        if self._n:
+            # sum of squared residuals of the last fit, |y - X.mean|^2
+            residuals2 = self._yty - 2*self.mean.dot(self._Xty) + self.mean.dot(self._XtX).dot(self.mean)
+            # pool the residual variance with the prior variance
+            self.sigma2 = ((self.prior_weight*self.prior_sigma2 + max(residuals2, 0.0)) /
+                           (self.prior_weight + self._n))
+            self.sigma2 = max(self.sigma2, 1e-6)
+            precision = prior_precision + self._XtX/self.sigma2
+            self.covariance = np.linalg.inv(precision)
+            self.mean = self.covariance.dot(prior_precision.dot(self.prior_mean) + self._Xty/self.sigma2)
+        else:
+            self.covariance = np.linalg.inv(prior_precision)
+            self.mean = self.prior_mean.copy()
+
+    def estimate(self, frames, start_xy=None):
+        """ Estimates the time to acquire `frames`.
+
+            Args:
+                frames (list): (x, y, software_autofocus) for each remaining
+                    frame, in the order they will be visited
+                start_xy (Optional[tuple]): where the stage is now, defaults to
+                    the last recorded frame
+
+            Returns:
+                dict: `seconds`, `low` and `high` (95% interval), `frames` and
+                    the fitted per frame `coefficients`
+        """
+        last_xy = start_xy if start_xy is not None else self._last_xy
+        total = np.zeros(len(FEATURES))
+        for x, y, software_autofocus in frames:
+            total += self._features((x, y), software_autofocus, last_xy)
+            last_xy = (x, y)
+        n = len(frames)
+        seconds = total.dot(self.mean) + n*self.exposure
+        # uncertainty in the coefficients plus independent per frame noise
+        sd = np.sqrt(total.dot(self.covariance).dot(total) + n*self.sigma2)
+        return {
+            'seconds': float(seconds),
+            'low': float(max(seconds - Z_95*sd, 0.0)),
+            'high': float(seconds + Z_95*sd),
+            'confidence': 0.95,
+            'frames': n,
+            'coefficients': dict(zip(FEATURES, self.mean.tolist())),
+        }
@@ -1,2 +1,4 @@
 STOP_TOKEN = "STOP"
-BUBBLE_TOKEN = "BUBBLE"
\ No newline at end of file
+BUBBLE_TOKEN = "BUBBLE"
+SAVED_TOKEN = "SAVED"
+FAILED_TOKEN = "FAILED"
\ No newline at end of file
@@ -0,0 +1,537 @@
+"""
+acquisition_benchmark.py
+
+Headless end-to-end acquisition benchmarks.  Runs the same steps as
+    MosaicPanel.on_run_acq / multiDacq (stage move, autofocus wait, z and
+    channel loops, snap, save queue and save process) against the simulated
+    demo image source (see ScopeSimulator.py), without wx.
+
+    $ python acquisition_benchmark.py --output results.json
+    $ python acquisition_benchmark.py --workload 3x3_4ch_sw --compare results.json
+
+For every workload it reports frames/s, save latency (frame acquired to tif
+    written), peak RSS of the acquisition and save processes and bytes
+    written.  Results are saved as json; --compare prints the change against
+    an earlier results file so regressions are visible between versions.
+
+Each workload runs in its own process so peak RSS is per workload.
+
+"""
+import os
+import sys
+import json
+import time
+import shutil
+import argparse
+import platform
+import tempfile
+import itertools
+import subprocess
+import collections
+import multiprocessing as mp
+
+import numpy as np
+
+try:
+    import resource
+except ImportError:
+    resource = None  # windows
+
+from SaveThread import file_save_process
+from SavePool import SavePool
+from SessionContainer import SessionIndex
+from FocusStore import FocusStore
+from FramePublisher import FramePublisher
+from SaveQueue import SaveQueue
+from FrameRing import FrameRing
+from Compression import Compressor, CODECS
+from imageSourceDemo import ImageSource
+from ScopeSimulator import TimingModel, RibbonSpecimen
+from PathPlanner import grid_frame_positions
+from AcquisitionPipeline import FramePipeline
+from AutofocusSettle import SettleDetector
+import AcquisitionTrace as trace
+
+Workload = collections.namedtuple('Workload', 'name mx my channels zplanes hardware_trigger')
+
+WORKLOADS = [
+    Workload("1x1_1ch_sw", 1, 1, 1, 1, False),
+    Workload("3x3_1ch_sw", 3, 3, 1, 1, False),
+    Workload("1x1_4ch_sw", 1, 1, 4, 1, False),
+    Workload("3x3_4ch_sw", 3, 3, 4, 1, False),
+    Workload("3x3_2ch_z3_sw", 3, 3, 2, 3, False),
+    Workload("1x1_4ch_hw", 1, 1, 4, 1, True),
+    Workload("3x3_4ch_hw", 3, 3, 4, 1, True),
+    Workload("3x3_4ch_z3_hw", 3, 3, 4, 3, True),
+]
+
+PERCENTILES = (50, 90, 99)
+
+
+def workload_matrix():
+    """ Every combination of mosaic size, channel count, z-stack and trigger.
+    """
+    workloads = []
+    for (m, channels, zplanes, hw) in itertools.product((1, 3), (1, 2, 3, 4), (1, 3), (False, True)):
+        name = "%dx%d_%dch%s_%s" % (m, m, channels, "_z%d" % zplanes if zplanes > 1 else "",
+                                    "hw" if hw else "sw")
+        workloads.append(Workload(name, m, m, channels, zplanes, hw))
+    return workloads
+
+
+def peak_rss_mb():
+    """ Peak resident memory of this process in MB, None if we can't tell.
+    """
+    if resource is None:
+        return None
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform == 'darwin':
+        return rss/1024.0**2  # bytes on mac
+    return rss/1024.0  # kB on linux
+
+
+class _SaveProcess(object):
+    """ The normal save process, reporting its peak memory when it is done.
+    """
+    def __init__(self, rss_queue):
+        self.rss_queue = rss_queue
+
+    def __call__(self, *args):
+        file_save_process(*args)
+        self.rss_queue.put(peak_rss_mb())
+
+
+def directory_size(path):
+    total = 0
+    count = 0
+    for root, dirs, files in os.walk(path):
+        for f in files:
+            total += os.path.getsize(os.path.join(root, f))
+            count += 1
+    return total, count
+
+
+class HeadlessAcquisition(object):
+    """ The acquisition loop from MosaicPanel without the GUI.
+
+        Args:
+            imgSrc (imageSourceDemo.ImageSource): simulated image source
+            outdir (str): where to save the data
+            workload (Workload): what to acquire
+            sections (list): (x, y) section centers
+            exposure (float): exposure time for every channel (ms)
+            pipelined (bool): overlap stage moves with queueing, see AcquisitionPipeline.py
+            adaptive_autofocus (bool): use the SettleDetector instead of fixed waits
+            autofocus_wait (float): same as the autofocus_wait setting
+            autofocus_sleep (float): same as the autofocus_sleep setting
+            save_queue (dict): SaveQueue arguments
+            save_workers (int): number of save processes, see SavePool.py
+            container (bool): save per channel containers, see SessionContainer.py
+            metadata_table (bool): record metadata in the session index instead
+                of a _metadata.txt per image, always on for containers
+            compression (Optional[Compression.Compressor]): compress saved images
+            focus_store (bool): keep focus scores in one FocusStore instead of
+                a _focus.csv per image
+            thumbnail_bins (list): thumbnail pyramid to save with every image,
+                see ThumbnailPyramid.py
+            publisher (Optional[FramePublisher.FramePublisher]): publishes
+                saved images
+    """
+    def __init__(self, imgSrc, outdir, workload, sections, exposure=50.0,
+                 pipelined=False, adaptive_autofocus=False,
+                 autofocus_wait=0.1, autofocus_sleep=0.2, zstack_delta=0.5,
+                 save_queue=None, save_workers=1, container=False, metadata_table=False,
+                 compression=None, focus_store=False, thumbnail_bins=(), publisher=None):
+        self.imgSrc = imgSrc
+        self.outdir = outdir
+        self.workload = workload
+        self.sections = sections
+        self.channels = imgSrc.get_channels()[:workload.channels]
+        self.exposure_times = dict((ch, exposure) for ch in self.channels)
+        self.autofocus_wait = autofocus_wait
+        self.autofocus_sleep = autofocus_sleep
+        self.zstack_delta = zstack_delta
+        self.hold_focus = workload.zplanes == 1
+        self.pipeline = FramePipeline(imgSrc) if pipelined else None
+        self.settle_detector = SettleDetector(imgSrc) if adaptive_autofocus else None
+        self.ready_times = []
+        self.save_queue_args = save_queue or {}
+        self.save_workers = save_workers
+        self.container = container
+        self.metadata_table = metadata_table or container
+        self.compression = compression
+        self.focus_store = focus_store
+        self.thumbnail_bins = thumbnail_bins
+        self.publisher = publisher
+        self.trace = trace.AcquisitionTrace(os.path.join(outdir, 'acquisition_trace.csv'))
+        self.save_trace_path = os.path.join(outdir, 'acquisition_trace_save.csv')
+        for ch in self.channels:
+            os.makedirs(os.path.join(outdir, ch))
+
+    def _queue_data(self, token):
+        self.ready_times.append(time.time())
+        if self.pipeline is not None:
+            self.pipeline.defer(token)
+        else:
+            with self.trace.span(trace.QUEUE_PUT):
+                self.dataQueue.put(token)
+
+    def autofocus_loop(self):
+        if self.settle_detector is not None:
+            self.settle_detector.wait()
+        else:
+            time.sleep(self.autofocus_wait)
+            attempts = 0
+            while not self.imgSrc.is_hardware_autofocus_done():
+                time.sleep(self.autofocus_sleep)
+                attempts += 1
+                if attempts > 50:
+                    break
+        if not self.hold_focus:
+            self.imgSrc.set_hardware_autofocus_state(False)
+
+    def acquire_frame(self, slice_index, frame_index, x, y, triggerflag):
+        imgSrc = self.imgSrc
+        if not self.hold_focus:
+            imgSrc.set_hardware_autofocus_state(True)
+        self.trace.set_frame(slice_index, frame_index)
+        with self.trace.span(trace.STAGE_MOVE):
+            if self.pipeline is not None:
+                self.pipeline.arrive(x, y)
+            else:
+                imgSrc.move_stage(x, y)
+        stagexy = imgSrc.get_xy()
+        with self.trace.span(trace.AUTOFOCUS_WAIT):
+            self.autofocus_loop()
+
+        current_z = imgSrc.get_z()
+        present_z = current_z
+        n = self.workload.zplanes
+        zplanes = [current_z - self.zstack_delta*(n-1)/2.0 + i*self.zstack_delta for i in range(n)]
+        last_channel = self.channels[-1]
+
+        for z_index, z in enumerate(zplanes):
+            if not self.hold_focus and z != present_z:
+                with self.trace.span(trace.SET_Z):
+                    imgSrc.set_z(z)
+                present_z = z
+            if self.workload.hardware_trigger:
+                imgSrc.startHardwareSequence()
+            for ch in self.channels:
+                if self.workload.hardware_trigger:
+                    with self.trace.span(trace.SNAP):
+                        data = imgSrc.get_image()
+                else:
+                    with self.trace.span(trace.SET_EXPOSURE):
+                        imgSrc.set_exposure(self.exposure_times[ch])
+                    with self.trace.span(trace.SET_CHANNEL):
+                        imgSrc.set_channel(ch)
+                    with self.trace.span(trace.SNAP):
+                        data = imgSrc.snap_image()
+                calc_focus = ch == self.channels[0]
+                flag = triggerflag and ch == last_channel
+                self._queue_data((slice_index, frame_index, z_index, ch, os.path.join(self.outdir, ch),
+                                  data, ch, stagexy[0], stagexy[1], z, flag, calc_focus, None))
+
+        if not self.hold_focus:
+            imgSrc.set_z(current_z)
+            imgSrc.set_hardware_autofocus_state(True)
+
+    def run(self):
+        """ Runs the acquisition.
+
+            Returns:
+                dict: timing results
+        """
+        queue_args = dict(self.save_queue_args)
+        ring_slots = queue_args.pop('ring_slots', 0)
+        if ring_slots:
+            (width, height) = self.imgSrc.get_sensor_size()
+            queue_args['ring'] = FrameRing(slots=ring_slots, slot_bytes=width*height*2)
+        self.dataQueue = SaveQueue(**queue_args)
+        self.messageQueue = mp.Queue()
+        rss_queue = mp.Queue()
+        metadata_dictionary = {
+            'channelname': dict((ch, ch) for ch in self.channels),
+            '(height,width)': self.imgSrc.get_sensor_size(),
+            'ScaleFactorX': self.imgSrc.get_pixel_size(),
+            'ScaleFactorY': self.imgSrc.get_pixel_size(),
+            'exp_time': self.exposure_times,
+        }
+        save_pool = SavePool(self.dataQueue, self.messageQueue, metadata_dictionary,
+                             workers=self.save_workers, trace_path=self.save_trace_path,
+                             target=_SaveProcess(rss_queue),
+                             index=SessionIndex(self.outdir, metadata_dictionary) if self.metadata_table else None,
+                             container=self.container,
+                             compression=self.compression,
+                             focus_store=FocusStore(self.outdir) if self.focus_store else None,
+                             thumbnail_bins=self.thumbnail_bins,
+                             publisher=self.publisher)
+        save_pool.start()
+
+        if self.workload.hardware_trigger:
+            self.imgSrc.setup_hardware_triggering(self.channels, [self.exposure_times[ch] for ch in self.channels])
+
+        (fw, fh) = self.imgSrc.get_frame_size_um()
+        t0 = time.time()
+        frames = 0
+        for i, (sx, sy) in enumerate(self.sections):
+            positions = grid_frame_positions(sx, sy, self.workload.mx, self.workload.my, 10.0, fw, fh)
+            for j, (x, y) in enumerate(positions):
+                self.acquire_frame(i, j, x, y, j == len(positions)-1)
+                if self.pipeline is not None:
+                    if j+1 < len(positions):
+                        self.pipeline.start_move(*positions[j+1])
+                    elif i+1 < len(self.sections):
+                        nx, ny = self.sections[i+1]
+                        self.pipeline.start_move(*grid_frame_positions(nx, ny, self.workload.mx, self.workload.my,
+                                                                        10.0, fw, fh)[0])
+                    with self.trace.span(trace.QUEUE_PUT):
+                        self.pipeline.flush(self.dataQueue)
+                frames += 1
+        if self.pipeline is not None:
+            self.pipeline.finish(self.dataQueue)
+        acquire_time = time.time() - t0
+
+        save_pool.stop()
+        save_rss = max(rss_queue.get() for p in range(save_pool.workers))
+        self.save_trace_paths = [save_pool.worker_trace_path(k) for k in range(save_pool.workers)]
+        total_time = time.time() - t0
+        self.trace.close()
+        if self.workload.hardware_trigger:
+            self.imgSrc.stop_hardware_triggering()
+
+        if not self.messageQueue.empty():
+            raise RuntimeError("save process failed: {}".format(self.messageQueue.get()[1]))
+
+        images = len(self.ready_times)
+        result = {
+            'frames': frames,
+            'images': images,
+            'acquire_time': acquire_time,
+            'total_time': total_time,
+            'frames_per_s': frames/total_time,
+            'images_per_s': images/total_time,
+            'save_peak_rss_mb': save_rss,
+            'save_queue': self.dataQueue.metrics,
+            'compression': save_pool.compression_stats.summary,
+        }
+        result.update(self.save_latency())
+        return result
+
+    def save_latency(self):
+        """ Time from each image being acquired to its tif being written.  The
+                save queue is first in first out, so the n-th image acquired is
+                the n-th one started.  With several save workers writes can
+                finish out of order, so this is approximate.
+        """
+        writes = []
+        for path in self.save_trace_paths:
+            writes += [s for s in trace.load_trace(path) if s[0] == trace.DISK_WRITE]
+        writes.sort(key=lambda s: s[3])
+        ends = np.array([s[3] + s[4] for s in writes])
+        latency = ends - np.array(self.ready_times[:len(ends)])
+        result = {'save_latency_mean': float(latency.mean()),
+                  'save_latency_max': float(latency.max())}
+        for p in PERCENTILES:
+            result['save_latency_p%d' % p] = float(np.percentile(latency, p))
+        return result
+
+
+def run_workload(workload, settings):
+    """ Runs a single workload in a scratch directory.
+    """
+    outdir = tempfile.mkdtemp(prefix="mp_bench_", dir=settings['scratch'])
+    try:
+        imgSrc = ImageSource(None)
+        specimen = RibbonSpecimen(n_sections=settings['sections'])
+        imgSrc.enable_simulation(TimingModel(time_scale=settings['time_scale']), specimen,
+                                 sensor_size=(settings['sensor'], settings['sensor']))
+        imgSrc.set_binning(1)
+        imgSrc.set_hardware_autofocus_state(True)
+        acq = HeadlessAcquisition(imgSrc, outdir, workload, specimen.section_centers(),
+                                  exposure=settings['exposure'],
+                                  pipelined=settings['pipelined'],
+                                  adaptive_autofocus=settings['adaptive_autofocus'],
+                                  save_queue={'budget': int(settings['save_budget']*1024**2),
+                                              'policy': settings['save_policy'],
+                                              'ring_slots': settings['ring_slots']},
+                                  save_workers=settings['save_workers'],
+                                  container=settings['container'],
+                                  metadata_table=settings['metadata_table'],
+                                  compression=Compressor(settings['compression'], settings['compression_level'],
+                                                         settings['adaptive_compression']),
+                                  focus_store=settings['focus_store'],
+                                  thumbnail_bins=settings['thumbnail_bins'],
+                                  publisher=FramePublisher(max_rate=settings['publish_rate'],
+                                                           encoding=settings['publish_encoding'])
+                                  if settings['publish_rate'] is not None else None)
+        result = acq.run()
+        result['bytes_written'], result['files_written'] = directory_size(outdir)
+        result['peak_rss_mb'] = peak_rss_mb()
+        if settings['keep']:
+            result['outdir'] = outdir
+        return result
+    finally:
+        if not settings['keep']:
+            shutil.rmtree(outdir, ignore_errors=True)
+
+
+def _run_workload_process(workload, settings, result_queue):
+    try:
+        result_queue.put(run_workload(workload, settings))
+    except Exception as e:
+        result_queue.put({'error': repr(e)})
+
+
+def run_isolated(workload, settings):
+    """ Runs a workload in its own process so peak RSS is its own.
+    """
+    result_queue = mp.Queue()
+    p = mp.Process(target=_run_workload_process, args=(workload, settings, result_queue))
+    p.start()
+    result = result_queue.get()
+    p.join()
+    result['workload'] = workload._asdict()
+    result['name'] = workload.name
+    return result
+
+
+def code_version():
+    try:
+        here = os.path.dirname(os.path.abspath(__file__))
+        return subprocess.check_output(["git", "describe", "--always", "--dirty"], cwd=here).strip()
+    except Exception:
+        return "unknown"
+
+
+def compression_ratio(result):
+    stats = result['compression'].values()
+    stored = sum(s['stored_bytes'] for s in stats)
+    return sum(s['raw_bytes'] for s in stats)/float(stored) if stored else 0.0
+
+
+def print_results(results):
+    print("{:<18}{:>8}{:>10}{:>12}{:>12}{:>10}{:>10}{:>12}{:>12}{:>8}".format(
+        "workload", "images", "frames/s", "latency p50", "latency p99", "RSS MB", "save MB", "written MB",
+        "blocked s", "ratio"))
+    for r in results:
+        if 'error' in r:
+            print("{:<18} FAILED: {}".format(r['name'], r['error']))
+            continue
+        print("{:<18}{:>8d}{:>10.2f}{:>12.3f}{:>12.3f}{:>10}{:>10}{:>12.1f}{:>12.2f}{:>8.2f}".format(
+            r['name'], r['images'], r['frames_per_s'], r['save_latency_p50'], r['save_latency_p99'],
+            "%.0f" % r['peak_rss_mb'] if r['peak_rss_mb'] else "-",
+            "%.0f" % r['save_peak_rss_mb'] if r['save_peak_rss_mb'] else "-",
+            r['bytes_written']/1024.0**2, r['save_queue']['blocked_time'], compression_ratio(r)))
+
+
+def compare_results(old, new):
+    """ Prints the change in throughput and latency for workloads in both runs.
+    """
+    old_results = dict((r['name'], r) for r in old['results'] if 'error' not in r)
+    print("\ncompared to {} ({}):".format(old.get('version'), old.get('timestamp')))
+    print("{:<18}{:>14}{:>14}{:>10}{:>14}".format("workload", "old frames/s", "new frames/s", "change", "latency p50"))
+    for r in new['results']:
+        o = old_results.get(r['name'])
+        if o is None or 'error' in r:
+            continue
+        change = 100.0*(r['frames_per_s'] - o['frames_per_s'])/o['frames_per_s']
+        lat = 100.0*(r['save_latency_p50'] - o['save_latency_p50'])/max(o['save_latency_p50'], 1e-9)
+        print("{:<18}{:>14.2f}{:>14.2f}{:>9.1f}%{:>13.1f}%".format(
+            r['name'], o['frames_per_s'], r['frames_per_s'], change, lat))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Headless acquisition benchmarks.")
+    parser.add_argument("--workload", action="append", help="only run these workloads (by name)")
+    parser.add_argument("--matrix", action="store_true", help="run every combination of mosaic/channels/z/trigger")
+    parser.add_argument("--list", action="store_true", help="list workloads and exit")
+    parser.add_argument("--sections", type=int, default=3, help="sections per workload")
+    parser.add_argument("--sensor", type=int, default=1024, help="simulated sensor size (pixels)")
+    parser.add_argument("--exposure", type=float, default=50.0, help="exposure time (ms)")
+    parser.add_argument("--time-scale", type=float, default=1.0, help="multiplies simulated scope latencies")
+    parser.add_argument("--pipelined", action="store_true", help="use pipelined acquisition")
+    parser.add_argument("--adaptive-autofocus", action="store_true", help="use adaptive autofocus settle detection")
+    parser.add_argument("--save-budget", type=float, default=2048, help="save queue budget (MB)")
+    parser.add_argument("--save-policy", default="block", choices=("block", "slow", "spill"),
+                        help="what the save queue does when saving falls behind")
+    parser.add_argument("--save-workers", type=int, default=1, help="number of save processes")
+    parser.add_argument("--container", action="store_true", help="save per channel containers instead of per-frame files")
+    parser.add_argument("--metadata-table", action="store_true",
+                        help="record metadata in one session table instead of a file per image")
+    parser.add_argument("--focus-store", action="store_true",
+                        help="keep focus scores in one session file instead of a file per image")
+    parser.add_argument("--thumbnails", default="",
+                        help="thumbnail pyramid to save with every image, eg. 2,4,8")
+    parser.add_argument("--publish-rate", type=float, default=None,
+                        help="publish saved images at up to this many per second, see FramePublisher.py")
+    parser.add_argument("--publish-encoding", default="raw", choices=("raw", "jpeg"),
+                        help="how published images are encoded")
+    parser.add_argument("--compression", default="none", choices=CODECS, help="compress saved images")
+    parser.add_argument("--compression-level", type=int, default=6, help="compression level")
+    parser.add_argument("--adaptive-compression", action="store_true",
+                        help="lower the compression level when the save queue backs up")
+    parser.add_argument("--ring-slots", type=int, default=0,
+                        help="pass frames to the save process through shared memory, see FrameRing.py")
+    parser.add_argument("--scratch", default=None, help="directory to write data to (default: temp dir)")
+    parser.add_argument("--keep", action="store_true", help="keep the acquired data")
+    parser.add_argument("--output", help="json file to save results to")
+    parser.add_argument("--compare", help="earlier results json to compare against")
+    args = parser.parse_args()
+
+    workloads = workload_matrix() if args.matrix else WORKLOADS
+    if args.workload:
+        workloads = [w for w in workloads if w.name in args.workload]
+    if args.list or not workloads:
+        for w in (workloads or WORKLOADS):
+            print(w.name)
+        return
+
+    settings = {
+        'sections': args.sections,
+        'sensor': args.sensor,
+        'exposure': args.exposure,
+        'time_scale': args.time_scale,
+        'pipelined': args.pipelined,
+        'adaptive_autofocus': args.adaptive_autofocus,
+        'save_budget': args.save_budget,
+        'save_policy': args.save_policy,
+        'ring_slots': args.ring_slots,
+        'save_workers': args.save_workers,
+        'container': args.container,
+        'metadata_table': args.metadata_table,
+        'focus_store': args.focus_store,
+        'publish_rate': args.publish_rate,
+        'publish_encoding': args.publish_encoding,
+        'thumbnail_bins': [int(bin) for bin in args.thumbnails.split(',') if bin],
+        'compression': args.compression,
+        'compression_level': args.compression_level,
+        'adaptive_compression': args.adaptive_compression,
+        'scratch': args.scratch,
+        'keep': args.keep,
+    }
+    results = []
+    for w in workloads:
+        print("running {}...".format(w.name))
+        results.append(run_isolated(w, settings))
+
+    report = {
+        'version': code_version(),
+        'timestamp': time.strftime("%Y-%m-%d %H:%M:%S"),
+        'platform': platform.platform(),
+        'python': platform.python_version(),
+        'settings': settings,
+        'results': results,
+    }
+    print_results(results)
+    if args.compare:
+        with open(args.compare, 'r') as f:
+            compare_results(json.load(f), report)
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
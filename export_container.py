@@ -0,0 +1,149 @@
+"""
+export_container.py
+
+Exports a session saved as containers (see SessionContainer.py) to the
+    per-frame layout: a tif plus _metadata.txt, _focus.csv and _afc.json
+    sidecars for every image, exactly as the save process would have written
+    them.
+
+    $ python export_container.py C:/data/session1
+    $ python export_container.py C:/data/session1 --output D:/export --channel DAPI
+
+For sessions saved as per-frame tifs with a metadata table, --metadata-only
+    regenerates just the _metadata.txt files.
+
+    $ python export_container.py C:/data/session1 --metadata-only
+
+Likewise --afc-only writes the _afc.json files of a session that kept its AFC
+    profiles in an AfcStore.
+
+    $ python export_container.py C:/data/session1 --afc-only
+
+The per-frame files go in <output>/<channel>/, output defaults to the session
+    directory.
+
+"""
+import os
+import argparse
+import itertools
+
+import tifffile
+
+import SessionContainer
+import AfcStore
+from SaveThread import write_frame_files, write_slice_metadata, write_afc_image
+
+
+def export_session(session_dir, output_dir=None, prot_names=None):
+    """ Writes every image in a container session as per-frame files.
+
+        Args:
+            session_dir (str): directory with the container index
+            output_dir (Optional[str]): where to export to, defaults to
+                `session_dir`
+            prot_names (Optional[list]): only export these channels
+
+        Returns:
+            int: number of images exported
+    """
+    output_dir = output_dir or session_dir
+    metadata = SessionContainer.load_metadata(session_dir)
+    rows = SessionContainer.load_index(session_dir).values()
+    if prot_names:
+        rows = [row for row in rows if row['prot_name'] in prot_names]
+
+    afc_profiles = {}
+    if os.path.isfile(os.path.join(session_dir, AfcStore.AFC_INDEX_FILE)):
+        index, profiles = AfcStore.load_afc_profiles(session_dir)
+        for entry, profile in zip(index, profiles):
+            key = (entry['section'], entry['frame'], entry['z_index'], entry['prot_name'])
+            afc_profiles[key] = profile[:entry['length']]
+
+    # read each container once, page by page
+    rows.sort(key=lambda row: (row['file'], row['page']))
+    exported = 0
+    for filename, file_rows in itertools.groupby(rows, key=lambda row: row['file']):
+        with tifffile.TiffFile(os.path.join(session_dir, filename)) as tif:
+            for row in file_rows:
+                path = os.path.join(output_dir, row['prot_name'])
+                if not os.path.isdir(path):
+                    os.makedirs(path)
+                afc_image = None
+                if row['afc_file']:
+                    # AFC profiles are 1d, they are stored as one row images
+                    afc_image = SessionContainer.read_page(session_dir, row['afc_file'], row['afc_page']).ravel()
+                else:
+                    afc_image = afc_profiles.get((row['section'], row['frame'], row['z_index'], row['prot_name']))
+                token = (row['section'], row['frame'], row['z_index'], row['prot_name'], path,
+                         tif.pages[row['page']].asarray(), row['channel'], row['x'], row['y'], row['z'],
+                         row['triggerflag'], row['focus_mean'] is not None, afc_image)
+                write_frame_files(token, metadata)
+                exported += 1
+    return exported
+
+
+def export_metadata(session_dir, output_dir=None, prot_names=None):
+    """ Writes the legacy _metadata.txt for every image in the session index.
+
+        Returns:
+            int: number of files written
+    """
+    output_dir = output_dir or session_dir
+    metadata = SessionContainer.load_metadata(session_dir)
+    exported = 0
+    for row in SessionContainer.load_index(session_dir).values():
+        if prot_names and row['prot_name'] not in prot_names:
+            continue
+        path = os.path.join(output_dir, row['prot_name'])
+        if not os.path.isdir(path):
+            os.makedirs(path)
+        filename = os.path.join(path, row['prot_name'] + "_S%04d_F%04d_Z%02d_metadata.txt" % (
+            row['section'], row['frame'], row['z_index']))
+        write_slice_metadata(filename, row['channel'], row['x'], row['y'], row['z'], row['section'],
+                             row['triggerflag'], metadata)
+        exported += 1
+    return exported
+
+
+def export_afc(session_dir, output_dir=None):
+    """ Writes the legacy _afc.json for every profile in the session's
+            AfcStore.
+
+        Returns:
+            int: number of files written
+    """
+    output_dir = output_dir or session_dir
+    index, profiles = AfcStore.load_afc_profiles(session_dir)
+    for entry, profile in zip(index, profiles):
+        path = os.path.join(output_dir, entry['prot_name'])
+        if not os.path.isdir(path):
+            os.makedirs(path)
+        filename = os.path.join(path, entry['prot_name'] + "_S%04d_F%04d_Z%02d_afc.json" % (
+            entry['section'], entry['frame'], entry['z_index']))
+        write_afc_image(filename, profile[:entry['length']], float(entry['x']), float(entry['y']),
+                        int(entry['section']), int(entry['frame']))
+    return len(index)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Export a container session to per-frame files.")
+    parser.add_argument("session", help="session directory")
+    parser.add_argument("--output", help="directory to export to (default: the session directory)")
+    parser.add_argument("--channel", action="append", help="only export these channels (protocol names)")
+    parser.add_argument("--metadata-only", action="store_true", help="only write the _metadata.txt files")
+    parser.add_argument("--afc-only", action="store_true", help="only write the _afc.json files")
+    args = parser.parse_args()
+
+    if args.afc_only:
+        exported = export_afc(args.session, args.output)
+        print("wrote {} AFC files".format(exported))
+    elif args.metadata_only:
+        exported = export_metadata(args.session, args.output, args.channel)
+        print("wrote {} metadata files".format(exported))
+    else:
+        exported = export_session(args.session, args.output, args.channel)
+        print("exported {} images".format(exported))
+
+
+if __name__ == '__main__':
+    main()
@@ -1,14 +1,19 @@
 import numpy as np
 import time
 from Rectangle import Rectangle
-import wx
+try:
+    import wx
+except ImportError:
+    wx = None  # headless, eg acquisition_benchmark.py
+from ScopeSimulator import TimingModel, RibbonSpecimen, wait_until
 
 class ImageSource():
     
     def __init__(self,configFile,channelGroupName='Channels',
                  use_focus_plane  = False, focus_points=None,
                  transpose_xy = False, logfile='MP_MM.txt',
-                 MasterArduinoPort = None, interframe_time= 10, filtswitch = None):
+                 MasterArduinoPort = None, interframe_time= 10, filtswitch = None,
+                 use_device_cache = True):
       #NEED TO IMPLEMENT IF NOT MICROMANAGER
      
       self.x = 0
@@ -21,6 +26,37 @@ class ImageSource():
       self.exposure_times = []
       self.offset = 0
       self.use_focus_plane = False
+      self.transpose_xy = transpose_xy
+      self.plane_tuple = None
+      self.channel = None
+      self.sensor_size = (2048,2048)
+
+      # simulated timing and images, off unless enable_simulation is called
+      self.timing = None
+      self.specimen = None
+      self._stage_ready = 0.0
+      self._af_ready = 0.0
+      self._sequence_index = 0
+
+    def enable_simulation(self,timing=None,specimen=None,sensor_size=None):
+        """ Makes the demo source behave like a real scope: every call takes as
+                long as the timing model says, and images are rendered from a
+                synthetic ribbon instead of being random noise.
+
+            Args:
+                timing (Optional[ScopeSimulator.TimingModel]): latencies to use
+                specimen (Optional[ScopeSimulator.RibbonSpecimen]): what to image
+                sensor_size (Optional[tuple]): (width,height) in pixels, smaller
+                    sensors render faster
+        """
+        self.timing = timing if timing is not None else TimingModel()
+        self.specimen = specimen if specimen is not None else RibbonSpecimen()
+        if sensor_size is not None:
+            self.sensor_size = tuple(sensor_size)
+
+    @property
+    def simulated(self):
+        return self.timing is not None
 
     @property
     def objective(self):
@@ -83,7 +119,7 @@ class ImageSource():
         self.exposure_times = exposure_times
         
     def startHardwareSequence(self):
-        pass
+        self._sequence_index = 0
 
     def set_binning(self,bin=1):
         self.binning = bin
@@ -123,13 +159,20 @@ class ImageSource():
         pass
 
     def is_hardware_autofocus_done(self):
+        if self.simulated:
+            return self.hardware_autofocus_state and time.time() >= self._af_ready
         return self.hardware_autofocus_state
         
 
     def take_hardware_snap(self):     
         images = []
-        for ch in self.channels:
-            images.append(np.random(self.get_sensor_size()))
+        for ch,exp in zip(self.channels,self.exposure_times):
+            if self.simulated:
+                done = time.time() + self.timing.snap_time(exp)
+                images.append(self.render_image(ch,exp))
+                wait_until(done)
+            else:
+                images.append(self.make_random_image())
         return images
 
 
@@ -192,7 +235,7 @@ class ImageSource():
         metadata=None
         return data,bbox
 
-    def set_xy(self,x,y,use_focus_plane=False):
+    def set_xy(self,x,y,use_focus_plane=False,wait=True):
         flipx,flipy = self.get_xy_flip()
 
         if use_focus_plane:
@@ -207,8 +250,14 @@ class ImageSource():
         #if flipy == 1:
         #    y = -y
         
+        if self.simulated:
+            start = max(time.time(),self._stage_ready)
+            self._stage_ready = start + self.timing.xy_move_time(x-self.x,y-self.y)
+            self._af_ready = self._stage_ready + self.timing.autofocus_time()
         self.x = x
         self.y = y
+        if wait:
+            self.wait_for_stage()
         #print self.get_xy()
         
 
@@ -239,6 +288,8 @@ class ImageSource():
     def get_z(self):
         return self.z
     def set_z(self,z):
+        if self.simulated:
+            wait_until(time.time() + self.timing.z_move_time(z-self.z))
         self.z = z
         
     def get_pixel_size(self):
@@ -250,6 +301,16 @@ class ImageSource():
         return np.random.randint(0,2**16 - 1,self.get_sensor_size(),np.uint16)
 
     def get_image(self,wait=True):
+        if self.simulated:
+            if not self.channels:
+                return self.snap_image()
+            #hardware triggered sequences cycle through the channels without switching
+            k = self._sequence_index % len(self.channels)
+            self._sequence_index += 1
+            done = time.time() + self.timing.snap_time(self.exposure_times[k])
+            data = self.render_image(self.channels[k],self.exposure_times[k])
+            wait_until(done)
+            return data
         return self.make_random_image()
 
     def get_frame_size_um(self):
@@ -281,10 +342,38 @@ class ImageSource():
         
     #@retry(tries= 5)
     def snap_image(self):
+        if self.simulated:
+            done = time.time() + self.timing.snap_time(self.exposure)
+            data = self.render_image(self.channel,self.exposure)
+            wait_until(done)
+            return data
         data = self.make_random_image()
         data = self.flip_image(data)
         return data
 
+    def render_image(self,channel,exposure):
+        """ Renders the simulated specimen under the current field of view, in
+                the same orientation snap_image would return it.
+        """
+        (fw,fh) = self.get_frame_size_um()
+        pixsize = self.get_pixel_size()
+        (x,y) = self.get_xy()
+        channels = self.get_channels()
+        chan_index = channels.index(channel) if channel in channels else 0
+        z = None if self.hardware_autofocus_state else self.z
+        data = self.specimen.render(x-fw/2,y-fh/2,pixsize,
+                                    (int(round(fh/pixsize)),int(round(fw/pixsize))),
+                                    channel=chan_index,z=z,exposure=exposure)
+        #undo what flip_image is about to do, so the result is in stage coordinates
+        (flipx,flipy,trans) = self.get_image_flip()
+        if flipy:
+            data=np.flipud(data)
+        if flipx:
+            data=np.fliplr(data)
+        if trans:
+            data = np.transpose(data)
+        return self.flip_image(data)
+
 
     def flip_image(self,data):
 
@@ -301,16 +390,27 @@ class ImageSource():
     
     def get_sensor_size(self):
         #return the height and width in pixels
-        return (2048,2048)
+        return self.sensor_size
         
     def move_stage(self,x,y):
         #need to implement if not MICROMANAGER
         #move the stage to position x,y
 
         self.set_xy(x,y)
-        
-        
+
+    def start_move_stage(self,x,y):
+        self.set_xy(x,y,wait=False)
+
+    def wait_for_stage(self):
+        wait_until(self._stage_ready)
+
+    def is_stage_busy(self):
+        return time.time() < self._stage_ready
+
+
     def set_channel(self,channel):
+        if self.simulated and channel != self.channel:
+            time.sleep(self.timing.channel_switch_time())
         self.channel = channel
         
     def get_channels(self):
@@ -374,6 +474,18 @@ class ImageSource():
 
     def get_autofocus_offset(self):
         return self.offset
+
+    def get_focus_score(self):
+        if self.simulated:
+            #the focus score falls to zero as the autofocus settles
+            return 20.0*max(self._af_ready-time.time(),0)
+        return 0.0
+
+    def invalidate_device_cache(self,*keys):
+        pass
+
+    def get_device_cache_stats(self):
+        return {'total': 0, 'invalidations': 0}
         
     def shutdown(self):
         pass
@@ -7,16 +7,20 @@ import wx
 import datetime
 import os
 from MMArduino import MMArduino
+import DeviceStateCache as dsc
 
 class ImageSource():
     
     def __init__(self,configFile,channelGroupName='Channels',
                  use_focus_plane  = False, focus_points=None,
                  transpose_xy = False, logfile='MP_MM.txt',
-                 MasterArduinoPort = None, interframe_time= 10, filtswitch = None):
+                 MasterArduinoPort = None, interframe_time= 10, filtswitch = None,
+                 use_device_cache = True):
       #NEED TO IMPLEMENT IF NOT MICROMANAGER
      
         self.configFile=configFile
+        # write-through cache of channel/exposure/binning/flip/z, see DeviceStateCache.py
+        self.device_cache = dsc.DeviceStateCache(enabled=use_device_cache)
         self.mmc = MMCorePy.CMMCore() 
         self.mmc.enableStderrLog(False)
         self.mmc.enableDebugLog(True)
@@ -117,6 +121,7 @@ class ImageSource():
 
                 if islocked:
                     self.mmc.enableContinuousFocus(True)
+                self.invalidate_device_cache(dsc.Z)
 
     def define_focal_plane(self,points):
         if points.shape[1]>3:
@@ -154,6 +159,7 @@ class ImageSource():
         self.mmc.stopSequenceAcquisition()
         self.mmc.setConfig('Triggering','Software')
         self.mmc.setConfig('Triggering','Software')
+        self.invalidate_device_cache(dsc.CHANNEL, dsc.EXPOSURE)
 
     def is_hardware_triggering(self):
         if self.mmc.getCurrentConfig('Triggering') == 'Hardware':
@@ -162,6 +168,8 @@ class ImageSource():
             return False
 
     def setup_hardware_triggering(self,channels,exposure_times):
+        #sequencing changes the channel properties behind our back
+        self.invalidate_device_cache(dsc.CHANNEL, dsc.EXPOSURE)
 
         #set up triggering to "Hardware" to load all the
         self.mmc.setConfig('Triggering','Hardware')
@@ -218,20 +226,28 @@ class ImageSource():
         self.masterArduino.startTimedPattern()
 
     def set_binning(self,bin=1):
+        if self.device_cache.matches(dsc.BINNING,bin):
+            return
         cam = self.mmc.getCameraDevice()
         binstring = "%dx%d"%(bin,bin)
         self.mmc.setProperty(cam,'Binning',binstring)
+        self.device_cache.store(dsc.BINNING,bin)
 
     def get_binning(self):
+        cached,bin = self.device_cache.lookup(dsc.BINNING)
+        if cached:
+            return bin
         cam = self.mmc.getCameraDevice()
         binstring = self.mmc.getProperty(cam,'Binning')
         (bx,by)=binstring.split('x')
+        self.device_cache.store(dsc.BINNING,int(bx))
         return int(bx)
 
     def image_based_autofocus(self,chan=None):
         if chan is not None:
             self.set_channel(chan)
         self.mmc.fullFocus()
+        self.invalidate_device_cache(dsc.Z)
         return self.mmc.getLastFocusScore()
 
     def get_max_pixel_value(self):
@@ -239,27 +255,41 @@ class ImageSource():
         return np.power(2,bit_depth)-1
 
     def get_exposure(self):
-        return self.mmc.getExposure()
+        cached,exp_msec = self.device_cache.lookup(dsc.EXPOSURE)
+        if cached:
+            return exp_msec
+        exp_msec = self.mmc.getExposure()
+        self.device_cache.store(dsc.EXPOSURE,exp_msec)
+        return exp_msec
 
     def set_exposure(self,exp_msec):
       #NEED TO IMPLEMENT IF NOT MICROMANAGER
+        if self.device_cache.matches(dsc.EXPOSURE,exp_msec):
+            return
         self.mmc.setExposure(exp_msec)
+        self.device_cache.store(dsc.EXPOSURE,exp_msec)
     
 
     def reset_focus_offset(self):
         if self.has_hardware_autofocus():
             focusDevice=self.mmc.getAutoFocusDevice()
             self.mmc.setProperty(focusDevice,"CRISP State","Reset Focus Offset")
+            self.invalidate_device_cache(dsc.Z,dsc.AUTOFOCUS)
   
     def get_hardware_autofocus_state(self):
         if self.has_hardware_autofocus():
-            return self.mmc.isContinuousFocusEnabled()
+            state = self.mmc.isContinuousFocusEnabled()
+            self.device_cache.store(dsc.AUTOFOCUS,state)
+            return state
            
     def set_hardware_autofocus_state(self,state,dowait=True):
         if self.has_hardware_autofocus():
             self.mmc.enableContinuousFocus(state)
             if dowait:
                 self.mmc.waitForDevice(self.mmc.getAutoFocusDevice())
+            #z is only cached while we know the autofocus isn't moving it
+            self.invalidate_device_cache(dsc.Z)
+            self.device_cache.store(dsc.AUTOFOCUS,bool(state))
         
     def has_hardware_autofocus(self):
         #NEED TO IMPLEMENT IF NOT MICROMANAGER
@@ -372,8 +402,12 @@ class ImageSource():
 
 
     def get_xy_flip(self):
+        cached,flip = self.device_cache.lookup(dsc.XY_FLIP)
+        if cached:
+            return flip
         flipx=int(self.mmc.getProperty(self.stage,"TransposeMirrorX"))==1
         flipy=int(self.mmc.getProperty(self.stage,"TransposeMirrorY"))==1
+        self.device_cache.store(dsc.XY_FLIP,(flipx,flipy))
 
         return flipx,flipy
     def get_xy(self):
@@ -394,12 +428,23 @@ class ImageSource():
 
         return (x,y)
 
+    def _z_cacheable(self):
+        #the autofocus moves z on its own, so only trust the cache when it is known to be off
+        return self.device_cache.peek(dsc.AUTOFOCUS) is False
+
     def get_z(self):
+        if self._z_cacheable():
+            cached,z = self.device_cache.lookup(dsc.Z)
+            if cached:
+                return z
         return self.mmc.getPosition(self.objective)
 
     def set_z(self,z):
+        if self._z_cacheable() and self.device_cache.matches(dsc.Z,z):
+            return
         self.mmc.setPosition (self.objective,z)
         self.mmc.waitForDevice(self.objective)
+        self.device_cache.store(dsc.Z,z)
         
     def get_pixel_size(self):
         #NEED TO IMPLEMENT IF NOT MICROMANAGER
@@ -495,9 +540,21 @@ class ImageSource():
         #move the stage to position x,y
 
         self.set_xy(x,y)
-        
-        
+
+    def start_move_stage(self,x,y):
+        #start moving the stage to x,y but don't wait for it to get there
+        self.set_xy_new(x,y)
+
+    def wait_for_stage(self):
+        self.mmc.waitForDevice(self.stage)
+
+    def is_stage_busy(self):
+        return self.mmc.deviceBusy(self.stage)
+
+
     def set_channel(self,channel):
+        if self.device_cache.matches(dsc.CHANNEL,channel):
+            return
         if channel not in self.get_channels():
             print "no such channel:" + channel
             return False
@@ -505,9 +562,15 @@ class ImageSource():
         self.mmc.setConfig(self.channelGroupName,channel)
         self.mmc.waitForConfig(self.channelGroupName,channel)
         self.mmc.setShutterOpen(False)
+        self.device_cache.store(dsc.CHANNEL,channel)
         
     def get_channels(self):
-        return self.mmc.getAvailableConfigs(self.channelGroupName)
+        cached,channels = self.device_cache.lookup(dsc.CHANNELS)
+        if cached:
+            return channels
+        channels = self.mmc.getAvailableConfigs(self.channelGroupName)
+        self.device_cache.store(dsc.CHANNELS,channels)
+        return channels
         
     def take_best_of_stack(self):
         print "need to implement take best of stack"
@@ -518,16 +581,32 @@ class ImageSource():
     def get_image_flip(self):
         #when take_image returns an image
         #which way is up?
+        cached,flip = self.device_cache.lookup(dsc.IMAGE_FLIP)
+        if cached:
+            return flip
         
         cam=self.mmc.getCameraDevice()
         flip_x = int(self.mmc.getProperty(cam,"TransposeMirrorX"))==1
         flip_y = int(self.mmc.getProperty(cam,"TransposeMirrorY"))==1
         trans = int(self.mmc.getProperty(cam,"TransposeXY"))==1
+        self.device_cache.store(dsc.IMAGE_FLIP,(flip_x,flip_y,trans))
 
         return (flip_x,flip_y,trans)
 
+    def invalidate_device_cache(self,*keys):
+        """ Forgets cached device state, call this after changing the hardware
+                outside of this class.  With no keys everything is forgotten.
+        """
+        self.device_cache.invalidate(*keys)
+
+    def get_device_cache_stats(self):
+        """ Device round trips saved by the device state cache, per setting.
+        """
+        return self.device_cache.stats
+
     def move_safe_and_focus(self,x,y): #MultiRibbons
         #lower objective, move the stage to position x,y
+        self.invalidate_device_cache(dsc.Z,dsc.AUTOFOCUS)
         focus_stage = self.objective
         #self.mmc.setRelativePosition(focus_stage,-3000.0)
         for j in range(300): #use small z steps to lower objective slowly
@@ -566,6 +645,7 @@ class ImageSource():
 
         low = -search_range/2
         high = search_range/2
+        self.invalidate_device_cache(dsc.Z,dsc.AUTOFOCUS)
         focus_stage=self.objective
         original_position=self.mmc.getPosition(focus_stage)
 
@@ -596,6 +676,7 @@ class ImageSource():
 
     def attempt_focus(self, settle_time=1.0):
         self.mmc.enableContinuousFocus(True)
+        self.invalidate_device_cache(dsc.Z,dsc.AUTOFOCUS)
         #self.mmc.waitForDevice(self.mmc.getAutoFocusDevice())
         time.sleep(settle_time)
         if self.mmc.isContinuousFocusEnabled():
@@ -633,12 +714,18 @@ class ImageSource():
         if self.has_hardware_autofocus():
             self.mmc.setAutoFocusOffset(offset)
             self.mmc.waitForDevice(self.hw_autofocus)
+            self.invalidate_device_cache(dsc.Z)
 
     def get_autofocus_offset(self):
         if self.has_hardware_autofocus():
             return self.mmc.getAutoFocusOffset()
+
+    def get_focus_score(self):
+        if self.has_hardware_autofocus():
+            return self.mmc.getCurrentFocusScore()
     
     def shutdown(self):
         self.mmc.unloadAllDevices()
+        self.invalidate_device_cache()
 
 imageSource = ImageSource  #DW: i fixed the name but wanted to preserve backwards compatibility
\ No newline at end of file
@@ -41,6 +41,37 @@ def make_thumbnail(img, bin=2, autoscale=True):
         img = image_16bit_to_8bit(img, autoscale=autoscale)
     return img
 
+def bin_image(img, bin=2, dtype=None):
+    """ Bins an image by averaging `bin` x `bin` blocks.  Rows and columns that
+        don't fill a block are dropped.
+
+    args:
+        img (numpy.ndarray): 2d image data
+        bin (int): binning
+        dtype (Optional[numpy.dtype]): dtype of the binned image, default is
+            the dtype of `img`.  Means are rounded to nearest for integers.
+
+    returns:
+        numpy.ndarray: binned image
+
+    """
+    dtype = np.dtype(dtype or img.dtype)
+    bin = max(int(bin), 1)
+    rows, cols = img.shape[0]//bin, img.shape[1]//bin
+    img = img[:rows*bin, :cols*bin]
+    # adding strided slices is several times faster than a reshaped sum
+    integer = img.dtype in (np.uint8, np.uint16)
+    sums = np.zeros((rows, cols), np.uint32 if integer else np.float64)
+    for i in range(bin):
+        for j in range(bin):
+            sums += img[i::bin, j::bin]
+    if integer and np.issubdtype(dtype, np.integer):
+        return ((sums + bin*bin//2)//(bin*bin)).astype(dtype)
+    means = sums/float(bin*bin)
+    if np.issubdtype(dtype, np.integer):
+        means = np.rint(means)
+    return means.astype(dtype)
+
 def get_focus_score(img):
     """ Olga's focus scoring algorithm.
     """
@@ -75,6 +75,10 @@ class RemoteInterface(Publisher):
     @pause.setter
     def pause(self, value):
         self._pause = value
+        if value:
+            self.parent.pause_acquisition()
+        else:
+            self.parent.resume_acquisition()
 
     def _check_rep(self):
         """ Checks replay socket.  Mosaic Planner calls this periodically to process
@@ -146,7 +150,10 @@ class RemoteInterface(Publisher):
 
     def set_objective_property(self, property, value):
         objective = self.parent.imgSrc.objective
-        return self.parent.imgSrc.mmc.setProperty(objective, str(property), value)
+        result = self.parent.imgSrc.mmc.setProperty(objective, str(property), value)
+        # eg. the objective's position, which the image source caches
+        self.parent.imgSrc.invalidate_device_cache()
+        return result
 
     def set_objective_vel(self, vel):
         """ Sets objective move speed
@@ -168,6 +175,14 @@ class RemoteInterface(Publisher):
         """
         return self.parent.get_remaining_time()
 
+    def get_remaining_time_estimate(self):
+        """ Returns remaining acquisition time with a confidence interval.
+
+        Returns:
+            dict: `seconds`, `low`, `high`, `confidence` and `frames`
+        """
+        return self.parent.get_remaining_time_estimate()
+
     def get_current_acquisition_settings(self):
         """ Gets the current imaging session metadata.
 
@@ -357,11 +372,62 @@ class RemoteInterface(Publisher):
         return self.parent._is_acquiring
 
     def start_acquisition(self, data_dir=""):
+        """ Starts an acquisition.  Returns right away, the acquisition runs
+                on its own thread.  Progress is published as
+                `acquisition_event`/`acquisition_status` messages and can be
+                polled with `get_acquisition_status`.
+        """
         if self.is_acquiring:
             raise Exception("MosaicPlanner is already acquiring!")
-        self._rep_sock.send_json(True)
-        self.parent._is_acquiring = True
-        self.parent.on_run_acq(data_dir)
+        self._pause = False
+        return self.parent.on_run_acq(data_dir)
+
+    def pause_acquisition(self):
+        self._pause = True
+        self.parent.pause_acquisition()
+
+    def resume_acquisition(self):
+        self._pause = False
+        self.parent.resume_acquisition()
+
+    def abort_acquisition(self):
+        self.parent.abort_acquisition()
+
+    def get_save_queue_metrics(self):
+        """ Gets save queue depth, bytes in flight and time spent blocked.
+        """
+        return self.parent.get_save_queue_metrics()
+
+    def get_save_progress(self):
+        """ Gets how many images are on disk, how many failed, and how far
+                into the acquisition everything has been saved.
+        """
+        return self.parent.get_save_progress()
+
+    def is_frame_saved(self, slice_index, frame_index, z_index, ch):
+        return self.parent.is_frame_saved(slice_index, frame_index, z_index, ch)
+
+    def get_storage_status(self):
+        """ Gets free space, write throughput and how much of the
+                acquisition is still to be written, see StorageMonitor.py.
+        """
+        return self.parent.get_storage_status()
+
+    def get_saved_thumbnail(self, slice_index, frame_index, ch, bin=8, z_index=0):
+        """ Gets a binned copy of a saved image, see ThumbnailPyramid.py.
+
+        Returns:
+            numpy.ndarray: the thumbnail, None if the image doesn't have one
+        """
+        return self.parent.get_saved_thumbnail(slice_index, frame_index, ch, bin, z_index)
+
+    def get_acquisition_status(self):
+        """ Gets the state and progress of the current (or last) acquisition.
+
+        Returns:
+            dict: `state`, `value`, `max_val`, `message`, `elapsed` and `error`
+        """
+        return self.parent.get_acquisition_status()
 
     def check_bubbles(self, img_folder):
         """ Checks for bubbles in the images in specified folder.
@@ -0,0 +1,129 @@
+"""
+save_transport_benchmark.py
+
+Compares the two ways of getting frames from the acquisition to the save
+    process: pickling them through the SaveQueue's mp.Queue, and copying them
+    into a shared memory FrameRing (see FrameRing.py) with only a descriptor
+    going through the queue.
+
+    $ python save_transport_benchmark.py --frames 200 --size 2048 --slots 8
+
+For each transport it reports frames/s and MB/s from the first put to the
+    save process having seen every frame, the time the acquisition spends in
+    `put`, and CPU time used by each side.  The save process checks every
+    frame arrived intact but doesn't write anything, so this is the transport
+    alone.
+
+"""
+import os
+import json
+import time
+import argparse
+import multiprocessing as mp
+
+import numpy as np
+
+from Tokens import STOP_TOKEN
+from SaveQueue import SaveQueue
+from FrameRing import FrameRing
+
+
+def cpu_time():
+    t = os.times()
+    return t[0] + t[1]
+
+
+def _consumer(queue, result_queue):
+    cpu0 = cpu_time()
+    frames = 0
+    bad = 0
+    while True:
+        token = queue.get()
+        if token == STOP_TOKEN:
+            queue.task_done()
+            break
+        data = token[5]
+        # every frame is stamped with its index
+        if data[0, 0] != token[1] % 65536 or data[-1, -1] != 7:
+            bad += 1
+        frames += 1
+        queue.task_done()
+    result_queue.put({'frames': frames, 'bad_frames': bad, 'consumer_cpu': cpu_time() - cpu0,
+                      'done': time.time()})
+
+
+def run_transport(frames, size, slots):
+    """ Sends `frames` size x size uint16 frames to a save process.
+
+        Args:
+            slots (int): FrameRing slots, 0 to pickle everything
+
+        Returns:
+            dict: throughput and timing results
+    """
+    ring = FrameRing(slots=slots, slot_bytes=size*size*2) if slots else None
+    queue = SaveQueue(budget=64*size*size*2, ring=ring)
+    result_queue = mp.Queue()
+    consumer = mp.Process(target=_consumer, args=(queue, result_queue))
+    consumer.start()
+
+    template = np.random.randint(0, 4096, (size, size)).astype(np.uint16)
+    template[-1, -1] = 7
+    put_times = []
+    cpu0 = cpu_time()
+    t0 = time.time()
+    for i in range(frames):
+        # a fresh array every frame, like the camera gives us
+        data = template.copy()
+        data[0, 0] = i % 65536
+        t = time.time()
+        queue.put((0, i, 0, 'ch', '', data, 0, 0.0, 0.0, 0.0, False, False, None))
+        put_times.append(time.time() - t)
+    queue.put(STOP_TOKEN)
+    result = result_queue.get()
+    consumer.join()
+    producer_cpu = cpu_time() - cpu0
+
+    elapsed = result['done'] - t0
+    put_times = np.array(put_times)
+    result.update({
+        'transport': 'ring' if slots else 'pickle',
+        'slots': slots,
+        'elapsed': elapsed,
+        'frames_per_s': frames/elapsed,
+        'mb_per_s': frames*size*size*2/1024.0**2/elapsed,
+        'put_mean_ms': 1000*float(put_times.mean()),
+        'put_p99_ms': 1000*float(np.percentile(put_times, 99)),
+        'producer_cpu': producer_cpu,
+        'queue': queue.metrics,
+    })
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Save process transport benchmark.")
+    parser.add_argument("--frames", type=int, default=200, help="frames to send")
+    parser.add_argument("--size", type=int, default=2048, help="frame size (pixels)")
+    parser.add_argument("--slots", type=int, default=8, help="ring slots")
+    parser.add_argument("--output", help="json file to save results to")
+    args = parser.parse_args()
+
+    results = [run_transport(args.frames, args.size, 0),
+               run_transport(args.frames, args.size, args.slots)]
+
+    print("{:<10}{:>10}{:>10}{:>14}{:>14}{:>16}{:>16}{:>12}".format(
+        "transport", "frames/s", "MB/s", "put mean ms", "put p99 ms", "acq CPU s", "save CPU s", "overflows"))
+    for r in results:
+        print("{:<10}{:>10.1f}{:>10.0f}{:>14.2f}{:>14.2f}{:>16.2f}{:>16.2f}{:>12}".format(
+            r['transport'], r['frames_per_s'], r['mb_per_s'], r['put_mean_ms'], r['put_p99_ms'],
+            r['producer_cpu'], r['consumer_cpu'],
+            r['queue']['ring']['overflows'] if 'ring' in r['queue'] else "-"))
+        if r['bad_frames']:
+            print("  {} frames arrived corrupted!".format(r['bad_frames']))
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump({'settings': vars(args), 'results': results}, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
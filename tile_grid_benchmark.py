@@ -0,0 +1,104 @@
+"""
+tile_grid_benchmark.py
+
+Compares finding tiles with the TileGrid (see TileGrid.py) against scanning
+    every tile's Rectangle, as ImageCollection used to, on a map of
+    overlapping tiles.
+
+    $ python tile_grid_benchmark.py --tiles 10000 --queries 2000
+
+Reports microseconds per query for points (add_covered_point), cutout sized
+    rectangles (get_cutout) and overlap queries, and the time to add the
+    tiles to the grid one at a time.  The grid's answers are checked against
+    the scan's.
+
+"""
+import json
+import time
+import argparse
+
+import numpy as np
+
+from Rectangle import Rectangle
+from TileGrid import TileGrid
+
+
+def make_tiles(count, size=100.0, overlap=0.1, jitter=5.0, seed=0):
+    """ Tiles of a map, `count` of them in a square-ish grid with some
+            overlap and stage jitter.
+    """
+    rng = np.random.RandomState(seed)
+    columns = int(np.ceil(np.sqrt(count)))
+    step = size*(1 - overlap)
+    tiles = []
+    for n in range(count):
+        x = (n % columns)*step + rng.uniform(-jitter, jitter)
+        y = (n // columns)*step + rng.uniform(-jitter, jitter)
+        tiles.append(Rectangle(x, x + size, y, y + size))
+    return tiles
+
+
+def scan_point(tiles, x, y):
+    return [n for n, tile in enumerate(tiles) if tile.contains_point(x, y)]
+
+
+def scan_rect(tiles, rect):
+    return [n for n, tile in enumerate(tiles) if tile.contains_rect(rect)]
+
+
+def scan_overlapping(tiles, rect):
+    return [n for n, tile in enumerate(tiles)
+            if tile.left < rect.right and rect.left < tile.right and tile.top < rect.bottom and rect.top < tile.bottom]
+
+
+def time_queries(function, queries):
+    t0 = time.time()
+    results = [function(*query) for query in queries]
+    return (time.time() - t0)/len(queries)*1e6, results
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Tile lookup benchmark.")
+    parser.add_argument("--tiles", type=int, default=10000, help="tiles in the map")
+    parser.add_argument("--queries", type=int, default=2000, help="queries of each kind")
+    parser.add_argument("--cutout", type=float, default=20.0, help="cutout size, tiles are 100")
+    parser.add_argument("--output", help="json file to save results to")
+    args = parser.parse_args()
+
+    tiles = make_tiles(args.tiles)
+    t0 = time.time()
+    grid = TileGrid()
+    for n, tile in enumerate(tiles):
+        grid.add(tile, n)
+    add_us = (time.time() - t0)/len(tiles)*1e6
+
+    rng = np.random.RandomState(1)
+    extent = max(tile.right for tile in tiles)
+    points = [tuple(xy) for xy in rng.uniform(0, extent, (args.queries, 2))]
+    half = args.cutout/2
+    rects = [(Rectangle(x - half, x + half, y - half, y + half),) for x, y in points]
+    # eg. the tiles around a cutout, for stitching
+    around = [(Rectangle(x - 5*half, x + 5*half, y - 5*half, y + 5*half),) for x, y in points]
+
+    results = []
+    for name, scan, indexed, queries in [
+            ("point", lambda x, y: scan_point(tiles, x, y), grid.containing_point, points),
+            ("contains", lambda r: scan_rect(tiles, r), grid.containing_rect, rects),
+            ("overlap", lambda r: scan_overlapping(tiles, r), grid.overlapping, around)]:
+        scan_us, expected = time_queries(scan, queries)
+        grid_us, found = time_queries(indexed, queries)
+        results.append({'query': name, 'scan_us': scan_us, 'grid_us': grid_us, 'speedup': scan_us/grid_us,
+                        'mismatches': sum(e != f for e, f in zip(expected, found))})
+
+    print("{} tiles, {:.1f} us per tile added".format(len(tiles), add_us))
+    print("{:<10}{:>12}{:>12}{:>10}{:>12}".format("query", "scan us", "grid us", "speedup", "mismatches"))
+    for r in results:
+        print("{:<10}{:>12.1f}{:>12.1f}{:>10.0f}{:>12}".format(
+            r['query'], r['scan_us'], r['grid_us'], r['speedup'], r['mismatches']))
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump({'settings': vars(args), 'add_us': add_us, 'results': results}, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,107 @@
+"""
+trace_report.py
+
+Summarizes acquisition trace files (see AcquisitionTrace.py) as per-phase
+    percentiles.
+
+    $ python trace_report.py C:/data/session1
+    $ python trace_report.py acquisition_trace.csv acquisition_trace_save.csv
+
+Directories are searched for files named acquisition_trace*.csv.
+
+"""
+import os
+import sys
+import argparse
+
+import numpy as np
+
+from AcquisitionTrace import load_trace
+
+PERCENTILES = (50, 90, 99)
+
+
+def find_trace_files(paths):
+    files = []
+    for path in paths:
+        if os.path.isdir(path):
+            for f in sorted(os.listdir(path)):
+                if f.startswith("acquisition_trace") and f.endswith(".csv"):
+                    files.append(os.path.join(path, f))
+        else:
+            files.append(path)
+    return files
+
+
+def summarize(spans):
+    """ Per-phase statistics for a list of spans.
+
+        Returns:
+            list: one dict per phase, sorted by total time spent
+    """
+    durations = {}
+    for phase, section, frame, start, duration in spans:
+        durations.setdefault(phase, []).append(duration)
+
+    if spans:
+        starts = np.array([s[3] for s in spans])
+        ends = starts + np.array([s[4] for s in spans])
+        wall_clock = ends.max() - starts.min()
+    else:
+        wall_clock = 0.0
+
+    summary = []
+    for phase, values in durations.items():
+        values = np.array(values)
+        row = {
+            'phase': phase,
+            'count': len(values),
+            'total': values.sum(),
+            'mean': values.mean(),
+            'max': values.max(),
+            'share': values.sum()/wall_clock if wall_clock else 0.0,
+        }
+        for p in PERCENTILES:
+            row['p%d' % p] = np.percentile(values, p)
+        summary.append(row)
+    summary.sort(key=lambda r: r['total'], reverse=True)
+    return summary, wall_clock
+
+
+def frame_count(spans):
+    return len(set((s[1], s[2]) for s in spans if s[1] >= 0))
+
+
+def print_summary(summary, wall_clock, frames):
+    print("wall clock: {:.1f} s  frames: {}".format(wall_clock, frames))
+    if frames:
+        print("per frame: {:.1f} ms".format(1000.0*wall_clock/frames))
+    columns = ["count", "total"] + ["p%d" % p for p in PERCENTILES] + ["max"]
+    print("{:<18}".format("phase") + "".join("{:>10}".format(c) for c in columns) + "{:>8}".format("share"))
+    for row in summary:
+        line = "{:<18}{:>10d}{:>10.1f}".format(row['phase'], row['count'], row['total'])
+        for c in columns[2:]:
+            line += "{:>10.1f}".format(1000.0*row[c])
+        line += "{:>7.1f}%".format(100.0*row['share'])
+        print(line)
+    print("(total in s, percentiles and max in ms; share is of wall clock and can overlap)")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Summarize acquisition trace files.")
+    parser.add_argument("paths", nargs="+", help="trace files or session directories")
+    args = parser.parse_args()
+
+    files = find_trace_files(args.paths)
+    if not files:
+        print("No trace files found.")
+        sys.exit(1)
+    spans = []
+    for f in files:
+        spans.extend(load_trace(f))
+    summary, wall_clock = summarize(spans)
+    print_summary(summary, wall_clock, frame_count(spans))
+
+
+if __name__ == '__main__':
+    main()